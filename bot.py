@@ -5,9 +5,11 @@ import time
 import logging
 import random
 import re
+import threading
 import imaplib
 import email
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from instagrapi import Client
 import openai
 from instagrapi.mixins.challenge import ChallengeChoice
@@ -17,14 +19,24 @@ from instagrapi.exceptions import (
     FeedbackRequired, PleaseWaitFewMinutes, LoginRequired,
     ChallengeError, ChallengeSelfieCaptcha, ChallengeUnknownStep
 )
-import requests
 import base64
 from cryptography.fernet import Fernet
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
-import firebase_admin
-from firebase_admin import credentials
 from firebase_admin import db
+from chat_storage import init_firebase, normalize_conversation
+from chat_history import ChatHistoryManager
+from llm_gateway import LLMGateway
+from llm_router import ChatRouter, iter_sentences
+from memory_index import MemoryIndex
+from summary_memory import SummaryStore
+from memory_cache import MemoryResultCache
+from prompt_builder import build_history_prompt, fit_messages
+from humanizer import Humanizer
+from rule_engine import RuleEngine
+from inbox_sync import InboxSync
+from worker_pool import OrderedWorkerPool, SendPacer
+from resilience import post_with_retry
 
 # 加载 .env 文件
 load_dotenv()
@@ -88,9 +100,13 @@ INSTAGRAM_USERNAME = os.getenv('INSTAGRAM_USERNAME', '')
 INSTAGRAM_PASSWORD = os.getenv('INSTAGRAM_PASSWORD', '')
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY', '')
 OPENAI_API_BASE = os.getenv('OPENAI_API_BASE', 'https://api.deepseek.com/v1')
-LINGYI_API_KEY = os.getenv('LINGYI_API_KEY', '')
-LINGYI_API_BASE = os.getenv('LINGYI_API_BASE', 'https://api.lingyiwanwu.com/v1/chat/completions')
 CHAT_HISTORY_KEY = os.getenv('CHAT_HISTORY_KEY', '')  # 用于加密聊天记录的密钥
+MEMORY_MODE = os.getenv('MEMORY_MODE', 'local').lower()  # local（本地检索）/ rerank（本地检索后由记忆 AI 筛选）/ llm（记忆 AI 读取完整历史）
+MEMORY_TOP_K = int(os.getenv('MEMORY_TOP_K', '5'))  # 本地检索返回的对话组数
+REPLY_STREAM_MODE = os.getenv('REPLY_STREAM_MODE', 'off').lower()  # off / first（首句先发）/ each（逐句发送）
+REPLY_SPECULATIVE = os.getenv('REPLY_SPECULATIVE', 'false').lower() == 'true'  # 检索记忆的同时生成不带记忆的草稿回复，只在 MEMORY_MODE 为 llm/rerank 时生效
+REPLY_RULES_FAST_PATH = os.getenv('REPLY_RULES_FAST_PATH', 'false').lower() == 'true'  # 先用 reply_rules.json 中的规则快速回复
+LOCAL_HISTORY_DIR = "downloaded_artifacts 22-29-31-785/artifact_2510800793"  # 本地历史对话目录
 
 # 配置OpenAI
 openai.api_key = OPENAI_API_KEY
@@ -155,58 +171,15 @@ def change_password_handler(username):
     logger.info(f"为账号 {username} 生成新密码: {password}")
     return password
 
-def create_chat_completion(messages, use_lingyi=True, max_retries=3, retry_delay=2):
-    """创建聊天回复，只使用灵医万物 API"""
-    retries = 0
-    while retries < max_retries:
-        try:
-            logger.info(f"尝试调用灵医万物 API [尝试次数: {retries + 1}/{max_retries}]")
-            response = requests.post(
-                LINGYI_API_BASE,
-                headers={
-                    "Authorization": f"Bearer {LINGYI_API_KEY}",
-                    "Content-Type": "application/json"
-                },
-                json={
-                    "model": "yi-34b-chat-0205",  # 指定模型
-                    "messages": messages,
-                    "temperature": 0.7,
-                    "max_tokens": 1000
-                }
-            )
-            
-            if response.status_code == 200:
-                return response.json()["choices"][0]["message"]["content"], True
-                
-            # 记录详细的错误信息
-            logger.error(f"API 错误 [状态码: {response.status_code}]")
-            logger.error(f"错误响应: {response.text}")
-            
-            # 如果是 500 错误，等待后重试
-            if response.status_code == 500:
-                if retries < max_retries - 1:
-                    logger.warning(f"服务器错误，等待 {retry_delay} 秒后重试")
-                    time.sleep(retry_delay)
-                    retries += 1
-                    continue
-            
-            # 其他错误直接返回错误消息
-            return "The server is too busy, I'm sorry I can't reply, you can try sending it to me again 😭", True
-                
-        except Exception as e:
-            logger.error(f"API 调用异常: {str(e)}")
-            if retries < max_retries - 1:
-                logger.info(f"等待 {retry_delay} 秒后重试")
-                time.sleep(retry_delay)
-                retries += 1
-                continue
-            break
-            
-    # 所有重试都失败后返回错误消息
-    return "The server is too busy, I'm sorry I can't reply, you can try sending it to me again 😭", True
+def call_memory_ai(messages, chat_history=None, conversation=None):
+    """调用 Gemini 1.5 Flash 作为记忆 AI
 
-def call_memory_ai(messages):
-    """调用 Gemini 1.5 Flash 作为记忆 AI"""
+    Args:
+        messages: [系统提示词, 带 thread_id 元数据的用户消息]
+        chat_history: 读取对话历史的 ChatHistoryManager（包含尚未写入存储的消息），
+            默认直接读取 Firebase
+        conversation: 只让记忆 AI 从这些消息中挑选（例如本地检索的候选），不再读取完整历史
+    """
     try:
         logger.info("使用 Gemini Flash API 调用记忆管理")
         
@@ -235,8 +208,12 @@ def call_memory_ai(messages):
             logger.debug(f"完整消息结构: {json.dumps(messages, ensure_ascii=False, indent=2)}")
             return "none"
             
-        ref = db.reference(f'chat_histories/{thread_id}')
-        conversation = ref.get()
+        if conversation is not None:
+            logger.info("使用本地检索的候选对话")
+        elif chat_history is not None:
+            conversation = chat_history.load_conversation(thread_id)
+        else:
+            conversation = normalize_conversation(db.reference(f'chat_histories/{thread_id}').get())
         
         if not conversation:
             logger.warning(f"未找到对话历史 [对话ID: {thread_id}]")
@@ -252,21 +229,23 @@ def call_memory_ai(messages):
         # 构建提示词
         system_prompt = messages[0]["content"]
         user_prompt = messages[1]["content"]
-        prompt = f"""请根据以下规则分析对话历史并回复：
+        template = f"""请根据以下规则分析对话历史并回复：
 
 {system_prompt}
 
 对话历史:
-{json.dumps(conversation, ensure_ascii=False, indent=2)}
+{{history}}
 
-当前问题: {user_prompt}
+当前问题: {{question}}
 
 请分析对话历史并按要求返回相关对话片段。"""
+        prompt = build_history_prompt(template, conversation, user_prompt, 'gemini')
         
         logger.info("发送请求到 Gemini API...")
         
         # 调用 Gemini API
-        response = requests.post(
+        response = post_with_retry(
+            'gemini',
             'https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-flash:generateContent',
             headers={
                 'x-goog-api-key': api_key,
@@ -305,188 +284,43 @@ def call_memory_ai(messages):
             }
         )
         
-        if response.status_code == 200:
-            result = response.json()
-            response_text = result['candidates'][0]['content']['parts'][0]['text']
-            logger.info("Gemini API 响应成功")
-            logger.info(f"响应内容: {response_text[:200]}...")
-            
-            # 验证和格式化返回结果
-            try:
-                # 清理响应文本，只保留 JSON 部分
-                json_text = response_text.strip()
-                if json_text.startswith('```json'):
-                    json_text = json_text[7:]
-                if json_text.endswith('```'):
-                    json_text = json_text[:-3]
-                json_text = json_text.strip()
-                
-                # 如果返回的是 "none"，直接返回
-                if json_text.strip('"') == "none":
-                    return "none"
-                    
-                # 尝试解析 JSON
-                if json_text.startswith('['):
-                    memory_list = json.loads(json_text)
-                    # 验证格式是否正确
-                    if all(isinstance(msg, dict) and 'role' in msg and 'content' in msg for msg in memory_list):
-                        return json.dumps(memory_list, ensure_ascii=False)
-                
-                logger.warning("记忆AI返回格式无效，返回 none")
-                return "none"
-                
-            except json.JSONDecodeError as e:
-                logger.error(f"JSON 解析失败: {str(e)}")
+        result = response.json()
+        response_text = result['candidates'][0]['content']['parts'][0]['text']
+        logger.info("Gemini API 响应成功")
+        logger.info(f"响应内容: {response_text[:200]}...")
+        
+        # 验证和格式化返回结果
+        try:
+            # 清理响应文本，只保留 JSON 部分
+            json_text = response_text.strip()
+            if json_text.startswith('```json'):
+                json_text = json_text[7:]
+            if json_text.endswith('```'):
+                json_text = json_text[:-3]
+            json_text = json_text.strip()
+        
+            # 如果返回的是 "none"，直接返回
+            if json_text.strip('"') == "none":
                 return "none"
-        else:
-            logger.error(f"Gemini API 错误: {response.status_code}")
-            logger.error(f"错误信息: {response.text}")
+        
+            # 尝试解析 JSON
+            if json_text.startswith('['):
+                memory_list = json.loads(json_text)
+                # 验证格式是否正确
+                if all(isinstance(msg, dict) and 'role' in msg and 'content' in msg for msg in memory_list):
+                    return json.dumps(memory_list, ensure_ascii=False)
+        
+            logger.warning("记忆AI返回格式无效，返回 none")
+            return "none"
+        
+        except json.JSONDecodeError as e:
+            logger.error(f"JSON 解析失败: {str(e)}")
             return "none"
             
     except Exception as e:
         logger.error(f"记忆 AI 调用失败: {str(e)}")
         return "none"
 
-class ChatHistoryManager:
-    def __init__(self):
-        """初始化 Firebase 连接"""
-        try:
-            # 从环境变量获取 Firebase 配置
-            firebase_cred_base64 = os.getenv('FIREBASE_CREDENTIALS_BASE64')
-            firebase_url = os.getenv('FIREBASE_DATABASE_URL')
-            
-            if not firebase_cred_base64 or not firebase_url:
-                logger.error("Firebase 配置未找到")
-                return
-                
-            # 解码 base64 凭证
-            try:
-                cred_json = base64.b64decode(firebase_cred_base64).decode('utf-8')
-                cred_dict = json.loads(cred_json)
-                logger.info("Firebase 凭证解码成功")
-            except Exception as e:
-                logger.error(f"Firebase 凭证解码失败: {str(e)}")
-                return
-                
-            # 初始化 Firebase
-            logger.info("初始化 Firebase 连接...")
-            cred = credentials.Certificate(cred_dict)
-            firebase_admin.initialize_app(cred, {
-                'databaseURL': firebase_url
-            })
-            logger.info("Firebase 连接成功")
-            
-            self.conversations = {}
-            self.ref = db.reference('chat_histories')
-            
-        except Exception as e:
-            logger.error(f"初始化 Firebase 失败: {str(e)}")
-
-    def save_conversation(self, thread_id):
-        """保存对话到 Firebase"""
-        thread_id = str(thread_id)
-        if thread_id not in self.conversations:
-            return
-            
-        conversation = self.conversations[thread_id]
-        if not conversation:
-            return
-            
-        try:
-            logger.info(f"保存对话到 Firebase [对话ID: {thread_id}]")
-            # 更新 Firebase
-            self.ref.child(thread_id).set(conversation)
-            logger.info("保存成功")
-            
-            # 同时保存本地备份
-            local_dir = "downloaded_artifacts 22-29-31-785/artifact_2510800793"
-            os.makedirs(local_dir, exist_ok=True)
-            local_file = os.path.join(local_dir, f"conversation_{thread_id}.json")
-            with open(local_file, 'w', encoding='utf-8') as f:
-                json.dump(conversation, f, ensure_ascii=False, indent=2)
-            logger.info(f"保存本地备份: {local_file}")
-            
-        except Exception as e:
-            logger.error(f"保存对话失败 [对话ID: {thread_id}]: {str(e)}")
-
-    def load_conversation(self, thread_id):
-        """从 Firebase 加载对话"""
-        thread_id = str(thread_id)
-        logger.info(f"尝试从 Firebase 加载对话 [对话ID: {thread_id}]")
-        
-        try:
-            # 从 Firebase 加载
-            conversation = self.ref.child(thread_id).get()
-            if conversation:
-                logger.info(f"成功从 Firebase 加载对话 - {len(conversation)} 条消息")
-                self.conversations[thread_id] = conversation
-                return conversation
-                
-            # 如果 Firebase 没有数据，尝试从本地加载
-            logger.info("Firebase 中未找到数据，尝试从本地加载")
-            local_file = f"downloaded_artifacts 22-29-31-785/artifact_2510800793/conversation_{thread_id}.json"
-            if os.path.exists(local_file):
-                with open(local_file, 'r', encoding='utf-8') as f:
-                    conversation = json.load(f)
-                logger.info(f"成功从本地加载对话 - {len(conversation)} 条消息")
-                # 同步到 Firebase
-                self.ref.child(thread_id).set(conversation)
-                logger.info("已同步本地数据到 Firebase")
-                self.conversations[thread_id] = conversation
-                return conversation
-                
-            logger.info("未找到对话历史")
-            return []
-            
-        except Exception as e:
-            logger.error(f"加载对话失败: {str(e)}")
-            return []
-
-    def add_message(self, thread_id, role, content, metadata=None):
-        """添加新消息到对话历史"""
-        # 如果内容为空或者全是 ***，则不保存
-        if not content or content.strip() == "***":
-            return
-            
-        thread_id = str(thread_id)
-        masked_thread_id = f"****{thread_id[-4:]}"
-        
-        if thread_id not in self.conversations:
-            self.conversations[thread_id] = []
-            
-        # 构建消息
-        message = {
-            'timestamp': datetime.now().isoformat(),
-            'role': role,
-            'content': content
-        }
-        if metadata:
-            message['metadata'] = metadata
-            
-        # 先添加到内存中的对话列表
-        self.conversations[thread_id].append(message)
-        current_index = len(self.conversations[thread_id]) - 1
-            
-        # 保存到 Firebase，使用当前消息的索引
-        try:
-            ref = db.reference(f'chat_histories/{thread_id}')
-            # 获取当前对话的所有消息
-            current_messages = ref.get() or []
-            # 添加新消息到列表末尾
-            current_messages.append(message)
-            # 更新整个对话历史
-            ref.set(current_messages)
-            logger.info(f"已保存消息到 Firebase [对话ID: {masked_thread_id}]")
-        except Exception as e:
-            logger.error(f"保存到 Firebase 失败: {str(e)}")
-            # 如果保存失败，从内存中移除消息
-            if thread_id in self.conversations:
-                self.conversations[thread_id].pop()
-            return
-        
-        # 最后记录日志
-        logger.info(f"添加新消息 [对话ID: {masked_thread_id}] - {role}: ***")
-
 class InstagramBot:
     def __init__(self, username, password):
         self.client = Client()
@@ -496,14 +330,38 @@ class InstagramBot:
         self.processed_messages = set()  # 用于跟踪已处理的消息
         self.relogin_attempt = 0
         self.max_relogin_attempts = 3
-        self.use_lingyi = True
         
         # 对话上下文管理
         self.conversation_contexts = {}
         self.max_context_length = 20
         
         # 聊天历史管理
-        self.chat_history = ChatHistoryManager()
+        self.memory_index = MemoryIndex() if MEMORY_MODE != 'llm' else None
+        self.chat_history = ChatHistoryManager(backup_dir=LOCAL_HISTORY_DIR, memory_index=self.memory_index)
+        self.memory_cache = MemoryResultCache()
+        
+        # 模型调用网关（按服务商限制并发，带截止时间）
+        self.llm = LLMGateway()
+        # 灵医万物 / DeepSeek 对冲调用
+        self.router = ChatRouter(self.llm)
+        # 投机生成的草稿回复在这里等待模型返回
+        self.draft_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="draft")
+        self.draft_stats = {'used': 0, 'replaced': 0}
+        self.draft_lock = threading.Lock()
+        # 模拟真人回复时间，生成回复的耗时计算在内
+        self.humanizer = Humanizer()
+        # 快速回复规则，命中时不调用模型
+        self.rules = RuleEngine.load() if REPLY_RULES_FAST_PATH else None
+        # 收件箱增量同步（每个对话的高水位保存在存储后端）
+        self.inbox = InboxSync(self.client, storage=self.chat_history.storage)
+        # 不同对话并行处理（同一对话内按顺序），发送消息共用一个节奏
+        self.workers = OrderedWorkerPool()
+        self.pacer = SendPacer()
+        self.exception_lock = threading.RLock()
+        
+        # 分层滚动摘要（长期记忆），随新消息增量更新
+        self.summaries = SummaryStore(self.summarize_context, storage=self.chat_history.storage)
+        self.chat_history.add_listener(self.summaries.add_message)
         
         # 设置验证码处理器
         self.client.challenge_code_handler = challenge_code_handler
@@ -512,6 +370,7 @@ class InstagramBot:
         self.client.delay_range = [1, 3]
         self.daily_message_limit = 100
         self.message_count = 0
+        self.count_lock = threading.Lock()  # 多个对话并行处理，计数和每日上限检查需要加锁
         self.setup_device()
         
     def setup_device(self):
@@ -536,7 +395,17 @@ class InstagramBot:
         self.client.set_locale("en_US")
         self.client.set_timezone_offset(-7 * 60 * 60)  # Los Angeles UTC-7
         
+    def send_message(self, thread_id, text):
+        """发送私信，所有对话共用 SendPacer 控制发送频率，发送期间独占 Instagram 客户端"""
+        with self.pacer:
+            return self.client.direct_answer(thread_id, text)
+
     def handle_exception(self, e):
+        """处理各种异常（多个对话同时出错时依次处理，避免同时重新登录；处理期间暂停发送）"""
+        with self.exception_lock, self.pacer.lock:
+            return self._handle_exception(e)
+
+    def _handle_exception(self, e):
         """处理各种异常"""
         if isinstance(e, BadPassword):
             logger.error(f"密码错误: {str(e)}")
@@ -666,9 +535,9 @@ class InstagramBot:
     def login(self):
         """登录 Instagram"""
         try:
-            # 尝试从 Firebase 加载会话
-            ref = db.reference('instagram_session')
-            session_data = ref.get()
+            # 尝试从 Firebase 加载会话（聊天记录使用本地存储时 Firebase 可能未配置）
+            ref = db.reference('instagram_session') if init_firebase() else None
+            session_data = ref.get() if ref else None
             
             if session_data:
                 logger.info("从 Firebase 加载会话数据")
@@ -695,8 +564,9 @@ class InstagramBot:
                 self.client.dump_settings('session.json')
                 with open('session.json', 'r') as f:
                     session_data = json.load(f)
-                ref.set(session_data)
-                logger.info("登录成功并保存新会话到 Firebase")
+                if ref:
+                    ref.set(session_data)
+                    logger.info("登录成功并保存新会话到 Firebase")
             except Exception as e:
                 logger.error(f"保存会话到 Firebase 失败: {str(e)}")
                 # 即使保存失败也继续运行
@@ -710,50 +580,87 @@ class InstagramBot:
                 self.client.dump_settings('session.json')
                 with open('session.json', 'r') as f:
                     session_data = json.load(f)
-                ref.set(session_data)
-                logger.info("已保存会话到 Firebase")
+                if ref:
+                    ref.set(session_data)
+                    logger.info("已保存会话到 Firebase")
             except Exception as save_error:
                 logger.error(f"保存会话失败: {str(save_error)}")
             
             return False
 
-    def summarize_context(self, context):
+    def summarize_context(self, context, max_chars=20):
         """使用AI总结对话上下文"""
         try:
             messages = [
-                {"role": "system", "content": "请将以下对话总结为20字以内的要点，保留关键信息。"},
+                {"role": "system", "content": f"请将以下对话总结为{max_chars}字以内的要点，保留关键信息。"},
                 {"role": "user", "content": context}
             ]
-            summary, _ = create_chat_completion(messages, self.use_lingyi)
+            summary, _ = self.router.complete(messages)
             logger.info(f"对话上下文总结: ***")
             return summary
         except Exception as e:
             logger.error(f"总结上下文失败: {str(e)}")
             return ""
 
-    def get_ai_response(self, message, thread_id):
-        """获取AI回复"""
-        try:
-            # 先记录原始对话ID
-            logger.info(f"开始处理对话 [原始对话ID: {thread_id}]")
-            
-            # 隐藏敏感信息的线程ID
-            masked_thread_id = f"****{str(thread_id)[-4:]}"
-            logger.info(f"处理对话 [掩码对话ID: {masked_thread_id}]")
-            
-            # 加载历史对话
-            try:
-                conversation = self.chat_history.load_conversation(thread_id)
-                logger.info(f"加载历史对话 [对话ID: {thread_id}] - {len(conversation)} 条消息")
-            except Exception as e:
-                logger.error(f"加载历史对话时出错: {str(e)}")
-                conversation = []
-            
-            # 构建记忆提取提示词
-            memory_messages = [
-                {
-                    "role": "system",
-                    "content": """你是一个专业的记忆管理 AI 助手。你的任务是从记忆库中提取相关对话片段，并严格按照以下格式返回。注意：你必须直接返回 JSON 格式的结果，不要包含任何其他内容。
+    def retrieve_memory(self, message, thread_id, memory_messages):
+        """检索与当前问题相关的历史对话
+
+        Returns:
+            str: JSON 格式的消息列表，没有相关记忆时返回 "none"
+        """
+        thread_id = str(thread_id)
+        if self.memory_index is not None:
+            if self.memory_index.needs_build(thread_id):
+                try:
+                    history = self.chat_history.load_conversation(thread_id, strict=True)
+                except Exception as e:
+                    # 读取失败时不建立索引，否则会保存一个空索引，之后不再重建
+                    logger.error(f"加载对话历史失败，暂不建立记忆索引: {str(e)}")
+                else:
+                    self.memory_index.build(thread_id, history)
+            # 索引没有建立时只包含本次运行的新消息，版本不可靠
+            version = None if self.memory_index.needs_build(thread_id) else self.memory_index.version(thread_id)
+        else:
+            version = self.chat_history.history_version(thread_id)
+
+        # 历史没有变化时，同样的问题直接使用上次的结果；版本未知时不使用缓存
+        if version is not None:
+            cached = self.memory_cache.get(thread_id, version, message)
+            if cached is not None:
+                logger.info(f"命中记忆缓存 [对话ID: ****{thread_id[-4:]}]")
+                return cached
+
+        memory_response = self._lookup_memory(message, thread_id, memory_messages)
+        # 记忆 AI 出错时也返回 "none"，只缓存本地检索的空结果
+        if version is not None and (memory_response != "none" or MEMORY_MODE == 'local'):
+            self.memory_cache.put(thread_id, version, message, memory_response)
+        return memory_response
+
+    def _lookup_memory(self, message, thread_id, memory_messages):
+        if self.memory_index is None:
+            return self.llm.run('gemini', call_memory_ai, memory_messages, self.chat_history)
+
+        # 重排模式多取一些候选，交给记忆 AI 筛选
+        top_k = MEMORY_TOP_K * 3 if MEMORY_MODE == 'rerank' else MEMORY_TOP_K
+        candidates = self.memory_index.search(thread_id, message, k=top_k)
+        logger.info(f"本地检索到 {len(candidates) // 2} 组相关对话")
+        if not candidates:
+            return "none"
+        if MEMORY_MODE == 'rerank':
+            return self.llm.run('gemini', call_memory_ai, memory_messages, self.chat_history, candidates)
+        return json.dumps(candidates, ensure_ascii=False)
+
+    def find_memory(self, message, thread_id):
+        """调用记忆检索，出错时返回 "none"
+
+        Returns:
+            str: JSON 格式的相关历史消息，没有时为 "none"
+        """
+        # 构建记忆提取提示词
+        memory_messages = [
+            {
+                "role": "system",
+                "content": """你是一个专业的记忆管理 AI 助手。你的任务是从记忆库中提取相关对话片段，并严格按照以下格式返回。注意：你必须直接返回 JSON 格式的结果，不要包含任何其他内容。
 
 1. 如果找到相关记忆，返回格式如下：
 [
@@ -784,41 +691,71 @@ class InstagramBot:
    - 在一个对话串中，必须保持主题一致
    - 例如：讨论游戏时的对话不要与讨论美食的对话混在一起
    - 即使用词相似，也要确保上下文主题相同"""
-                },
-                {
-                    "role": "user",
-                    "content": f"历史对话：{json.dumps(conversation, ensure_ascii=False)}\n\n当前问题：{message}",
-                    "metadata": {
-                        "thread_id": thread_id,
-                        "timestamp": datetime.now().isoformat()
-                    }
+            },
+            {
+                "role": "user",
+                # 对话历史由 call_memory_ai 读取后放入提示词，这里不再重复
+                "content": message,
+                "metadata": {
+                    "thread_id": thread_id,
+                    "timestamp": datetime.now().isoformat()
                 }
-            ]
-            
-            logger.info(f"开始调用记忆AI [对话ID: {thread_id}]")
-            logger.info(f"当前问题: {message}")
-            memory_response = call_memory_ai(memory_messages)
-            logger.info(f"记忆AI返回结果: ***")
-            
-            # 处理记忆结果
-            try:
-                if memory_response != "none":
-                    memory_list = json.loads(memory_response)
-                    if isinstance(memory_list, list) and len(memory_list) > 0:
-                        logger.info(f"找到相关历史记忆: {len(memory_list)} 条消息")
-                        messages = memory_list + [{"role": "user", "content": message}]
-                    else:
-                        logger.info("记忆格式无效，忽略历史记忆")
-                        messages = [{"role": "user", "content": message}]
+            }
+        ]
+        
+        logger.info(f"开始检索记忆 [对话ID: {thread_id}]")
+        logger.info(f"当前问题: {message}")
+        try:
+            memory_response = self.retrieve_memory(message, thread_id, memory_messages)
+        except Exception as e:
+            logger.error(f"记忆检索失败: {str(e)}")
+            memory_response = "none"
+        logger.info(f"记忆检索结果: ***")
+        return memory_response
+
+    def build_reply_messages(self, message, thread_id, memory_response=None):
+        """构建生成回复的消息列表：记忆 AI 检索到的历史 + 系统提示词 + 当前消息
+
+        Args:
+            memory_response: 已经得到的记忆检索结果，为 None 时在这里检索
+        """
+        # 先记录原始对话ID
+        logger.info(f"开始处理对话 [原始对话ID: {thread_id}]")
+        
+        # 隐藏敏感信息的线程ID
+        masked_thread_id = f"****{str(thread_id)[-4:]}"
+        logger.info(f"处理对话 [掩码对话ID: {masked_thread_id}]")
+        
+        # 加载最近的历史对话（完整历史由记忆 AI 自行检索）
+        try:
+            conversation = self.chat_history.load_conversation(thread_id, last_n=self.max_context_length)
+            logger.info(f"加载历史对话 [对话ID: {thread_id}] - {len(conversation)} 条消息")
+        except Exception as e:
+            logger.error(f"加载历史对话时出错: {str(e)}")
+            conversation = []
+        
+        if memory_response is None:
+            memory_response = self.find_memory(message, thread_id)
+        
+        # 处理记忆结果
+        try:
+            if memory_response != "none":
+                memory_list = json.loads(memory_response)
+                if isinstance(memory_list, list) and len(memory_list) > 0:
+                    logger.info(f"找到相关历史记忆: {len(memory_list)} 条消息")
+                    messages = memory_list + [{"role": "user", "content": message}]
                 else:
-                    logger.info("没有找到相关历史记忆")
+                    logger.info("记忆格式无效，忽略历史记忆")
                     messages = [{"role": "user", "content": message}]
-            except Exception as e:
-                logger.error(f"处理记忆结果时出错: {str(e)}")
+            else:
+                logger.info("没有找到相关历史记忆")
                 messages = [{"role": "user", "content": message}]
-            
-            # 添加系统提示词
-            system_prompt = """# 角色设定与交互规则
+        except Exception as e:
+            logger.error(f"处理记忆结果时出错: {str(e)}")
+            messages = [{"role": "user", "content": message}]
+        
+        # 添加系统提示词
+        system_prompt = """# 角色设定与交互规则
 
 ## 基本角色
 你是用户的好朋友（精通多种语言，用用户输入的语言回答）。你的回答将通过逼真的文字转语音技术阅读。
@@ -847,16 +784,77 @@ class InstagramBot:
 
 ### 语言匹配
 - 用对方的语言回答。"""
-            
-            messages.insert(0, {"role": "system", "content": system_prompt})
+        
+        # 附加长期记忆摘要
+        summary = self.summaries.context(thread_id)
+        if summary:
+            system_prompt += f"\n\n## 长期记忆（之前对话的摘要）\n{summary}"
+        
+        messages.insert(0, {"role": "system", "content": system_prompt})
+        # 按对话模型的 token 预算裁剪
+        messages = fit_messages(messages, 'lingyi')
+        return messages
+
+    def speculative_reply(self, message, thread_id):
+        """记忆检索和不带记忆的草稿回复同时进行
+
+        没有相关记忆时（最常见的情况）直接使用草稿，省去一次串行的模型调用；
+        检索到相关记忆时取消草稿，用带记忆的消息重新生成。
+
+        Returns:
+            str: 回复内容
+        """
+        start_time = time.time()
+        cancel = threading.Event()
+        draft_messages = self.build_reply_messages(message, thread_id, memory_response="none")
+        draft = self.draft_executor.submit(self.router.complete, draft_messages, cancel)
+
+        memory_response = self.find_memory(message, thread_id)
+        if memory_response == "none":
+            response_text, _ = draft.result()
+            with self.draft_lock:
+                self.draft_stats['used'] += 1
+            logger.info(f"没有相关记忆，使用草稿回复 - 耗时 {time.time() - start_time:.3f} 秒")
+            return response_text
+
+        cancel.set()
+        with self.draft_lock:
+            self.draft_stats['replaced'] += 1
+            used, replaced = self.draft_stats['used'], self.draft_stats['replaced']
+        logger.info(f"找到相关记忆，放弃草稿回复 [草稿采用 {used} 次 / 放弃 {replaced} 次]")
+        messages = self.build_reply_messages(message, thread_id, memory_response=memory_response)
+        response_text, _ = self.router.complete(messages)
+        return response_text
+
+    def quick_reply(self, message, thread_id):
+        """快速回复规则（REPLY_RULES_FAST_PATH），没有命中或未启用时返回 None"""
+        if self.rules is None:
+            return None
+        return self.rules.match(message, self.chat_history.load_conversation(thread_id, last_n=10))
+
+    def get_ai_response(self, message, thread_id, check_rules=True):
+        """获取AI回复
+
+        Args:
+            check_rules: 是否先匹配快速回复规则，调用方已经匹配过时为 False
+        """
+        try:
+            if check_rules:
+                reply = self.quick_reply(message, thread_id)
+                if reply is not None:
+                    return reply
+            
+            # 本地检索只需几毫秒，草稿几乎总会被放弃，而已经发出的 HTTP 请求无法取消；
+            # 只在记忆检索需要调用远程模型时投机生成
+            if REPLY_SPECULATIVE and MEMORY_MODE in ('llm', 'rerank'):
+                return self.speculative_reply(message, thread_id)
+
+            messages = self.build_reply_messages(message, thread_id)
             
             # 生成回复
             try:
-                time.sleep(random.uniform(1, 3))
                 logger.info(f"开始调用对话AI生成回复")
-                response_text, switch_to_lingyi = create_chat_completion(messages, self.use_lingyi)
-                if switch_to_lingyi:
-                    self.use_lingyi = True
+                response_text, _ = self.router.complete(messages)
                 logger.info(f"对话AI回复: ***")
                 
                 return response_text
@@ -868,26 +866,59 @@ class InstagramBot:
             logger.error(f"AI回复生成失败: {str(e)}")
             return "The server is too busy, I'm sorry I can't reply, you can try sending it to me again 😭"
 
+    def send_streamed_reply(self, message, thread_id, timer=None):
+        """流式生成回复，句子生成后立即发送
+
+        REPLY_STREAM_MODE=first 时第一句先发送，其余内容生成完后合并为一条发送；
+        REPLY_STREAM_MODE=each 时每句单独发送。
+        传入 timer（humanizer.ReplyTimer）时第一句发送前补足剩余的停顿时间。
+
+        Returns:
+            str: 已发送的完整回复；还没有发送任何内容就失败时返回 None
+        """
+        chunks = []
+        sent = []
+
+        def collect(stream):
+            for chunk in stream:
+                chunks.append(chunk)
+                yield chunk
+
+        try:
+            messages = self.build_reply_messages(message, thread_id)
+            logger.info(f"开始流式生成回复 [对话ID: {thread_id}]")
+            for sentence in iter_sentences(collect(self.router.stream(messages))):
+                if not sent or REPLY_STREAM_MODE == 'each':
+                    if timer is not None:
+                        timer.wait(sentence)
+                    self.send_message(thread_id, sentence)
+                    sent.append(sentence)
+                    logger.info(f"已发送第 {len(sent)} 句回复 [对话ID: {thread_id}]")
+
+            if REPLY_STREAM_MODE != 'each' and sent:
+                full_text = "".join(chunks).strip()
+                rest = full_text[full_text.find(sent[0]) + len(sent[0]):].strip()
+                if rest:
+                    self.send_message(thread_id, rest)
+                    sent.append(rest)
+        except Exception as e:
+            logger.error(f"流式回复失败 [对话ID: {thread_id}]: {str(e)}")
+            if not sent:
+                return None
+        return "\n".join(sent)
+
     def load_conversation_history(self, thread_id):
-        """根据对话ID加载特定的历史对话"""
+        """根据对话ID检查本地归档中的历史对话，只读取最近的消息"""
         try:
             thread_id = str(thread_id)
-            local_dir = "downloaded_artifacts 22-29-31-785/artifact_2510800793"
-            filename = f"conversation_{thread_id}.json"
-            filepath = os.path.join(local_dir, filename)
+            archive = self.chat_history.archive
             
-            if os.path.exists(filepath):
+            if archive.exists(thread_id):
                 logger.info(f"找到对话历史文件 [对话ID: {thread_id}]")
-                with open(filepath, 'r', encoding='utf-8') as f:
-                    conversation = json.load(f)
-                
-                # 将对话加载到chat_history中
-                self.chat_history.conversations[thread_id] = conversation
-                logger.info(f"成功加载对话历史 [对话ID: {thread_id}]")
-                logger.info(f"- 消息数量: {len(conversation)}")
+                logger.info(f"- 消息数量: {archive.count(thread_id)}")
                 logger.info("- 最近的消息:")
-                # 显示最近的3条消息
-                for i, msg in enumerate(conversation[-3:]):
+                # 显示最近的3条消息，只解析最后的分段
+                for i, msg in enumerate(archive.tail(thread_id, 3)):
                     logger.info(f"  {i+1}. {msg.get('role')}: {msg.get('content')[:100]}...")
                 return True
             else:
@@ -897,10 +928,16 @@ class InstagramBot:
             logger.error(f"加载对话历史失败 [对话ID: {thread_id}]: {str(e)}")
             return False
 
-    def process_thread(self, thread):
-        """处理单个对话线程"""
+    def process_thread(self, thread, new_messages=None):
+        """处理单个对话线程
+
+        Args:
+            new_messages: 收件箱同步得到的新消息（从早到晚），为 None 时按高水位请求
+        """
         try:
-            if self.message_count >= self.daily_message_limit:
+            with self.count_lock:
+                limit_reached = self.message_count >= self.daily_message_limit
+            if limit_reached:
                 logger.warning("已达到每日消息限制")
                 return
                 
@@ -909,23 +946,40 @@ class InstagramBot:
             # 在处理消息前加载该对话的历史记录
             self.load_conversation_history(thread_id)
             
-            # 获取完整的对话内容（最近1条消息）
-            full_thread = self.client.direct_thread(thread_id, amount=1)
-            if not full_thread.messages:
-                return
-                
-            # 获取最新消息
-            message = full_thread.messages[0]
+            if new_messages is None:
+                # 一次请求取到上次处理之后的所有消息
+                new_messages = self.inbox.unseen(thread)
             
-            # 检查消息是否已经回复过
-            if message.id in self.processed_messages:
+            # 跳过已经回复过的消息
+            batch = [msg for msg in new_messages if msg.id not in self.processed_messages]
+            if not batch:
+                if new_messages:
+                    self.inbox.mark(thread_id, new_messages[-1])
                 return
             
-            # 处理消息
-            if message.item_type == 'text' and message.text:
-                self.handle_text_messages([message], thread_id)
-            elif message.item_type in ['media', 'clip', 'voice_media', 'animated_media', 'reel_share']:
-                self.handle_media_message(message, thread_id)
+            # 处理消息：媒体消息逐条回复，连续发来的文本消息合并为一次回复
+            texts = []
+            for message in batch:
+                if message.item_type == 'text' and message.text:
+                    texts.append(message)
+                elif message.item_type in ['media', 'clip', 'voice_media', 'animated_media', 'reel_share']:
+                    self.handle_media_message(message, thread_id)
+                else:
+                    # 不支持回复的消息类型，同样记为已处理
+                    self.processed_messages.add(message.id)
+            if texts:
+                if len(texts) > 1:
+                    logger.info(f"对话中有 {len(texts)} 条未处理的文本消息，合并回复 [对话ID: {thread_id}]")
+                self.handle_text_messages(texts, thread_id)
+            
+            # 高水位只推进到连续处理成功的最后一条，失败的消息下次轮询时重试
+            last_done = None
+            for message in new_messages:
+                if message.id not in self.processed_messages:
+                    break
+                last_done = message
+            if last_done is not None:
+                self.inbox.mark(thread_id, last_done)
                     
         except Exception as e:
             logger.error(f"处理消息时出错: {str(e)}")
@@ -935,6 +989,7 @@ class InstagramBot:
         """处理多条文本消息"""
         try:
             thread_id = str(thread_id)
+            timer = self.humanizer.start(thread_id)
             # 只有多条消息时才使用编号格式
             if len(messages) > 1:
                 combined_message = "\n".join([f"{i+1}. {msg.text}" for i, msg in enumerate(messages)])
@@ -957,15 +1012,28 @@ class InstagramBot:
                 )
                 logger.info(f"已保存用户消息 [对话ID: {thread_id}]")
             
-            # 生成AI回复
-            logger.debug(f"开始生成AI回复 [对话ID: {thread_id}]")
-            ai_response = self.get_ai_response(combined_message, thread_id)
-            logger.debug(f"AI回复内容: {ai_response}")
-            time.sleep(random.uniform(2, 5))
+            # 先匹配快速回复规则，命中时不需要打开流式连接
+            quick_response = self.quick_reply(combined_message, thread_id)
+
+            # 流式模式下边生成边发送，失败时改用普通模式
+            ai_response = None
+            if quick_response is None and REPLY_STREAM_MODE in ('first', 'each'):
+                ai_response = self.send_streamed_reply(combined_message, thread_id, timer)
             
-            # 使用direct_answer发送回复
             try:
-                self.client.direct_answer(thread_id, ai_response)
+                if ai_response is None:
+                    # 生成AI回复
+                    logger.debug(f"开始生成AI回复 [对话ID: {thread_id}]")
+                    if quick_response is not None:
+                        ai_response = quick_response
+                    else:
+                        ai_response = self.get_ai_response(combined_message, thread_id, check_rules=False)
+                    logger.debug(f"AI回复内容: {ai_response}")
+                    # 只等待目标回复时间中剩余的部分
+                    timer.wait(ai_response)
+                    
+                    # 使用direct_answer发送回复
+                    self.send_message(thread_id, ai_response)
                 logger.info(f"回复成功 [对话ID: {thread_id}] - 消息已发送")
                 
                 # 保存AI回复
@@ -983,7 +1051,8 @@ class InstagramBot:
                 # 标记所有消息为已处理
                 for message in messages:
                     self.processed_messages.add(message.id)
-                self.message_count += 1
+                with self.count_lock:
+                    self.message_count += 1
                 
             except Exception as e:
                 logger.error(f"发送回复失败: {str(e)}")
@@ -1001,12 +1070,13 @@ class InstagramBot:
             
             response = "Unsupported file type 😭"
             try:
-                self.client.direct_answer(thread_id, response)
+                self.send_message(thread_id, response)
                 logger.info(f"已回复不支持的文件类型提示 [对话ID: {thread_id}]")
                 # 记录AI回复
                 self.chat_history.add_message(thread_id, 'assistant', response)
                 self.processed_messages.add(message.id)
-                self.message_count += 1
+                with self.count_lock:
+                    self.message_count += 1
             except Exception as e:
                 logger.error(f"回复媒体消息失败: {str(e)}")
                 self.handle_exception(e)
@@ -1044,25 +1114,14 @@ class InstagramBot:
             
             has_new_message = False
             try:
-                # 检查未读消息
-                unread_threads = self.client.direct_threads(amount=20, selected_filter="unread")
-                if unread_threads:
-                    logger.info(f"发现 {len(unread_threads)} 个未读对话")
+                # 增量同步未读和待处理对话，只返回上次处理之后的新消息
+                updates = self.inbox.poll()
+                if updates:
+                    logger.info(f"发现 {len(updates)} 个有新消息的对话")
                     is_processing = True
-                    for thread in unread_threads:
-                        self.process_thread(thread)
-                    has_new_message = True
-                    last_message_time = time.time()  # 更新最后活动时间
-                    is_processing = False
-                    consecutive_errors = 0  # 重置错误计数
-                
-                # 检查待处理消息
-                pending_threads = self.client.direct_pending_inbox(20)
-                if pending_threads:
-                    logger.info(f"发现 {len(pending_threads)} 个待处理对话")
-                    is_processing = True
-                    for thread in pending_threads:
-                        self.process_thread(thread)
+                    for thread, new_messages in updates:
+                        self.workers.submit(str(thread.id), self.process_thread, thread, new_messages)
+                    self.workers.join()
                     has_new_message = True
                     last_message_time = time.time()  # 更新最后活动时间
                     is_processing = False
@@ -1222,10 +1281,15 @@ class InstagramBot:
                 
                 # 保存所有对话历史
                 self.chat_history.save_all_conversations()
+                self.router.log_summary()
+                self.humanizer.log_summary()
                 
                 # 随机延迟10-30秒
                 time.sleep(random.uniform(10, 30))
-                
+
+            # 退出前保存最后一轮的对话历史
+            self.chat_history.save_all_conversations()
+
         except Exception as e:
             logger.error(f"运行时出错: {str(e)}")
             self.handle_exception(e)
@@ -1295,47 +1359,39 @@ class InstagramBot:
             self.load_local_history()
 
     def load_local_history(self):
-        """加载本地历史对话文件"""
+        """检查本地历史对话归档
+
+        归档按需读取（见 ChatHistoryManager.load_conversation），这里只读取索引和最近的消息，
+        不再在启动时解析所有对话文件。
+        """
         try:
-            # 修改为相对路径
-            local_dir = "downloaded_artifacts 22-29-31-785/artifact_2510800793"
-            logger.info(f"开始从本地加载历史对话，目录: {local_dir}")
+            archive = self.chat_history.archive
+            logger.info(f"开始从本地加载历史对话，目录: {archive.base_dir}")
             
-            if os.path.exists(local_dir):
-                logger.info(f"找到本地历史对话目录: {local_dir}")
+            if os.path.exists(archive.base_dir):
+                logger.info(f"找到本地历史对话目录: {archive.base_dir}")
                 loaded_files = 0
-                for filename in os.listdir(local_dir):
-                    if filename.startswith("conversation_") and filename.endswith(".json"):
-                        try:
-                            filepath = os.path.join(local_dir, filename)
-                            logger.info(f"正在加载本地对话文件: {filename}")
-                            
-                            with open(filepath, 'r', encoding='utf-8') as f:
-                                conversation = json.load(f)
-                            
-                            # 从文件名中提取thread_id
-                            thread_id = filename.replace('conversation_', '').replace('.json', '')
-                            
-                            # 将对话加载到chat_history中
-                            self.chat_history.conversations[thread_id] = conversation
-                            loaded_files += 1
-                            
-                            logger.info(f"成功从本地加载对话历史 [对话ID: {thread_id}]")
-                            logger.info(f"- 消息数量: {len(conversation)}")
-                            logger.info("- 最近的消息:")
-                            # 显示最近的3条消息
-                            for i, msg in enumerate(conversation[-3:]):
-                                logger.info(f"  {i+1}. {msg.get('role')}: {msg.get('content')[:100]}...")
-                            
-                        except Exception as e:
-                            logger.error(f"加载本地对话文件失败 {filename}: {str(e)}")
+                for thread_id in archive.list_threads():
+                    try:
+                        count = archive.count(thread_id)
+                        loaded_files += 1
+                        
+                        logger.info(f"成功从本地加载对话历史 [对话ID: {thread_id}]")
+                        logger.info(f"- 消息数量: {count}")
+                        logger.info("- 最近的消息:")
+                        # 显示最近的3条消息
+                        for i, msg in enumerate(archive.tail(thread_id, 3)):
+                            logger.info(f"  {i+1}. {msg.get('role')}: {msg.get('content')[:100]}...")
+                        
+                    except Exception as e:
+                        logger.error(f"加载本地对话归档失败 [对话ID: {thread_id}]: {str(e)}")
                 
                 if loaded_files > 0:
-                    logger.info(f"共成功从本地加载 {loaded_files} 个对话文件")
+                    logger.info(f"共成功从本地加载 {loaded_files} 个对话")
                 else:
                     logger.warning("本地目录中没有找到有效的对话文件")
             else:
-                logger.warning(f"本地历史对话目录不存在: {local_dir}")
+                logger.warning(f"本地历史对话目录不存在: {archive.base_dir}")
         except Exception as e:
             logger.error(f"加载本地历史对话文件失败: {str(e)}")
 
@@ -1356,7 +1412,7 @@ class InstagramBot:
                         data = self.cipher_suite.decrypt(encrypted_data)
                         conversation = json.loads(data.decode('utf-8'))
                         
-                        self.chat_history.conversations[thread_id] = conversation
+                        self.chat_history.set_conversation(thread_id, conversation)
                         loaded_files += 1
                         logger.info(f"成功加载对话 [对话ID: {thread_id}] - {len(conversation)} 条消息")
                         
@@ -0,0 +1,611 @@
+import os
+import sys
+import json
+import time
+import atexit
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from chat_storage import create_storage, generate_push_id
+from chat_message import ChatMessage, compact_messages, expand_messages
+from local_archive import ConversationArchive
+
+logger = logging.getLogger(__name__)
+
+# 写回缓冲配置：消息先写入本地日志和内存队列，再由后台线程批量写入存储
+WRITE_BEHIND = os.getenv('CHAT_WRITE_BEHIND', 'true').lower() == 'true'
+FLUSH_INTERVAL = float(os.getenv('CHAT_FLUSH_INTERVAL', '2'))  # 定时刷新间隔（秒）
+FLUSH_MAX_PENDING = int(os.getenv('CHAT_FLUSH_MAX_PENDING', '20'))  # 待写入消息达到该数量时立即刷新
+WRITE_JOURNAL = os.getenv('CHAT_WRITE_JOURNAL', 'chat_write_journal.jsonl')  # 防止崩溃丢消息的日志文件，实际文件名带上入口脚本名
+
+# 对话读缓存配置
+CACHE_TTL = float(os.getenv('CHAT_CACHE_TTL', '60'))  # 缓存在该时间内直接使用，超时后做版本校验（秒）
+CACHE_MAX_THREADS = int(os.getenv('CHAT_CACHE_MAX_THREADS', '100'))  # 最多缓存的对话数
+CACHE_MAX_BYTES = int(os.getenv('CHAT_CACHE_MAX_BYTES', str(50 * 1024 * 1024)))  # 缓存总大小上限
+
+
+def default_journal_path():
+    """当前入口脚本的写回日志路径，如 chat_write_journal.bot.jsonl
+
+    bot.py、simple_bot.py 等入口各自使用一个日志文件，同时运行时不会重写掉对方的记录。
+    """
+    entry = os.path.splitext(os.path.basename(sys.argv[0] or ''))[0] or 'chat'
+    root, ext = os.path.splitext(WRITE_JOURNAL)
+    return f"{root}.{entry}{ext}"
+
+
+def _timestamp(message):
+    if isinstance(message, ChatMessage):
+        return message.iso_timestamp()
+    return message.get('timestamp', '')
+
+
+def _window(messages, last_n=None, since=None):
+    """截取 since 之后的最近 last_n 条消息（消息字典或紧凑记录均可）"""
+    if since is not None:
+        messages = [msg for msg in messages if _timestamp(msg) >= since]
+    if last_n is not None:
+        messages = messages[-last_n:] if last_n > 0 else []
+    return messages
+
+
+class CacheEntry:
+    def __init__(self, messages, version, size):
+        self.messages = messages
+        self.version = version  # 存储后端返回的版本（Firebase ETag 等），None 表示需要重新加载
+        self.size = size
+        self.checked_at = time.time()
+        self.local_writes = False  # 本进程追加过消息，缓存内容仍完整，但 version 已经落后于存储
+
+
+class ConversationCache:
+    """按对话缓存历史消息（紧凑记录列表），按对话数和内存字节数做 LRU 淘汰"""
+
+    def __init__(self, max_threads=CACHE_MAX_THREADS, max_bytes=CACHE_MAX_BYTES):
+        self.max_threads = max_threads
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, thread_id):
+        with self.lock:
+            entry = self.entries.get(thread_id)
+            if entry is not None:
+                self.entries.move_to_end(thread_id)
+            return entry
+
+    def put(self, thread_id, messages, version):
+        size = sum(msg.size() for msg in messages)
+        with self.lock:
+            self._remove(thread_id)
+            if size > self.max_bytes:
+                # 单个对话超过上限时不缓存
+                return
+            self.entries[thread_id] = CacheEntry(messages, version, size)
+            self.total_bytes += size
+            self._evict()
+
+    def record_append(self, thread_id, message, conversation):
+        """本进程写入新消息后同步更新缓存
+
+        Args:
+            conversation: 已经追加了该消息的内存对话列表；与缓存是同一个列表时不再重复追加
+        """
+        with self.lock:
+            entry = self.entries.get(thread_id)
+            if entry is None:
+                return
+            if entry.messages is not conversation:
+                entry.messages.append(message)
+            size = message.size()
+            entry.size += size
+            self.total_bytes += size
+            # 缓存仍然有效；超时后只需确认没有其他写入者（见 ChatHistoryManager._matches_storage）
+            entry.local_writes = True
+            self._evict()
+
+    def invalidate(self, thread_id):
+        with self.lock:
+            self._remove(thread_id)
+
+    def _remove(self, thread_id):
+        entry = self.entries.pop(thread_id, None)
+        if entry is not None:
+            self.total_bytes -= entry.size
+
+    def _evict(self):
+        while self.entries and (len(self.entries) > self.max_threads or self.total_bytes > self.max_bytes):
+            thread_id, entry = self.entries.popitem(last=False)
+            self.total_bytes -= entry.size
+            logger.debug(f"淘汰对话缓存 [对话ID: ****{thread_id[-4:]}]")
+
+
+class ChatHistoryManager:
+    def __init__(self, storage=None, backup_dir=None, write_behind=WRITE_BEHIND,
+                 flush_interval=FLUSH_INTERVAL, max_pending=FLUSH_MAX_PENDING,
+                 journal_path=None, cache_ttl=CACHE_TTL, memory_index=None):
+        """初始化聊天记录管理器
+
+        Args:
+            storage: 存储后端，默认根据 CHAT_STORAGE_BACKEND 环境变量创建
+            backup_dir: 本地归档目录（见 local_archive.ConversationArchive），为空时不保存本地备份
+            write_behind: 是否启用写回缓冲，关闭时每条消息同步写入存储
+            flush_interval: 定时刷新间隔（秒）
+            max_pending: 待写入消息达到该数量时立即刷新
+            journal_path: 写回日志文件路径，默认按入口脚本区分（见 default_journal_path）
+            cache_ttl: 读缓存免校验时间（秒），为 0 时每次读取都做版本校验
+            memory_index: 本地记忆检索索引（memory_index.MemoryIndex），新消息会同步写入
+        """
+        self.conversations = {}  # thread_id -> 紧凑消息记录列表（chat_message.ChatMessage）
+        self.backup_dir = backup_dir
+        self.archive = ConversationArchive(backup_dir) if backup_dir else None
+        self.archived = {}  # thread_id -> 本地归档中最后一条消息的时间戳
+        self.dirty = set()  # 上次 save_all_conversations 之后有新消息的对话
+        self.listeners = []  # 新消息回调 callback(thread_id, role, content, timestamp)
+        if memory_index:
+            self.add_listener(memory_index.add_message)
+        self.storage = storage
+        if self.storage is None:
+            try:
+                self.storage = create_storage()
+            except Exception as e:
+                logger.error(f"初始化聊天记录存储失败: {str(e)}")
+
+        # 读缓存
+        self.cache = ConversationCache()
+        self.cache_ttl = cache_ttl
+
+        # 写回缓冲
+        self.write_behind = write_behind
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.journal_path = journal_path or default_journal_path()
+        self.pending = {}  # thread_id -> [(key, message), ...]
+        self.pending_lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.flush_event = threading.Event()
+        self.closed = False
+        self.flush_thread = None
+
+        if self.write_behind:
+            self._replay_journal()
+            self.flush_thread = threading.Thread(target=self._flush_loop, name="chat-flush", daemon=True)
+            self.flush_thread.start()
+            atexit.register(self.close)
+
+    def history_version(self, thread_id):
+        """存储中对话的版本：截至最后一条回复的消息数（末尾尚未回复的用户消息不计入）
+
+        按存储中的完整对话计算（有读缓存和 ETag 校验，未变化时不重新下载），
+        不依赖本进程内存中已经加载的消息，每次运行的第一个问题也能得到正确的版本。
+
+        Returns:
+            int: 版本，读取失败时返回 None
+        """
+        try:
+            conversation = self.load_conversation(thread_id, strict=True)
+        except Exception:
+            return None
+        count = len(conversation)
+        while count and conversation[count - 1].get('role') == 'user':
+            count -= 1
+        return count
+
+    def add_listener(self, callback):
+        """注册新消息回调，用于增量维护检索索引、摘要等"""
+        self.listeners.append(callback)
+
+    def _notify(self, thread_id, message):
+        for callback in self.listeners:
+            try:
+                callback(thread_id, message['role'], message['content'], message['timestamp'])
+            except Exception as e:
+                logger.error(f"新消息回调失败: {str(e)}")
+
+    def set_conversation(self, thread_id, messages):
+        """用外部来源（如下载的备份）的消息字典列表替换内存中的对话"""
+        thread_id = str(thread_id)
+        self.conversations[thread_id] = compact_messages(messages)
+
+    def _archive_conversation(self, thread_id, conversation):
+        """把内存对话中比本地归档最后一条更新的消息追加到本地归档
+
+        按时间戳而不是条数判断，内存对话被完整历史替换（_load_full）后也不会重复归档。
+        """
+        last = self.archived.get(thread_id)
+        if last is None:
+            tail = self.archive.tail(thread_id, 1)
+            last = ChatMessage.from_dict(tail[-1]).iso_timestamp() if tail else ''
+        start = len(conversation)
+        while start and conversation[start - 1].iso_timestamp() > last:
+            start -= 1
+        new_messages = expand_messages(conversation[start:])
+        if new_messages:
+            self.archive.extend(thread_id, new_messages)
+            last = conversation[-1].iso_timestamp()
+        self.archived[thread_id] = last
+        return len(new_messages)
+
+    def _matches_storage(self, thread_id, cached):
+        """缓存中最后一条已写入的消息是否仍是存储中的最后一条（调用方需持有 flush_lock）
+
+        只读取存储中的最后一条消息，不下载整个对话。
+        """
+        pending = len(self._pending_messages(thread_id))
+        saved = cached.messages[:len(cached.messages) - pending]
+        stored = self.storage.tail(thread_id, 1)
+        if not saved or not stored:
+            return not saved and not stored
+        last = ChatMessage.from_dict(stored[-1])
+        return (last.iso_timestamp(), last.role, last.content) == \
+            (saved[-1].iso_timestamp(), saved[-1].role, saved[-1].content)
+
+    def _pending_count(self):
+        return sum(len(entries) for entries in self.pending.values())
+
+    def _pending_messages(self, thread_id):
+        with self.pending_lock:
+            return [message for _, message in self.pending.get(thread_id, [])]
+
+    def _write_journal(self, thread_id, key, message):
+        """把待写入的消息追加到本地日志，写入存储后再清理"""
+        with open(self.journal_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps({'thread_id': thread_id, 'key': key, 'message': message}, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _rewrite_journal(self):
+        """用当前仍未写入的消息重写日志（调用方需持有 pending_lock）"""
+        if not self._pending_count():
+            if os.path.exists(self.journal_path):
+                os.remove(self.journal_path)
+            return
+        tmp_path = self.journal_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for thread_id, entries in self.pending.items():
+                for key, message in entries:
+                    f.write(json.dumps({'thread_id': thread_id, 'key': key, 'message': message}, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.journal_path)
+
+    def _replay_journal(self):
+        """启动时重放上次未写入存储的消息"""
+        if not os.path.exists(self.journal_path):
+            return
+        replayed = 0
+        try:
+            with open(self.journal_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # 崩溃时最后一行可能只写了一半
+                        logger.warning("跳过损坏的写回日志记录")
+                        continue
+                    thread_id = str(entry['thread_id'])
+                    self.pending.setdefault(thread_id, []).append((entry['key'], entry['message']))
+                    self.dirty.add(thread_id)
+                    if thread_id not in self.conversations:
+                        self.conversations[thread_id] = []
+                    self.conversations[thread_id].append(ChatMessage.from_dict(entry['message']))
+                    replayed += 1
+        except Exception as e:
+            logger.error(f"读取写回日志失败: {str(e)}")
+            return
+        if replayed:
+            logger.info(f"从写回日志恢复 {replayed} 条未保存的消息")
+            self.flush()
+
+    def _flush_loop(self):
+        """后台刷新线程：定时或待写入消息过多时批量写入"""
+        while not self.closed:
+            self.flush_event.wait(self.flush_interval)
+            self.flush_event.clear()
+            if self.closed:
+                break
+            self.flush()
+
+    def flush(self):
+        """把所有待写入的消息通过一次批量写入保存到存储
+
+        Returns:
+            bool: 是否全部写入成功
+        """
+        with self.flush_lock:
+            with self.pending_lock:
+                batch = [(thread_id, key, message)
+                         for thread_id, entries in self.pending.items()
+                         for key, message in entries]
+            if not batch:
+                return True
+
+            start_time = time.time()
+            try:
+                self.storage.append_batch(batch)
+            except Exception as e:
+                # 消息仍保留在队列和日志中，下次刷新时重试
+                logger.error(f"批量保存消息失败，稍后重试: {str(e)}")
+                return False
+
+            written = {key for _, key, _ in batch}
+            with self.pending_lock:
+                for thread_id in list(self.pending):
+                    entries = [entry for entry in self.pending[thread_id] if entry[0] not in written]
+                    if entries:
+                        self.pending[thread_id] = entries
+                    else:
+                        del self.pending[thread_id]
+                try:
+                    self._rewrite_journal()
+                except Exception as e:
+                    logger.error(f"更新写回日志失败: {str(e)}")
+
+            threads = len({thread_id for thread_id, _, _ in batch})
+            logger.info(f"批量保存 {len(batch)} 条消息到 {self.storage.name} "
+                        f"[{threads} 个对话] - 耗时 {time.time() - start_time:.3f} 秒")
+            return True
+
+    def close(self):
+        """停止后台刷新线程并写入剩余消息"""
+        if self.closed:
+            return
+        self.closed = True
+        self.flush_event.set()
+        if self.flush_thread and self.flush_thread is not threading.current_thread():
+            self.flush_thread.join(timeout=self.flush_interval + 1)
+        if self.write_behind:
+            self.flush()
+
+    def save_conversation(self, thread_id):
+        """保存对话到存储后端"""
+        thread_id = str(thread_id)
+        if thread_id not in self.conversations:
+            return
+
+        conversation = self.conversations[thread_id]
+        if not conversation:
+            return
+
+        try:
+            # 先写入待保存的消息，避免整体覆盖后再次追加造成重复
+            if self.write_behind:
+                self.flush()
+
+            logger.info(f"保存对话到 {self.storage.name} [对话ID: {thread_id}]")
+            self.storage.save(thread_id, expand_messages(conversation))
+            self.cache.put(thread_id, conversation, None)
+            logger.info("保存成功")
+
+            # 同时追加本地备份，只写入新增的消息
+            if self.archive:
+                appended = self._archive_conversation(thread_id, conversation)
+                logger.info(f"追加本地备份 [对话ID: {thread_id}] - {appended} 条消息")
+
+        except Exception as e:
+            logger.error(f"保存对话失败 [对话ID: {thread_id}]: {str(e)}")
+
+    def save_all_conversations(self):
+        """保存所有有新消息的对话
+
+        待写入存储的消息通过一次批量写入（Firebase 多路径 update）保存，
+        然后一次性把这些对话的新消息追加到本地归档。
+
+        Returns:
+            bool: 是否全部保存成功
+        """
+        with self.pending_lock:
+            dirty = self.dirty
+            self.dirty = set()
+        if not dirty:
+            return True
+
+        start_time = time.time()
+        success = True
+        if self.write_behind and not self.flush():
+            success = False
+        storage_time = time.time() - start_time
+
+        archive_start = time.time()
+        failed = set()
+        appended = 0
+        if self.archive:
+            for thread_id in dirty:
+                conversation = self.conversations.get(thread_id)
+                if not conversation:
+                    continue
+                try:
+                    appended += self._archive_conversation(thread_id, conversation)
+                except Exception as e:
+                    logger.error(f"追加本地备份失败 [对话ID: ****{thread_id[-4:]}]: {str(e)}")
+                    failed.add(thread_id)
+        archive_time = time.time() - archive_start
+
+        if not success:
+            failed = dirty
+        if failed:
+            # 下次保存时重试
+            with self.pending_lock:
+                self.dirty |= failed
+
+        logger.info(f"保存 {len(dirty)} 个有更新的对话 - 写入存储耗时 {storage_time:.3f} 秒，"
+                    f"本地备份 {appended} 条消息耗时 {archive_time:.3f} 秒")
+        return success and not failed
+
+    def load_conversation(self, thread_id, last_n=None, since=None, strict=False):
+        """从存储后端加载对话（包含尚未写入存储的消息），优先使用读缓存
+
+        Args:
+            thread_id: 对话 ID
+            last_n: 只加载最近的 n 条消息
+            since: 只加载该时间（datetime 或 ISO 格式字符串）之后的消息
+            strict: 加载完整对话失败时抛出异常，用于不能把读取失败当成空对话的场景（如建立索引）
+        """
+        thread_id = str(thread_id)
+        if last_n is None and since is None:
+            return self._load_full(thread_id, strict)
+
+        if isinstance(since, datetime):
+            since = since.isoformat()
+
+        try:
+            cached = self.cache.get(thread_id)
+            if cached is not None and time.time() - cached.checked_at < self.cache_ttl:
+                self.cache.hits += 1
+                return expand_messages(_window(cached.messages, last_n, since))
+
+            # 只查询需要的窗口：按时间范围或 limitToLast
+            with self.flush_lock:
+                if since is not None:
+                    stored = self.storage.range_by_time(thread_id, start=since)
+                else:
+                    stored = self.storage.tail(thread_id, last_n)
+                conversation = _window(stored + self._pending_messages(thread_id), last_n, since)
+
+            if conversation:
+                logger.info(f"从 {self.storage.name} 加载对话窗口 [对话ID: {thread_id}] - {len(conversation)} 条消息")
+                return conversation
+
+            # 存储中没有数据时走完整加载流程（包含本地归档）
+            return _window(self._load_full(thread_id), last_n, since)
+
+        except Exception as e:
+            logger.error(f"加载对话窗口失败: {str(e)}")
+            return []
+
+    def _load_full(self, thread_id, strict=False):
+        """加载完整对话，strict 为 True 时读取失败直接抛出异常，而不是返回空列表"""
+        try:
+            cached = self.cache.get(thread_id)
+            if cached is not None and time.time() - cached.checked_at < self.cache_ttl:
+                self.cache.hits += 1
+                logger.info(f"命中对话缓存 [对话ID: {thread_id}] - {len(cached.messages)} 条消息")
+                return expand_messages(cached.messages)
+
+            logger.info(f"尝试从 {self.storage.name} 加载对话 [对话ID: {thread_id}]")
+            # 刷新过程中消息可能同时存在于存储和队列中，等待刷新完成再读取
+            with self.flush_lock:
+                if cached is not None and cached.local_writes:
+                    if self._matches_storage(thread_id, cached):
+                        cached.checked_at = time.time()
+                        self.cache.hits += 1
+                        logger.info(f"对话只有本进程写入，使用缓存 [对话ID: {thread_id}] - {len(cached.messages)} 条消息")
+                        return expand_messages(cached.messages)
+                    # 有其他写入者，缓存的 version 已经无效，直接完整下载
+                    cached = None
+                changed, stored, version = self.storage.load_if_changed(
+                    thread_id, cached.version if cached is not None else None
+                )
+                if not changed:
+                    cached.checked_at = time.time()
+                    self.cache.hits += 1
+                    logger.info(f"对话未变化，使用缓存 [对话ID: {thread_id}] - {len(cached.messages)} 条消息")
+                    return expand_messages(cached.messages)
+                conversation = stored + self._pending_messages(thread_id)
+            self.cache.misses += 1
+
+            if conversation:
+                logger.info(f"成功从 {self.storage.name} 加载对话 - {len(conversation)} 条消息")
+                records = compact_messages(conversation)
+                self.conversations[thread_id] = records
+                self.cache.put(thread_id, records, version)
+                return conversation
+
+            # 如果存储中没有数据，尝试从本地归档加载
+            if self.archive and self.archive.exists(thread_id):
+                logger.info(f"{self.storage.name} 中未找到数据，尝试从本地加载")
+                conversation = self.archive.load(thread_id)
+                logger.info(f"成功从本地加载对话 - {len(conversation)} 条消息")
+                # 同步到存储后端
+                self.storage.save(thread_id, conversation)
+                logger.info(f"已同步本地数据到 {self.storage.name}")
+                records = compact_messages(conversation)
+                self.conversations[thread_id] = records
+                if records:
+                    self.archived[thread_id] = records[-1].iso_timestamp()
+                self.cache.put(thread_id, records, None)
+                return conversation
+
+            logger.info("未找到对话历史")
+            return []
+
+        except Exception as e:
+            logger.error(f"加载对话失败: {str(e)}")
+            if strict:
+                raise
+            return []
+
+    def watch(self, thread_id, callback):
+        """对话有新写入时调用 callback()，返回带 close() 方法的监听句柄"""
+        return self.storage.watch(str(thread_id), callback)
+
+    def add_message(self, thread_id, role, content, metadata=None):
+        """添加新消息到对话历史"""
+        # 如果内容为空或者全是 ***，则不保存
+        if not content or content.strip() == "***":
+            return
+
+        thread_id = str(thread_id)
+        masked_thread_id = f"****{thread_id[-4:]}"
+
+        if thread_id not in self.conversations:
+            self.conversations[thread_id] = []
+
+        # 构建消息
+        message = {
+            'timestamp': datetime.now().isoformat(),
+            'role': role,
+            'content': content
+        }
+        if metadata:
+            message['metadata'] = metadata
+
+        if self.write_behind and not self.closed:
+            # 写入本地日志后放入队列，由后台线程批量写入存储
+            key = generate_push_id()
+            try:
+                with self.pending_lock:
+                    self._write_journal(thread_id, key, message)
+                    self.pending.setdefault(thread_id, []).append((key, message))
+                    self.dirty.add(thread_id)
+                    pending_count = self._pending_count()
+            except Exception as e:
+                logger.error(f"写入写回日志失败: {str(e)}")
+                return
+            record = ChatMessage.from_dict(message)
+            self.conversations[thread_id].append(record)
+            self.cache.record_append(thread_id, record, self.conversations[thread_id])
+            self._notify(thread_id, message)
+            if pending_count >= self.max_pending:
+                self.flush_event.set()
+            logger.info(f"添加新消息 [对话ID: {masked_thread_id}] - {role}: ***")
+            return
+
+        # 先添加到内存中的对话列表
+        record = ChatMessage.from_dict(message)
+        self.conversations[thread_id].append(record)
+
+        # 以追加方式保存，不再读取和重写整个对话历史
+        try:
+            self.storage.append(thread_id, message)
+            self.cache.record_append(thread_id, record, self.conversations[thread_id])
+            with self.pending_lock:
+                self.dirty.add(thread_id)
+            self._notify(thread_id, message)
+            logger.info(f"已保存消息到 {self.storage.name} [对话ID: {masked_thread_id}]")
+        except Exception as e:
+            logger.error(f"保存消息失败: {str(e)}")
+            # 如果保存失败，从内存中移除消息
+            if thread_id in self.conversations:
+                self.conversations[thread_id].pop()
+            return
+
+        # 最后记录日志
+        logger.info(f"添加新消息 [对话ID: {masked_thread_id}] - {role}: ***")
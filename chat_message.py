@@ -0,0 +1,96 @@
+import sys
+from datetime import datetime, timedelta
+
+EPOCH = datetime(1970, 1, 1)
+
+# 不放进 extra 的元数据键：对话 ID 已经是存储路径，时间与消息时间重复，message_id 单独存放
+REDUNDANT_METADATA = ('thread_id', 'timestamp', 'message_id')
+
+
+def parse_timestamp(value):
+    """ISO 时间字符串转为微秒整数
+
+    只转换能原样还原的格式（datetime.isoformat() 生成的本地时间），
+    带时区或其他格式的字符串保持不变。
+    """
+    if not isinstance(value, str):
+        return value
+    try:
+        dt = datetime.fromisoformat(value)
+    except ValueError:
+        return value
+    if dt.tzinfo is not None:
+        return value
+    delta = dt - EPOCH
+    micros = (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+    return micros if format_timestamp(micros) == value else value
+
+
+def format_timestamp(value):
+    """微秒整数还原为 ISO 时间字符串"""
+    if isinstance(value, int):
+        return (EPOCH + timedelta(microseconds=value)).isoformat()
+    return value
+
+
+class ChatMessage:
+    """内存中的紧凑消息记录
+
+    和存储中的消息字典相比：时间戳存为整数，角色字符串驻留（所有消息共用同一个对象），
+    去掉元数据中重复的 thread_id 和 timestamp，并且不为每条消息创建字典。
+    需要字典格式（LLM 提示词、写入存储）时用 to_dict() 转换。
+    """
+    __slots__ = ('timestamp', 'role', 'content', 'message_id', 'extra')
+
+    def __init__(self, timestamp, role, content, message_id=None, extra=None):
+        self.timestamp = timestamp
+        self.role = role
+        self.content = content
+        self.message_id = message_id
+        self.extra = extra
+
+    @classmethod
+    def from_dict(cls, message):
+        metadata = message.get('metadata')
+        message_id = None
+        extra = None
+        if isinstance(metadata, dict):
+            message_id = metadata.get('message_id')
+            extra = {k: v for k, v in metadata.items() if k not in REDUNDANT_METADATA} or None
+        return cls(
+            parse_timestamp(message.get('timestamp', '')),
+            sys.intern(str(message.get('role', ''))),
+            message.get('content', ''),
+            message_id,
+            extra
+        )
+
+    def iso_timestamp(self):
+        return format_timestamp(self.timestamp)
+
+    def to_dict(self):
+        message = {
+            'timestamp': self.iso_timestamp(),
+            'role': self.role,
+            'content': self.content
+        }
+        if self.message_id is not None or self.extra:
+            metadata = dict(self.extra) if self.extra else {}
+            if self.message_id is not None:
+                metadata['message_id'] = self.message_id
+            message['metadata'] = metadata
+        return message
+
+    def size(self):
+        """占用的内存字节数（用于缓存容量控制）"""
+        return sys.getsizeof(self) + sys.getsizeof(self.content)
+
+
+def compact_messages(messages):
+    """消息字典列表转为紧凑记录列表"""
+    return [msg if isinstance(msg, ChatMessage) else ChatMessage.from_dict(msg) for msg in messages]
+
+
+def expand_messages(records):
+    """紧凑记录列表转回消息字典列表"""
+    return [record.to_dict() for record in records]
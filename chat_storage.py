@@ -0,0 +1,667 @@
+import os
+import re
+import json
+import base64
+import time
+import random
+import logging
+import sqlite3
+import threading
+from datetime import datetime
+import firebase_admin
+from firebase_admin import credentials
+from firebase_admin import db
+
+logger = logging.getLogger(__name__)
+
+
+# 按月分区的键，例如 2024-01
+MONTH_KEY = re.compile(r'^\d{4}-\d{2}$')
+
+# 不支持推送通知的后端检查新消息的间隔（秒），每次只查询最后一条消息
+WATCH_POLL_INTERVAL = float(os.getenv('CHAT_WATCH_POLL_INTERVAL', '1'))
+
+
+def is_message(node):
+    """判断 Firebase 节点是单条消息还是消息分组"""
+    return isinstance(node, dict) and 'role' in node and 'content' in node
+
+
+def normalize_conversation(data):
+    """把 Firebase 中的对话节点统一转换成按顺序排列的消息列表
+
+    兼容以下存储形态：
+    - 旧格式：整个列表用 set() 写入，Firebase 返回 list（或数字键的 dict）
+    - 追加格式：通过 push() 逐条写入，键是按时间递增的 push ID
+    - 按月分区：{yyyy-mm: {push ID: 消息}}（见 MonthlyFirebaseStorage）
+    - 其他分组节点：{节点ID: {消息ID: 消息}}，展开其中的消息
+
+    不是消息也不包含消息的节点会被忽略。
+    """
+    if not data:
+        return []
+
+    if isinstance(data, list):
+        # 列表中可能有空洞（被删除的下标），直接跳过
+        messages = []
+        for msg in data:
+            if is_message(msg):
+                messages.append(msg)
+            elif isinstance(msg, dict):
+                messages.extend(normalize_conversation(msg))
+        return messages
+
+    if isinstance(data, dict):
+        legacy = []
+        pushed = []
+        groups = []
+        for key, msg in data.items():
+            if not isinstance(msg, dict):
+                continue
+            key = str(key)
+            if not is_message(msg):
+                groups.append((key, msg))
+            elif key.isdigit():
+                legacy.append((int(key), msg))
+            else:
+                pushed.append((key, msg))
+        # 旧格式的消息一定早于追加写入的消息；push ID 按字典序即为时间顺序
+        legacy.sort(key=lambda item: item[0])
+        pushed.sort(key=lambda item: item[0])
+        messages = [msg for _, msg in legacy] + [msg for _, msg in pushed]
+        if not groups:
+            return messages
+
+        groups.sort(key=lambda item: item[0])
+        for _, group in groups:
+            messages.extend(normalize_conversation(group))
+        # 迁移未完成时分组内的消息和旧消息可能交错，按时间重新排序（排序是稳定的）
+        messages.sort(key=lambda msg: msg.get('timestamp', ''))
+        return messages
+
+    logger.warning(f"无法识别的对话数据类型: {type(data).__name__}")
+    return []
+
+
+def filter_by_time(messages, start=None, end=None):
+    """在本地按时间段筛选消息（ISO 格式字符串比较）"""
+    return [
+        msg for msg in messages
+        if (not start or msg.get('timestamp', '') >= start)
+        and (not end or msg.get('timestamp', '') <= end)
+    ]
+
+
+# Firebase push ID 使用的字符表（按 ASCII 排序，保证键的字典序即时间顺序）
+PUSH_CHARS = '-0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ_abcdefghijklmnopqrstuvwxyz'
+_push_lock = threading.Lock()
+_last_push_time = 0
+_last_rand_chars = []
+
+
+def generate_push_id():
+    """在本地生成与 Firebase push() 格式相同的键
+
+    前 8 位是毫秒时间戳，后 12 位随机；同一毫秒内生成多个键时递增随机部分，
+    保证键严格递增。这样可以把多条消息放进一次 update() 里写入。
+    """
+    global _last_push_time, _last_rand_chars
+    with _push_lock:
+        now = int(time.time() * 1000)
+        duplicate = now == _last_push_time
+        _last_push_time = now
+
+        time_chars = []
+        for _ in range(8):
+            time_chars.append(PUSH_CHARS[now % 64])
+            now //= 64
+
+        if not duplicate:
+            _last_rand_chars = [random.randrange(64) for _ in range(12)]
+        else:
+            i = 11
+            while i >= 0 and _last_rand_chars[i] == 63:
+                _last_rand_chars[i] = 0
+                i -= 1
+            if i >= 0:
+                _last_rand_chars[i] += 1
+
+        return ''.join(reversed(time_chars)) + ''.join(PUSH_CHARS[c] for c in _last_rand_chars)
+
+
+def init_firebase():
+    """初始化 Firebase 连接，已初始化时直接返回
+
+    Returns:
+        bool: Firebase 是否可用
+    """
+    try:
+        firebase_admin.get_app()
+        return True
+    except ValueError:
+        pass
+
+    # 从环境变量获取 Firebase 配置
+    firebase_cred_base64 = os.getenv('FIREBASE_CREDENTIALS_BASE64')
+    firebase_url = os.getenv('FIREBASE_DATABASE_URL')
+
+    if not firebase_cred_base64 or not firebase_url:
+        logger.error("Firebase 配置未找到")
+        return False
+
+    # 解码 base64 凭证
+    try:
+        cred_json = base64.b64decode(firebase_cred_base64).decode('utf-8')
+        cred_dict = json.loads(cred_json)
+        logger.info("Firebase 凭证解码成功")
+    except Exception as e:
+        logger.error(f"Firebase 凭证解码失败: {str(e)}")
+        return False
+
+    logger.info("初始化 Firebase 连接...")
+    cred = credentials.Certificate(cred_dict)
+    firebase_admin.initialize_app(cred, {
+        'databaseURL': firebase_url
+    })
+    logger.info("Firebase 连接成功")
+    return True
+
+
+class ChatStorage:
+    """聊天记录存储接口
+
+    消息统一使用 {'timestamp', 'role', 'content', 'metadata'} 的字典格式，
+    timestamp 为 ISO 格式字符串。
+    """
+    name = "storage"
+
+    def load(self, thread_id):
+        """加载整个对话，返回按时间排序的消息列表"""
+        raise NotImplementedError
+
+    def load_if_changed(self, thread_id, version=None):
+        """版本未变化时不重新下载对话
+
+        Returns:
+            (changed, messages, version)：未变化时 messages 为 None；
+            不支持版本检查的后端每次都返回 changed=True
+        """
+        return True, self.load(thread_id), None
+
+    def append(self, thread_id, message):
+        """追加一条消息"""
+        raise NotImplementedError
+
+    def append_batch(self, entries):
+        """批量追加消息
+
+        Args:
+            entries: [(thread_id, key, message), ...]，key 由 generate_push_id() 生成，
+                重复写入同一个 key 不会产生重复消息
+        """
+        for thread_id, key, message in entries:
+            self.append(thread_id, message)
+
+    def save(self, thread_id, messages):
+        """用给定的消息列表整体覆盖对话"""
+        raise NotImplementedError
+
+    def tail(self, thread_id, n):
+        """获取对话中最近的 n 条消息"""
+        raise NotImplementedError
+
+    def range_by_time(self, thread_id, start=None, end=None):
+        """获取时间在 [start, end] 内的消息，start/end 为 ISO 格式字符串"""
+        raise NotImplementedError
+
+    def list_threads(self):
+        """列出所有对话 ID"""
+        raise NotImplementedError
+
+    def load_state(self, name):
+        """读取机器人的运行状态（对话摘要、收件箱同步进度等 JSON 数据）
+
+        运行环境的本地磁盘可能是临时的（如 GitHub Actions），需要跨运行保留的状态保存在存储后端。
+
+        Args:
+            name: 状态名称，可以用 / 分层，如 summaries/{thread_id}；
+                读取上层名称时返回下层各项组成的 dict，如 inbox_sync -> {thread_id: ...}
+
+        Returns:
+            保存的数据，不存在时返回 None
+        """
+        raise NotImplementedError
+
+    def save_state(self, name, data):
+        """整体覆盖保存运行状态"""
+        raise NotImplementedError
+
+    def watch(self, thread_id, callback):
+        """对话有新写入时调用 callback()（在后台线程中）
+
+        默认实现在后台线程中定时查询最后一条消息，适用于 SQLite 等本地后端，
+        也可以在本地代替 Firebase 推送做测试。
+
+        Returns:
+            带 close() 方法的监听句柄
+        """
+        return PollingWatcher(self, thread_id, callback)
+
+
+class PollingWatcher:
+    """定时查询最后一条消息，变化时通知"""
+
+    def __init__(self, storage, thread_id, callback, interval=WATCH_POLL_INTERVAL):
+        self.storage = storage
+        self.thread_id = str(thread_id)
+        self.callback = callback
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="chat-watch", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        last = None
+        first = True
+        while not self.stopped.is_set():
+            try:
+                latest = self.storage.tail(self.thread_id, 1)
+                latest = latest[-1] if latest else None
+                if first or latest != last:
+                    last = latest
+                    self.callback()
+                first = False
+            except Exception as e:
+                logger.error(f"检查对话更新失败: {str(e)}")
+            self.stopped.wait(self.interval)
+
+    def close(self):
+        self.stopped.set()
+
+
+class FirebaseStorage(ChatStorage):
+    """基于 Firebase Realtime Database 的存储"""
+    name = "Firebase"
+
+    def __init__(self, root='chat_histories', state_root='bot_state', updates_root='chat_updates'):
+        if not init_firebase():
+            raise ValueError("Firebase 不可用")
+        self.root = root
+        self.ref = db.reference(root)
+        self.state_ref = db.reference(state_root)
+        # 每个对话一个更新标记（最后写入的消息键），watch() 只监听它，不监听整个对话
+        self.updates_ref = db.reference(updates_root)
+        self.updates_root = updates_root
+        self.db_root = db.reference('/')
+
+    def load(self, thread_id):
+        return normalize_conversation(self.ref.child(str(thread_id)).get())
+
+    def load_if_changed(self, thread_id, version=None):
+        # 使用 ETag 校验，未变化时服务器只返回 304，不传输对话内容
+        ref = self.ref.child(str(thread_id))
+        if version:
+            changed, data, etag = ref.get_if_changed(version)
+            if not changed:
+                return False, None, version
+        else:
+            data, etag = ref.get(etag=True)
+        return True, normalize_conversation(data), etag
+
+    def _message_path(self, thread_id, key, message):
+        return f"{self.root}/{thread_id}/{key}"
+
+    def append(self, thread_id, message):
+        # 只写入新节点，不读取已有历史，耗时与对话长度无关；键在本地生成，和 push() 格式相同
+        key = generate_push_id()
+        self.append_batch([(thread_id, key, message)])
+        return key
+
+    def append_batch(self, entries):
+        # 一次多路径 update() 写入所有对话的新消息，同时更新每个对话的更新标记
+        updates = {}
+        for thread_id, key, message in entries:
+            updates[self._message_path(thread_id, key, message)] = message
+            updates[f"{self.updates_root}/{thread_id}"] = key
+        if updates:
+            self.db_root.update(updates)
+
+    def _touch(self, thread_id):
+        self.updates_ref.child(str(thread_id)).set(generate_push_id())
+
+    def save(self, thread_id, messages):
+        self.ref.child(str(thread_id)).set(messages)
+        self._touch(thread_id)
+
+    def tail(self, thread_id, n):
+        # 数字键按数值排在 push ID 之前，order_by_key 同时适用于新旧两种格式
+        data = self.ref.child(str(thread_id)).order_by_key().limit_to_last(n).get()
+        return normalize_conversation(data)
+
+    @staticmethod
+    def _has_groups(ref):
+        """节点下是否有不带 timestamp 的子节点（分组数据等）
+
+        按 timestamp 排序时没有该字段的子节点排在最前面，只需要取第一个子节点判断。
+        """
+        first = ref.order_by_child('timestamp').limit_to_first(1).get()
+        children = first.values() if isinstance(first, dict) else (first or [])
+        return any(child is not None and not is_message(child) for child in children)
+
+    def _query_by_time(self, ref, start=None, end=None, check_layout=True):
+        """按 timestamp 查询节点下的消息
+
+        需要在数据库规则中为 timestamp 建立 .indexOn 索引（见 README）。
+        节点中有分组数据（{节点ID: {消息ID: 消息}}）时分组没有 timestamp，查询不到其中的消息；
+        这种情况和查询失败时都退回到读取整个节点后在本地筛选。
+        """
+        query = ref.order_by_child('timestamp')
+        if start:
+            query = query.start_at(start)
+        if end:
+            query = query.end_at(end)
+        try:
+            if check_layout and self._has_groups(ref):
+                logger.info("节点中有分组数据，读取整个节点后按时间筛选")
+                return filter_by_time(normalize_conversation(ref.get()), start, end)
+            return normalize_conversation(query.get())
+        except Exception as e:
+            logger.warning(f"按时间查询失败，改为读取整个节点后筛选（请检查 timestamp 的 .indexOn 规则）: {str(e)}")
+            return filter_by_time(normalize_conversation(ref.get()), start, end)
+
+    def range_by_time(self, thread_id, start=None, end=None):
+        messages = self._query_by_time(self.ref.child(str(thread_id)), start, end)
+        messages.sort(key=lambda msg: msg.get('timestamp', ''))
+        return messages
+
+    def list_threads(self):
+        data = self.ref.get(shallow=True)
+        return list(data.keys()) if isinstance(data, dict) else []
+
+    def load_state(self, name):
+        # 注意 Firebase 不保存空的 dict/list，读取方需要自行补上默认值
+        return self.state_ref.child(name).get()
+
+    def save_state(self, name, data):
+        self.state_ref.child(name).set(data)
+
+    def watch(self, thread_id, callback):
+        # 流式监听对话的更新标记：建立连接和断线重连时只同步这一个值，而不是整个对话；空闲时没有请求
+        return self.updates_ref.child(str(thread_id)).listen(lambda event: callback())
+
+
+def build_partitions(messages):
+    """把消息列表按月分组为 {yyyy-mm: {push ID: 消息}}，分区内保持原有顺序"""
+    partitions = {}
+    for message in messages:
+        partitions.setdefault(MonthlyFirebaseStorage.partition_of(message), {})[generate_push_id()] = message
+    return partitions
+
+
+class MonthlyFirebaseStorage(FirebaseStorage):
+    """按月分区的 Firebase 存储：chat_histories/{thread_id}/{yyyy-mm}/{push ID}
+
+    读取最近消息或某个时间段时只访问相关月份的分区，不再下载整个对话。
+    旧格式的对话需要先用 migrate_chat_histories.py 迁移，未迁移前读取会退回到整体下载。
+    """
+    name = "Firebase(按月分区)"
+
+    @staticmethod
+    def partition_of(message):
+        month = message.get('timestamp', '')[:7]
+        return month if MONTH_KEY.match(month) else datetime.now().strftime('%Y-%m')
+
+    def partitions(self, thread_id):
+        """列出对话的月份分区（shallow 查询只下载键）
+
+        Returns:
+            (分区列表, 是否还有未迁移的旧格式数据)
+        """
+        data = self.ref.child(str(thread_id)).get(shallow=True)
+        if not isinstance(data, dict):
+            return [], False
+        months = sorted(key for key in data if MONTH_KEY.match(str(key)))
+        return months, len(months) != len(data)
+
+    def _message_path(self, thread_id, key, message):
+        return f"{self.root}/{thread_id}/{self.partition_of(message)}/{key}"
+
+    def save(self, thread_id, messages):
+        self.ref.child(str(thread_id)).set(build_partitions(messages))
+        self._touch(thread_id)
+
+    def tail(self, thread_id, n):
+        months, has_legacy = self.partitions(thread_id)
+        if has_legacy:
+            logger.warning(f"对话尚未迁移为按月分区，读取整个对话 [对话ID: {thread_id}]")
+            return self.load(thread_id)[-n:]
+
+        # 从最新的月份往前读，够 n 条就停止
+        chunks = []
+        total = 0
+        for month in reversed(months):
+            if total >= n:
+                break
+            data = self.ref.child(str(thread_id)).child(month).order_by_key().limit_to_last(n - total).get()
+            chunk = normalize_conversation(data)
+            chunks.append(chunk)
+            total += len(chunk)
+        return [msg for chunk in reversed(chunks) for msg in chunk][-n:]
+
+    def range_by_time(self, thread_id, start=None, end=None):
+        months, has_legacy = self.partitions(thread_id)
+        if has_legacy:
+            logger.warning(f"对话尚未迁移为按月分区，读取整个对话 [对话ID: {thread_id}]")
+            return filter_by_time(self.load(thread_id), start, end)
+
+        messages = []
+        for month in months:
+            if (start and month < start[:7]) or (end and month > end[:7]):
+                continue
+            # partitions() 已经确认没有旧格式数据，月份分区下只有消息
+            messages.extend(self._query_by_time(
+                self.ref.child(str(thread_id)).child(month), start, end, check_layout=False
+            ))
+        messages.sort(key=lambda msg: msg.get('timestamp', ''))
+        return messages
+
+
+class SQLiteStorage(ChatStorage):
+    """基于本地 SQLite（WAL 模式）的存储，按 (thread_id, timestamp) 建立索引"""
+    name = "SQLite"
+
+    def __init__(self, path='chat_history.db'):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.executescript("""
+                CREATE TABLE IF NOT EXISTS messages (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    thread_id TEXT NOT NULL,
+                    timestamp TEXT NOT NULL,
+                    role TEXT NOT NULL,
+                    content TEXT NOT NULL,
+                    metadata TEXT,
+                    message_key TEXT UNIQUE
+                );
+                CREATE INDEX IF NOT EXISTS idx_messages_thread_time
+                    ON messages (thread_id, timestamp);
+                CREATE TABLE IF NOT EXISTS bot_state (
+                    name TEXT PRIMARY KEY,
+                    data TEXT NOT NULL
+                );
+            """)
+            self.conn.commit()
+        logger.info(f"SQLite 存储已就绪: {path}")
+
+    @staticmethod
+    def _to_row(thread_id, message, key=None):
+        metadata = message.get('metadata')
+        return (
+            str(thread_id),
+            message.get('timestamp', ''),
+            message.get('role', ''),
+            message.get('content', ''),
+            json.dumps(metadata, ensure_ascii=False) if metadata else None,
+            key
+        )
+
+    @staticmethod
+    def _to_message(row):
+        timestamp, role, content, metadata = row
+        message = {
+            'timestamp': timestamp,
+            'role': role,
+            'content': content
+        }
+        if metadata:
+            message['metadata'] = json.loads(metadata)
+        return message
+
+    def _query(self, sql, params):
+        with self.lock:
+            rows = self.conn.execute(sql, params).fetchall()
+        return [self._to_message(row) for row in rows]
+
+    def load(self, thread_id):
+        return self._query(
+            "SELECT timestamp, role, content, metadata FROM messages "
+            "WHERE thread_id = ? ORDER BY timestamp, id",
+            (str(thread_id),)
+        )
+
+    def _version(self, thread_id):
+        with self.lock:
+            count, max_id = self.conn.execute(
+                "SELECT COUNT(*), MAX(id) FROM messages WHERE thread_id = ?",
+                (str(thread_id),)
+            ).fetchone()
+        return f"{count}:{max_id}"
+
+    def load_if_changed(self, thread_id, version=None):
+        # 消息数和最大自增 ID 都没变，说明对话没有被修改
+        current = self._version(thread_id)
+        if version == current:
+            return False, None, version
+        return True, self.load(thread_id), current
+
+    def append(self, thread_id, message):
+        with self.lock:
+            cursor = self.conn.execute(
+                "INSERT INTO messages (thread_id, timestamp, role, content, metadata, message_key) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                self._to_row(thread_id, message)
+            )
+            self.conn.commit()
+        return cursor.lastrowid
+
+    def append_batch(self, entries):
+        rows = [self._to_row(thread_id, message, key) for thread_id, key, message in entries]
+        with self.lock:
+            with self.conn:
+                # 日志重放时同一个 key 可能再次写入，直接忽略
+                self.conn.executemany(
+                    "INSERT OR IGNORE INTO messages "
+                    "(thread_id, timestamp, role, content, metadata, message_key) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    rows
+                )
+
+    def save(self, thread_id, messages):
+        rows = [self._to_row(thread_id, msg) for msg in messages]
+        with self.lock:
+            with self.conn:
+                self.conn.execute("DELETE FROM messages WHERE thread_id = ?", (str(thread_id),))
+                self.conn.executemany(
+                    "INSERT INTO messages (thread_id, timestamp, role, content, metadata, message_key) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    rows
+                )
+
+    def tail(self, thread_id, n):
+        messages = self._query(
+            "SELECT timestamp, role, content, metadata FROM messages "
+            "WHERE thread_id = ? ORDER BY timestamp DESC, id DESC LIMIT ?",
+            (str(thread_id), int(n))
+        )
+        messages.reverse()
+        return messages
+
+    def range_by_time(self, thread_id, start=None, end=None):
+        sql = "SELECT timestamp, role, content, metadata FROM messages WHERE thread_id = ?"
+        params = [str(thread_id)]
+        if start:
+            sql += " AND timestamp >= ?"
+            params.append(start)
+        if end:
+            sql += " AND timestamp <= ?"
+            params.append(end)
+        sql += " ORDER BY timestamp, id"
+        return self._query(sql, params)
+
+    def list_threads(self):
+        with self.lock:
+            rows = self.conn.execute("SELECT DISTINCT thread_id FROM messages").fetchall()
+        return [row[0] for row in rows]
+
+    @staticmethod
+    def _children(name):
+        # LIKE 中的 % 和 _ 需要转义
+        escaped = name.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        return escaped + '/%'
+
+    def load_state(self, name):
+        with self.lock:
+            row = self.conn.execute("SELECT data FROM bot_state WHERE name = ?", (name,)).fetchone()
+            if row:
+                return json.loads(row[0])
+            rows = self.conn.execute(
+                "SELECT name, data FROM bot_state WHERE name LIKE ? ESCAPE '\\'", (self._children(name),)
+            ).fetchall()
+        if not rows:
+            return None
+        # 与 Firebase 一致，下层各项组成嵌套的 dict
+        state = {}
+        for key, data in rows:
+            parts = key[len(name) + 1:].split('/')
+            node = state
+            for part in parts[:-1]:
+                node = node.setdefault(part, {})
+            node[parts[-1]] = json.loads(data)
+        return state
+
+    def save_state(self, name, data):
+        with self.lock:
+            with self.conn:
+                # 整体覆盖，同时清除原来分层保存的下层各项
+                self.conn.execute(
+                    "DELETE FROM bot_state WHERE name LIKE ? ESCAPE '\\'", (self._children(name),)
+                )
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO bot_state (name, data) VALUES (?, ?)",
+                    (name, json.dumps(data, ensure_ascii=False))
+                )
+
+
+def create_storage(backend=None):
+    """根据配置创建存储后端
+
+    Args:
+        backend: 'firebase' 或 'sqlite'，默认读取 CHAT_STORAGE_BACKEND 环境变量
+    """
+    backend = (backend or os.getenv('CHAT_STORAGE_BACKEND', 'firebase')).lower()
+    if backend == 'sqlite':
+        return SQLiteStorage(os.getenv('CHAT_SQLITE_PATH', 'chat_history.db'))
+    if backend == 'firebase':
+        # CHAT_FIREBASE_LAYOUT=monthly 时按月分区存储
+        if os.getenv('CHAT_FIREBASE_LAYOUT', 'flat').lower() == 'monthly':
+            return MonthlyFirebaseStorage()
+        return FirebaseStorage()
+    raise ValueError(f"未知的存储后端: {backend}")
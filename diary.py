@@ -3,10 +3,10 @@ import json
 import logging
 from datetime import datetime, timedelta
 import pytz
-import requests
+import http_client
 import firebase_admin
 from firebase_admin import credentials
-from firebase_admin import db
+from chat_storage import create_storage
 from dotenv import load_dotenv
 from supabase import create_client, Client
 
@@ -39,6 +39,7 @@ class DiaryGenerator:
         # 初始化数据库
         self._init_firebase()
         self._init_supabase()
+        self.storage = create_storage('firebase')
         
         # 设置时区为北京时间
         self.timezone = pytz.timezone('Asia/Shanghai')
@@ -95,38 +96,23 @@ class DiaryGenerator:
             today_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
             today_end = now
             
-            # 从 Firebase 获取特定对话
-            ref = db.reference(f'chat_histories/{CONVERSATION_ID}')
-            conversation_data = ref.get()
+            # 从 Firebase 只获取今天的消息（按月分区时只读取当月分区）。
+            # 消息时间戳是写入时机器人所在机器的本地时间（datetime.now()，不带时区，
+            # GitHub Actions 上即 UTC），查询边界同样换算成本机本地时间
+            start_local = today_start.astimezone().replace(tzinfo=None).isoformat()
+            all_messages = self.storage.range_by_time(CONVERSATION_ID, start=start_local)
             
-            if not conversation_data:
-                logger.warning(f"未找到指定对话 [ID: {CONVERSATION_ID}]")
+            if not all_messages:
+                logger.warning(f"未找到指定对话的今日消息 [ID: {CONVERSATION_ID}]")
                 return []
             
-            # 合并所有子节点的消息
-            all_messages = []
-            
-            # 处理数据，无论是字典还是列表
-            if isinstance(conversation_data, dict):
-                # 如果是字典（键值对）结构
-                for node_id, messages in conversation_data.items():
-                    if isinstance(messages, dict):
-                        for msg_id, msg in messages.items():
-                            if isinstance(msg, dict) and 'timestamp' in msg:
-                                all_messages.append(msg)
-            elif isinstance(conversation_data, list):
-                # 如果是列表结构
-                for msg in conversation_data:
-                    if isinstance(msg, dict) and 'timestamp' in msg:
-                        all_messages.append(msg)
-            
             # 筛选今天的消息
             today_messages = []
             for msg in all_messages:
                 try:
                     # 获取消息时间
-                    msg_time = datetime.fromisoformat(msg['timestamp'])
-                    msg_time = pytz.utc.localize(msg_time).astimezone(self.timezone)
+                    # 不带时区的时间按本机本地时间解释
+                    msg_time = datetime.fromisoformat(msg['timestamp']).astimezone(self.timezone)
                     
                     # 如果消息在今天的时间范围内
                     if today_start <= msg_time <= today_end:
@@ -173,7 +159,7 @@ class DiaryGenerator:
                 'timezone': 'Asia/Shanghai'
             }
             
-            response = requests.get('https://api.open-meteo.com/v1/forecast', params=params)
+            response = http_client.get('https://api.open-meteo.com/v1/forecast', params=params)
             
             if response.status_code == 200:
                 data = response.json()
@@ -230,7 +216,7 @@ class DiaryGenerator:
         """调用 AI 模型生成内容"""
         try:
             # 首先尝试调用 Gemini 1.5 Pro
-            response = requests.post(
+            response = http_client.post(
                 'https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-pro:generateContent',
                 headers={
                     'x-goog-api-key': self.api_key,
@@ -262,7 +248,7 @@ class DiaryGenerator:
             
             try:
                 # 使用备用模型 Gemini 2.0 Flash
-                response = requests.post(
+                response = http_client.post(
                     'https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash-experimental:generateContent',
                     headers={
                         'x-goog-api-key': self.api_key,
@@ -0,0 +1,101 @@
+import os
+import time
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+# 连接池与超时配置
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', '5'))  # 建立连接超时（秒）
+HTTP_READ_TIMEOUT = float(os.getenv('HTTP_READ_TIMEOUT', '60'))  # 等待响应超时（秒）
+HTTP_POOL_CONNECTIONS = int(os.getenv('HTTP_POOL_CONNECTIONS', '4'))  # 每个会话缓存的连接池数
+HTTP_POOL_MAXSIZE = int(os.getenv('HTTP_POOL_MAXSIZE', '10'))  # 每个主机保持的最大连接数
+
+_sessions = {}  # 主机 -> requests.Session
+_lock = threading.Lock()
+
+# 当前调用链的截止时间（time.time() 时间戳），由 llm_gateway 等调用方设置
+_deadline = contextvars.ContextVar('http_deadline', default=None)
+
+
+@contextmanager
+def deadline(at):
+    """在该上下文内发出的请求，超时时间不超过截止时间 at"""
+    token = _deadline.set(at)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def current_deadline():
+    """当前调用链的截止时间，没有设置时返回 None"""
+    return _deadline.get()
+
+
+def _apply_deadline(timeout):
+    at = _deadline.get()
+    if at is None:
+        return timeout
+    remaining = at - time.time()
+    if remaining <= 0:
+        raise requests.exceptions.Timeout("已超过调用截止时间")
+    if isinstance(timeout, tuple):
+        return tuple(min(value, remaining) for value in timeout)
+    return min(timeout, remaining)
+
+
+def get_session(url):
+    """获取目标主机共用的会话，复用 keep-alive 连接，避免每次请求都重新握手"""
+    host = urlsplit(url).netloc
+    with _lock:
+        session = _sessions.get(host)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=HTTP_POOL_CONNECTIONS, pool_maxsize=HTTP_POOL_MAXSIZE)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _sessions[host] = session
+        return session
+
+
+def request(method, url, timeout=None, **kwargs):
+    """发送请求并记录耗时
+
+    Args:
+        timeout: (连接超时, 读取超时)，默认使用 HTTP_CONNECT_TIMEOUT / HTTP_READ_TIMEOUT；
+            在 deadline() 上下文中不会超过剩余时间
+    """
+    if timeout is None:
+        timeout = (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+    timeout = _apply_deadline(timeout)
+    host = urlsplit(url).netloc
+    start_time = time.time()
+    try:
+        response = get_session(url).request(method, url, timeout=timeout, **kwargs)
+    except Exception as e:
+        logger.error(f"HTTP {method} {host} 失败 - 耗时 {time.time() - start_time:.3f} 秒: {str(e)}")
+        raise
+    logger.info(f"HTTP {method} {host} - 状态码 {response.status_code}，耗时 {time.time() - start_time:.3f} 秒")
+    return response
+
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
+
+
+def close_all():
+    """关闭所有会话及其连接"""
+    with _lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
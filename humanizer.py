@@ -0,0 +1,123 @@
+import os
+import json
+import time
+import random
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# 默认的"真人"回复时间：从收到消息到发出回复（秒），原来生成前停顿 1-3 秒、生成后再停顿 2-5 秒
+HUMAN_DELAY_MIN = float(os.getenv('HUMAN_DELAY_MIN', '3'))
+HUMAN_DELAY_MAX = float(os.getenv('HUMAN_DELAY_MAX', '8'))
+HUMAN_TYPING_SPEED = float(os.getenv('HUMAN_TYPING_SPEED', '0'))  # 每个字额外增加的打字时间（秒），0 表示不按长度增加
+HUMAN_PROFILES_PATH = os.getenv('HUMAN_PROFILES_PATH', '')  # 按对话设置回复时间的 JSON 文件，为空时都使用默认值
+
+
+class ThreadProfile:
+    """单个对话的回复时间设置和统计"""
+
+    def __init__(self, delay_min=HUMAN_DELAY_MIN, delay_max=HUMAN_DELAY_MAX, typing_speed=HUMAN_TYPING_SPEED):
+        self.delay_min = delay_min
+        self.delay_max = delay_max
+        self.typing_speed = typing_speed
+        self.replies = 0
+        self.slept = 0.0  # 累计补足的停顿
+        self.late = 0  # 生成耗时已经超过目标、没有停顿的次数
+
+    def sample(self):
+        return random.uniform(self.delay_min, self.delay_max)
+
+
+class ReplyTimer:
+    """一次回复的计时：收到消息时开始，发送前只停顿目标时间中还剩下的部分"""
+
+    def __init__(self, humanizer, thread_id, profile):
+        self.humanizer = humanizer
+        self.thread_id = thread_id
+        self.profile = profile
+        self.start_time = time.time()
+        self.target = profile.sample()
+        self.waited = False
+
+    def remaining(self, reply=''):
+        target = self.target + len(reply) * self.profile.typing_speed
+        return max(0.0, target - (time.time() - self.start_time))
+
+    def wait(self, reply=''):
+        """发送前调用，同一次回复只停顿一次（流式回复的后续句子不再停顿）"""
+        if self.waited:
+            return
+        self.waited = True
+        delay = self.remaining(reply)
+        elapsed = time.time() - self.start_time
+        self.humanizer.record(self.profile, delay)
+        logger.info(f"回复停顿 [对话ID: ****{self.thread_id[-4:]}] - 已耗时 {elapsed:.3f} 秒，"
+                    f"目标 {self.target:.1f} 秒，再等待 {delay:.3f} 秒")
+        if delay > 0:
+            time.sleep(delay)
+
+
+class Humanizer:
+    """模拟真人回复时间
+
+    每条消息按对话的设置抽取一个目标回复时间，生成回复的耗时计算在内，
+    发送前只等待 max(0, 目标 - 已耗时)，模型越慢停顿越短。
+
+    HUMAN_PROFILES_PATH 文件格式：{"对话ID": {"min": 2, "max": 6, "typing_speed": 0.05}}
+    """
+
+    def __init__(self, profiles_path=HUMAN_PROFILES_PATH):
+        self.profiles = {}
+        self.overrides = {}
+        self.lock = threading.Lock()
+        if profiles_path and os.path.exists(profiles_path):
+            try:
+                with open(profiles_path, 'r', encoding='utf-8') as f:
+                    self.overrides = json.load(f)
+                logger.info(f"加载回复时间设置 - {len(self.overrides)} 个对话")
+            except Exception as e:
+                logger.error(f"读取回复时间设置失败: {str(e)}")
+
+    def profile(self, thread_id):
+        thread_id = str(thread_id)
+        with self.lock:
+            profile = self.profiles.get(thread_id)
+            if profile is None:
+                override = self.overrides.get(thread_id, {})
+                profile = ThreadProfile(
+                    float(override.get('min', HUMAN_DELAY_MIN)),
+                    float(override.get('max', HUMAN_DELAY_MAX)),
+                    float(override.get('typing_speed', HUMAN_TYPING_SPEED))
+                )
+                self.profiles[thread_id] = profile
+            return profile
+
+    def start(self, thread_id):
+        """收到消息时调用，返回这次回复的计时器"""
+        return ReplyTimer(self, str(thread_id), self.profile(thread_id))
+
+    def record(self, profile, delay):
+        with self.lock:
+            profile.replies += 1
+            profile.slept += delay
+            if delay == 0:
+                profile.late += 1
+
+    def summary(self):
+        """所有对话合计的回复次数、平均补足停顿和超过目标时间的比例"""
+        with self.lock:
+            replies = sum(p.replies for p in self.profiles.values())
+            slept = sum(p.slept for p in self.profiles.values())
+            late = sum(p.late for p in self.profiles.values())
+        return {
+            'replies': replies,
+            'avg_delay': slept / replies if replies else 0.0,
+            'late_rate': late / replies if replies else 0.0
+        }
+
+    def log_summary(self):
+        stats = self.summary()
+        if stats['replies']:
+            logger.info(f"回复停顿 - {stats['replies']} 次，平均补足 {stats['avg_delay']:.3f} 秒，"
+                        f"{stats['late_rate']:.0%} 的回复生成耗时已超过目标")
@@ -0,0 +1,146 @@
+import os
+import logging
+import threading
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+INBOX_MESSAGE_LIMIT = int(os.getenv('INBOX_MESSAGE_LIMIT', '5'))  # 收件箱接口每个对话附带的最近消息数
+INBOX_BACKFILL_LIMIT = 20  # 附带的消息不够时补充请求的消息数
+
+
+def _parse_time(value):
+    return datetime.fromisoformat(value) if value else None
+
+
+def _position(timestamp, item_id):
+    """消息的先后顺序：时间相同时按消息 ID 比较（Instagram 的消息 ID 是递增的数字字符串）"""
+    item_id = str(item_id)
+    return (timestamp, len(item_id), item_id)
+
+
+class InboxSync:
+    """增量同步收件箱
+
+    保存每个对话的高水位（最后处理的消息 ID 和时间）。
+    每次轮询只请求未读和待处理两个列表，并让列表直接带上每个对话最近的消息，
+    不再对每个对话单独调用 direct_thread；活动时间早于高水位的对话直接跳过，
+    只返回高水位之后的新消息（时间相同时按消息 ID 排序）。
+
+    高水位和会话一样保存在存储后端（GitHub Actions 每次运行的磁盘都是新的），
+    每个对话一项：inbox_sync/{对话ID} = {"item_id": "...", "timestamp": "..."}
+    """
+
+    def __init__(self, client, storage=None, message_limit=INBOX_MESSAGE_LIMIT):
+        """
+        Args:
+            storage: 聊天记录存储后端（chat_storage.ChatStorage），为空时高水位只保存在内存中
+        """
+        self.client = client
+        self.storage = storage
+        self.message_limit = message_limit
+        self.threads = {}
+        self.lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        if self.storage is None:
+            return
+        try:
+            self.threads = self.storage.load_state('inbox_sync') or {}
+            logger.info(f"加载收件箱同步状态 - {len(self.threads)} 个对话")
+        except Exception as e:
+            logger.error(f"读取收件箱同步状态失败: {str(e)}")
+
+    def _fetch(self):
+        """请求未读和待处理对话，同一个对话只保留一次"""
+        threads = {}
+        unread = self.client.direct_threads(
+            amount=20, selected_filter="unread", thread_message_limit=self.message_limit
+        )
+        pending = self.client.direct_pending_inbox(20)
+        for thread in list(unread or []) + list(pending or []):
+            threads.setdefault(str(thread.id), thread)
+        return list(threads.values())
+
+    def _covers(self, messages, mark, own_id):
+        """取到的消息是否已经覆盖了所有新消息（到达高水位，或第一次见到的对话里有自己的回复）"""
+        if mark is None:
+            return any(str(msg.user_id) == own_id for msg in messages)
+        since = _parse_time(mark['timestamp'])
+        return any(msg.timestamp <= since for msg in messages)
+
+    def unseen(self, thread):
+        """对话中高水位之后的所有新消息（不含自己发送的），按时间从早到晚排列
+
+        收件箱附带的消息不够时再请求一次最近 INBOX_BACKFILL_LIMIT 条，连续发来的多条消息都不会遗漏。
+        第一次见到的对话返回自己最后一次回复之后的消息。
+        """
+        thread_id = str(thread.id)
+        mark = self.threads.get(thread_id)
+        own_id = str(self.client.user_id)
+        messages = thread.messages or []
+        if not messages or (len(messages) >= self.message_limit and not self._covers(messages, mark, own_id)):
+            messages = self.client.direct_messages(thread_id, amount=INBOX_BACKFILL_LIMIT)
+        messages = sorted(messages, key=lambda msg: _position(msg.timestamp, msg.id))
+
+        if mark is None:
+            new_messages = []
+            for msg in reversed(messages):
+                if str(msg.user_id) == own_id:
+                    break
+                new_messages.append(msg)
+            new_messages.reverse()
+            return new_messages
+        # 同一时间可能有多条消息，按 (时间, ID) 比较，不会漏掉与高水位时间相同的消息
+        since = _position(_parse_time(mark['timestamp']), mark['item_id'])
+        return [
+            msg for msg in messages
+            if _position(msg.timestamp, msg.id) > since and str(msg.user_id) != own_id
+        ]
+
+    def poll(self):
+        """返回有新消息的对话
+
+        Returns:
+            list: [(thread, [新消息, ...]), ...]
+        """
+        threads = self._fetch()
+        if not threads:
+            return []
+
+        updates = []
+        skipped = 0
+        for thread in threads:
+            mark = self.threads.get(str(thread.id))
+            if mark is not None and thread.last_activity_at and thread.last_activity_at < _parse_time(mark['timestamp']):
+                skipped += 1
+                continue
+            messages = self.unseen(thread)
+            if messages:
+                updates.append((thread, messages))
+            else:
+                skipped += 1
+
+        if skipped:
+            logger.info(f"收件箱同步 - {len(updates)} 个对话有新消息，跳过 {skipped} 个没有变化的对话")
+        return updates
+
+    def mark(self, thread_id, message):
+        """消息处理完后更新对话的高水位"""
+        thread_id = str(thread_id)
+        with self.lock:
+            current = self.threads.get(thread_id)
+            if current is not None and (
+                _position(_parse_time(current['timestamp']), current['item_id']) >= _position(message.timestamp, message.id)
+            ):
+                return
+            mark = {'item_id': str(message.id), 'timestamp': message.timestamp.isoformat()}
+            self.threads[thread_id] = mark
+        if self.storage is None:
+            return
+        # 只写入这一个对话的高水位；同一个对话的消息按顺序处理，不会并发写入
+        try:
+            self.storage.save_state(f"inbox_sync/{thread_id}", mark)
+        except Exception as e:
+            logger.error(f"保存收件箱同步状态失败: {str(e)}")
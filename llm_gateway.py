@@ -0,0 +1,131 @@
+import os
+import time
+import asyncio
+import logging
+import threading
+import concurrent.futures
+from contextlib import contextmanager
+import http_client
+
+logger = logging.getLogger(__name__)
+
+# 每个模型服务商同时进行的调用数上限，例如 LLM_CONCURRENCY_LINGYI=4
+DEFAULT_CONCURRENCY = int(os.getenv('LLM_CONCURRENCY', '4'))
+LLM_DEADLINE = float(os.getenv('LLM_DEADLINE', '90'))  # 单次调用（包括排队和重试）的截止时间（秒）
+
+
+def provider_limit(provider):
+    return int(os.getenv(f'LLM_CONCURRENCY_{provider.upper()}', str(DEFAULT_CONCURRENCY)))
+
+
+class LLMGateway:
+    """模型调用网关
+
+    在后台线程中运行一个 asyncio 事件循环，每个服务商一个信号量限制并发，
+    同步的模型调用函数放到线程中执行。多个对话可以同时等待模型返回，
+    某个服务商变慢时只占用它自己的并发名额。
+
+    截止时间通过 http_client.deadline() 传递给实际的 HTTP 请求，
+    超时或取消后正在进行的请求最迟在截止时间结束。
+    """
+
+    def __init__(self, deadline=LLM_DEADLINE):
+        self.deadline = deadline
+        self.semaphores = {}
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="llm-gateway", daemon=True)
+        self.thread.start()
+
+    def _semaphore(self, provider):
+        # 只在事件循环线程中调用
+        if provider not in self.semaphores:
+            self.semaphores[provider] = asyncio.Semaphore(provider_limit(provider))
+        return self.semaphores[provider]
+
+    async def call(self, provider, func, *args, deadline=None, **kwargs):
+        """在 provider 的并发限制内调用 func(*args, **kwargs)
+
+        Args:
+            deadline: 截止时间（秒），默认 LLM_DEADLINE，排队时间也计算在内
+
+        Raises:
+            asyncio.TimeoutError: 超过截止时间
+            asyncio.CancelledError: 调用被取消
+        """
+        timeout = self.deadline if deadline is None else deadline
+        start_time = time.time()
+        at = start_time + timeout
+
+        async def invoke():
+            async with self._semaphore(provider):
+                waited = time.time() - start_time
+                if waited > 1:
+                    logger.info(f"{provider} 调用排队 {waited:.3f} 秒")
+                # to_thread 会复制当前上下文，截止时间随之传入线程中的 HTTP 请求
+                with http_client.deadline(at):
+                    return await asyncio.to_thread(func, *args, **kwargs)
+
+        try:
+            result = await asyncio.wait_for(invoke(), timeout)
+        except asyncio.TimeoutError:
+            logger.error(f"{provider} 调用超过截止时间 {timeout:.0f} 秒")
+            raise
+        except asyncio.CancelledError:
+            logger.warning(f"{provider} 调用已取消 - 耗时 {time.time() - start_time:.3f} 秒")
+            raise
+        logger.info(f"{provider} 调用完成 - 耗时 {time.time() - start_time:.3f} 秒")
+        return result
+
+    def submit(self, provider, func, *args, deadline=None, **kwargs):
+        """从同步代码提交调用，返回 concurrent.futures.Future，future.cancel() 会取消调用"""
+        return asyncio.run_coroutine_threadsafe(
+            self.call(provider, func, *args, deadline=deadline, **kwargs), self.loop
+        )
+
+    async def _acquire(self, provider):
+        await self._semaphore(provider).acquire()
+
+    def _release(self, provider):
+        # 只在事件循环线程中调用
+        self._semaphore(provider).release()
+
+    @contextmanager
+    def slot(self, provider, deadline=None):
+        """在同步代码中占用 provider 的一个并发名额，用于流式调用等不能放进 call() 的场景
+
+        与 call() 共用同一个信号量和截止时间（排队时间计算在内），
+        期间的 HTTP 请求通过 http_client.deadline() 带上截止时间。
+
+        Yields:
+            float: 截止时间（time.time() 时间戳）
+
+        Raises:
+            concurrent.futures.TimeoutError: 排队超过截止时间
+        """
+        timeout = self.deadline if deadline is None else deadline
+        start_time = time.time()
+        at = start_time + timeout
+        future = asyncio.run_coroutine_threadsafe(self._acquire(provider), self.loop)
+        try:
+            future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            if not future.cancel():
+                # 取消前刚好拿到了名额
+                self.loop.call_soon_threadsafe(self._release, provider)
+            logger.error(f"{provider} 排队超过截止时间 {timeout:.0f} 秒")
+            raise
+        waited = time.time() - start_time
+        if waited > 1:
+            logger.info(f"{provider} 调用排队 {waited:.3f} 秒")
+        try:
+            with http_client.deadline(at):
+                yield at
+        finally:
+            self.loop.call_soon_threadsafe(self._release, provider)
+
+    def run(self, provider, func, *args, deadline=None, **kwargs):
+        """从同步代码调用并等待结果"""
+        return self.submit(provider, func, *args, deadline=deadline, **kwargs).result()
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
@@ -0,0 +1,362 @@
+import os
+import re
+import json
+import time
+import logging
+import threading
+from collections import deque
+from concurrent.futures import wait, FIRST_COMPLETED, CancelledError
+import http_client
+from resilience import CircuitOpenError, breaker, call_with_retry, check_response, is_retryable
+
+logger = logging.getLogger(__name__)
+
+LINGYI_API_KEY = os.getenv('LINGYI_API_KEY', '')
+LINGYI_API_BASE = os.getenv('LINGYI_API_BASE', 'https://api.lingyiwanwu.com/v1/chat/completions')
+LINGYI_MODEL = os.getenv('LINGYI_MODEL', 'yi-34b-chat-0205')
+OPENAI_API_KEY = os.getenv('OPENAI_API_KEY', '')
+OPENAI_API_BASE = os.getenv('OPENAI_API_BASE', 'https://api.deepseek.com/v1')
+DEEPSEEK_MODEL = os.getenv('DEEPSEEK_MODEL', 'deepseek-chat')
+
+# 对冲请求配置
+HEDGE_DELAY = float(os.getenv('LLM_HEDGE_DELAY', '4'))  # 样本不足时，主服务商超过该时间未返回就请求备用服务商（秒）
+STATS_WINDOW = int(os.getenv('LLM_STATS_WINDOW', '100'))  # 统计延迟和错误率的最近调用数
+MIN_SAMPLES = 10  # 样本数达到该值后用 p95 作为对冲等待时间
+MAX_ERROR_RATE = 0.5  # 错误率超过该值的服务商不再作为主服务商
+CANCEL_POLL_INTERVAL = 0.1  # 可取消的调用检查取消标志的间隔（秒）
+
+# 句子结束标点（中英文），用于流式回复按句发送
+SENTENCE_END = re.compile(r'[。！？!?…~～\n]+|\.(?=\s|$)')
+
+
+def _chat_completion(provider, url, api_key, model, messages):
+    response = http_client.post(
+        url,
+        headers={
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json"
+        },
+        json={
+            "model": model,
+            "messages": messages,
+            "temperature": 0.7,
+            "max_tokens": 1000
+        }
+    )
+    check_response(provider, response)
+    return response.json()["choices"][0]["message"]["content"]
+
+
+def _stream_chat_completion(provider, url, api_key, model, messages):
+    """以 SSE 流式调用 OpenAI 兼容接口，逐段返回生成的文本"""
+    response = http_client.post(
+        url,
+        headers={
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json",
+            "Accept": "text/event-stream"
+        },
+        json={
+            "model": model,
+            "messages": messages,
+            "temperature": 0.7,
+            "max_tokens": 1000,
+            "stream": True
+        },
+        stream=True
+    )
+    try:
+        check_response(provider, response)
+        for line in response.iter_lines(decode_unicode=True):
+            if not line or not line.startswith('data:'):
+                continue
+            data = line[len('data:'):].strip()
+            if data == '[DONE]':
+                break
+            delta = json.loads(data)["choices"][0].get("delta", {})
+            if delta.get("content"):
+                yield delta["content"]
+    finally:
+        response.close()
+
+
+def iter_sentences(chunks):
+    """把流式返回的文本片段拼接成完整的句子，每凑齐一句就返回"""
+    buffer = ""
+    for chunk in chunks:
+        buffer += chunk
+        while True:
+            match = SENTENCE_END.search(buffer)
+            # 标点在末尾时可能还有后续标点（如 "？！"），等下一个片段再判断
+            if not match or match.end() == len(buffer):
+                break
+            sentence = buffer[:match.end()].strip()
+            buffer = buffer[match.end():]
+            if sentence:
+                yield sentence
+    if buffer.strip():
+        yield buffer.strip()
+
+
+def lingyi_completion(messages):
+    """调用灵医万物 API（带重试和熔断）"""
+    return call_with_retry('lingyi', _chat_completion, 'lingyi', LINGYI_API_BASE, LINGYI_API_KEY, LINGYI_MODEL, messages)
+
+
+def deepseek_completion(messages):
+    """调用 DeepSeek（OpenAI 兼容）API（带重试和熔断）"""
+    return call_with_retry(
+        'deepseek', _chat_completion, 'deepseek',
+        f"{OPENAI_API_BASE.rstrip('/')}/chat/completions", OPENAI_API_KEY, DEEPSEEK_MODEL, messages
+    )
+
+
+def lingyi_stream(messages):
+    return _stream_chat_completion('lingyi', LINGYI_API_BASE, LINGYI_API_KEY, LINGYI_MODEL, messages)
+
+
+def deepseek_stream(messages):
+    return _stream_chat_completion(
+        'deepseek', f"{OPENAI_API_BASE.rstrip('/')}/chat/completions", OPENAI_API_KEY, DEEPSEEK_MODEL, messages
+    )
+
+
+# 服务商名称 -> 流式调用函数
+STREAM_FUNCTIONS = {
+    'lingyi': lingyi_stream,
+    'deepseek': deepseek_stream
+}
+
+
+def default_providers():
+    """根据已配置的密钥返回可用的服务商，按默认优先级排列"""
+    providers = []
+    if LINGYI_API_KEY:
+        providers.append(('lingyi', lingyi_completion))
+    if OPENAI_API_KEY:
+        providers.append(('deepseek', deepseek_completion))
+    return providers
+
+
+def _percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct))]
+
+
+class ProviderStats:
+    """服务商最近调用的延迟和错误率"""
+
+    def __init__(self, window=STATS_WINDOW):
+        self.latencies = deque(maxlen=window)
+        self.results = deque(maxlen=window)  # True 表示成功
+        self.lock = threading.Lock()
+
+    def record(self, latency):
+        with self.lock:
+            self.latencies.append(latency)
+            self.results.append(True)
+
+    def record_error(self):
+        with self.lock:
+            self.results.append(False)
+
+    def p50(self):
+        with self.lock:
+            return _percentile(self.latencies, 0.5) if self.latencies else None
+
+    def p95(self):
+        with self.lock:
+            return _percentile(self.latencies, 0.95) if self.latencies else None
+
+    def error_rate(self):
+        with self.lock:
+            return self.results.count(False) / len(self.results) if self.results else 0.0
+
+    def samples(self):
+        return len(self.latencies)
+
+
+class ChatRouter:
+    """多服务商对冲调用
+
+    选择延迟最低且错误率正常的服务商作为主服务商；主服务商在等待预算
+    （它自己的 p95，样本不足时为 LLM_HEDGE_DELAY）内没有返回或出错时，
+    同时请求下一个服务商，使用先返回的结果并取消另一个请求。
+    """
+
+    def __init__(self, gateway, providers=None, hedge_delay=HEDGE_DELAY):
+        self.gateway = gateway
+        self.providers = providers if providers is not None else default_providers()
+        self.hedge_delay = hedge_delay
+        self.stats = {name: ProviderStats() for name, _ in self.providers}
+
+    def ranked(self):
+        """按是否熔断、错误率是否正常、p50 延迟排序；还没有样本的服务商排在前面以获得样本，同等条件下保持配置顺序"""
+        def score(item):
+            position, (name, _) = item
+            stats = self.stats[name]
+            p50 = stats.p50()
+            return (not breaker(name).available(), stats.error_rate() > MAX_ERROR_RATE,
+                    p50 if p50 is not None else 0, position)
+        return [provider for _, provider in sorted(enumerate(self.providers), key=score)]
+
+    def hedge_budget(self, name):
+        stats = self.stats[name]
+        if stats.samples() >= MIN_SAMPLES:
+            return stats.p95()
+        return self.hedge_delay
+
+    def _timed(self, name, func, messages):
+        start_time = time.time()
+        try:
+            result = func(messages)
+        except CircuitOpenError:
+            # 熔断中没有发出请求，不计入延迟和错误率
+            raise
+        except Exception:
+            self.stats[name].record_error()
+            raise
+        self.stats[name].record(time.time() - start_time)
+        return result
+
+    def _submit(self, name, func, messages):
+        return self.gateway.submit(name, self._timed, name, func, messages)
+
+    @staticmethod
+    def _wait(futures, timeout=None, cancel=None):
+        """等待任一 future 完成；cancel（threading.Event）被设置时取消所有请求并抛出 CancelledError"""
+        if cancel is None:
+            return wait(futures, timeout=timeout, return_when=FIRST_COMPLETED)[0]
+        end_time = None if timeout is None else time.time() + timeout
+        while True:
+            step = CANCEL_POLL_INTERVAL if end_time is None else min(CANCEL_POLL_INTERVAL, max(end_time - time.time(), 0))
+            done = wait(futures, timeout=step, return_when=FIRST_COMPLETED)[0]
+            if cancel.is_set():
+                for future in futures:
+                    future.cancel()
+                raise CancelledError()
+            if done or (end_time is not None and time.time() >= end_time):
+                return done
+
+    def complete(self, messages, cancel=None):
+        """生成回复
+
+        Args:
+            cancel: threading.Event，设置后放弃生成，正在进行的请求被取消
+
+        Returns:
+            (回复内容, 服务商名称)
+
+        Raises:
+            Exception: 所有服务商都失败
+            concurrent.futures.CancelledError: 被 cancel 取消
+        """
+        if not self.providers:
+            raise Exception("没有可用的模型服务商")
+
+        start_time = time.time()
+        queue = self.ranked()
+        name, func = queue.pop(0)
+        futures = {self._submit(name, func, messages): name}
+        budget = self.hedge_budget(name)
+        last_error = None
+
+        done = self._wait(futures, budget, cancel)
+        if not done and queue:
+            backup_name, backup_func = queue.pop(0)
+            logger.info(f"{name} 未在 {budget:.1f} 秒内返回，同时请求 {backup_name}")
+            futures[self._submit(backup_name, backup_func, messages)] = backup_name
+
+        while futures:
+            if not done:
+                done = self._wait(futures, cancel=cancel)
+            for future in done:
+                winner = futures.pop(future)
+                if future.cancelled():
+                    continue
+                try:
+                    result = future.result()
+                except Exception as e:
+                    last_error = e
+                    logger.error(f"{winner} 调用失败: {str(e)}")
+                    continue
+                for other in futures:
+                    other.cancel()
+                logger.info(f"使用 {winner} 的回复 - 耗时 {time.time() - start_time:.3f} 秒")
+                return result, winner
+            done = set()
+
+            # 已经处理过的失败不再重复触发；只有没有请求在进行时才改用下一个服务商
+            if not futures and queue:
+                backup_name, backup_func = queue.pop(0)
+                logger.info(f"请求失败，改用 {backup_name}")
+                futures[self._submit(backup_name, backup_func, messages)] = backup_name
+
+        raise Exception(f"所有模型服务商调用失败: {str(last_error)}")
+
+    def stream(self, messages):
+        """流式生成回复，逐段返回文本
+
+        流式调用无法对冲，按 ranked() 顺序选择服务商，跳过熔断中的服务商；
+        在收到第一段文本之前失败时换下一个服务商，之后失败则直接抛出异常。
+        和普通调用一样通过网关占用服务商的并发名额，整个流在截止时间内没有结束时中止。
+        """
+        last_error = None
+        for name, _ in self.ranked():
+            stream_func = STREAM_FUNCTIONS.get(name)
+            if stream_func is None:
+                continue
+            circuit = breaker(name)
+            if not circuit.allow():
+                logger.info(f"{name} 处于熔断状态，跳过流式调用")
+                continue
+            start_time = time.time()
+            started = False
+            try:
+                with self.gateway.slot(name) as at:
+                    for chunk in stream_func(messages):
+                        if time.time() > at:
+                            raise TimeoutError(f"{name} 流式调用超过截止时间")
+                        if not started:
+                            started = True
+                            logger.info(f"{name} 首段文本延迟 {time.time() - start_time:.3f} 秒")
+                        yield chunk
+            except GeneratorExit:
+                # 调用方提前停止读取
+                circuit.release()
+                raise
+            except Exception as e:
+                self.stats[name].record_error()
+                # 与 call_with_retry 相同：请求本身有误（4xx 等）不算服务商故障
+                if is_retryable(e):
+                    circuit.record_failure()
+                else:
+                    circuit.release()
+                if started:
+                    raise
+                last_error = e
+                logger.error(f"{name} 流式调用失败: {str(e)}")
+                continue
+            self.stats[name].record(time.time() - start_time)
+            circuit.record_success()
+            return
+        raise Exception(f"所有模型服务商流式调用失败: {str(last_error)}")
+
+    def summary(self):
+        """各服务商的 p50/p95 延迟与错误率"""
+        return {
+            name: {
+                'p50': self.stats[name].p50(),
+                'p95': self.stats[name].p95(),
+                'error_rate': self.stats[name].error_rate(),
+                'samples': self.stats[name].samples()
+            }
+            for name, _ in self.providers
+        }
+
+    def log_summary(self):
+        for name, stats in self.summary().items():
+            if stats['p50'] is None:
+                continue
+            logger.info(f"{name} - p50 {stats['p50']:.3f} 秒，p95 {stats['p95']:.3f} 秒，"
+                        f"错误率 {stats['error_rate']:.0%}（{stats['samples']} 次）")
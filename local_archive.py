@@ -0,0 +1,285 @@
+import os
+import json
+import gzip
+import logging
+import threading
+
+try:
+    import zstandard
+except ImportError:  # zstd 压缩是可选的
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_SEGMENT_SIZE = int(os.getenv('CHAT_ARCHIVE_SEGMENT_SIZE', '500'))  # 每个分段的消息数
+ARCHIVE_COMPRESSION = os.getenv('CHAT_ARCHIVE_COMPRESSION', 'gzip').lower()  # gzip / zstd / none
+
+INDEX_FILE = "index.json"
+
+
+class ConversationArchive:
+    """本地对话归档：每个对话一个目录，消息以追加方式写入 JSONL 分段
+
+    目录结构：
+        {base_dir}/{thread_id}/index.json          分段索引（消息数、起止时间、文件大小）
+        {base_dir}/{thread_id}/seg_000001.jsonl.gz 已写满并压缩的分段
+        {base_dir}/{thread_id}/seg_000002.jsonl    当前正在追加的分段
+
+    追加只写当前分段的末尾；读取最近 N 条或某个时间段时，只解析索引命中的分段。
+    兼容旧的 conversation_{thread_id}.json 整文件备份，首次读取时自动导入。
+    """
+
+    def __init__(self, base_dir, segment_size=ARCHIVE_SEGMENT_SIZE, compression=ARCHIVE_COMPRESSION):
+        self.base_dir = base_dir
+        self.segment_size = segment_size
+        if compression == 'zstd' and zstandard is None:
+            logger.warning("未安装 zstandard，归档改用 gzip 压缩")
+            compression = 'gzip'
+        self.compression = compression
+        self.indexes = {}
+        self.lock = threading.RLock()
+
+    # ---- 路径与索引 ----
+
+    def _thread_dir(self, thread_id):
+        return os.path.join(self.base_dir, str(thread_id))
+
+    def _legacy_file(self, thread_id):
+        return os.path.join(self.base_dir, f"conversation_{thread_id}.json")
+
+    def _index(self, thread_id):
+        """读取对话索引，必要时导入旧格式备份或修复未完整写入的分段"""
+        thread_id = str(thread_id)
+        if thread_id in self.indexes:
+            return self.indexes[thread_id]
+
+        index_path = os.path.join(self._thread_dir(thread_id), INDEX_FILE)
+        if os.path.exists(index_path):
+            with open(index_path, 'r', encoding='utf-8') as f:
+                index = json.load(f)
+            self.indexes[thread_id] = index
+            self._recover_active_segment(thread_id, index)
+            return index
+
+        index = {'count': 0, 'segments': []}
+        self.indexes[thread_id] = index
+        legacy_file = self._legacy_file(thread_id)
+        if os.path.exists(legacy_file):
+            with open(legacy_file, 'r', encoding='utf-8') as f:
+                messages = json.load(f)
+            logger.info(f"导入旧格式对话备份 [对话ID: {thread_id}] - {len(messages)} 条消息")
+            self._append_messages(thread_id, messages)
+        return index
+
+    def _save_index(self, thread_id):
+        thread_dir = self._thread_dir(thread_id)
+        os.makedirs(thread_dir, exist_ok=True)
+        index_path = os.path.join(thread_dir, INDEX_FILE)
+        tmp_path = index_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.indexes[str(thread_id)], f, ensure_ascii=False)
+        os.replace(tmp_path, index_path)
+
+    def _recover_active_segment(self, thread_id, index):
+        """崩溃后索引可能落后于分段文件，按实际内容重建当前分段的统计信息"""
+        if not index['segments']:
+            return
+        active = index['segments'][-1]
+        if active.get('sealed'):
+            return
+        path = os.path.join(self._thread_dir(thread_id), active['file'])
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        if size == active['bytes']:
+            return
+
+        logger.warning(f"归档索引与分段不一致，重新扫描 [对话ID: {thread_id}]")
+        messages = []
+        valid_bytes = 0
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                for line in f:
+                    try:
+                        messages.append(json.loads(line))
+                    except ValueError:
+                        break  # 最后一行没有写完
+                    valid_bytes += len(line)
+            if valid_bytes != size:
+                with open(path, 'r+b') as f:
+                    f.truncate(valid_bytes)
+
+        index['count'] += len(messages) - active['count']
+        active['count'] = len(messages)
+        active['bytes'] = valid_bytes
+        active['first_ts'] = messages[0].get('timestamp', '') if messages else ''
+        active['last_ts'] = messages[-1].get('timestamp', '') if messages else ''
+        self._save_index(thread_id)
+
+    # ---- 分段读写 ----
+
+    def _new_segment(self, thread_id, index):
+        number = len(index['segments']) + 1
+        segment = {
+            'file': f"seg_{number:06d}.jsonl",
+            'count': 0,
+            'bytes': 0,
+            'first_ts': '',
+            'last_ts': '',
+            'sealed': False
+        }
+        index['segments'].append(segment)
+        return segment
+
+    def _seal_segment(self, thread_id, segment):
+        """压缩写满的分段"""
+        if self.compression not in ('gzip', 'zstd'):
+            segment['sealed'] = True
+            return
+        thread_dir = self._thread_dir(thread_id)
+        path = os.path.join(thread_dir, segment['file'])
+        with open(path, 'rb') as f:
+            data = f.read()
+        if self.compression == 'zstd':
+            compressed_name = segment['file'] + ".zst"
+            compressed = zstandard.ZstdCompressor().compress(data)
+        else:
+            compressed_name = segment['file'] + ".gz"
+            compressed = gzip.compress(data)
+        with open(os.path.join(thread_dir, compressed_name), 'wb') as f:
+            f.write(compressed)
+        os.remove(path)
+        segment['file'] = compressed_name
+        segment['bytes'] = len(compressed)
+        segment['sealed'] = True
+
+    def _read_segment(self, thread_id, segment):
+        path = os.path.join(self._thread_dir(thread_id), segment['file'])
+        if segment['file'].endswith('.gz'):
+            with open(path, 'rb') as f:
+                data = gzip.decompress(f.read())
+        elif segment['file'].endswith('.zst'):
+            if zstandard is None:
+                raise RuntimeError("读取 zstd 分段需要安装 zstandard")
+            with open(path, 'rb') as f:
+                data = zstandard.ZstdDecompressor().decompress(f.read(), max_output_size=64 * 1024 * 1024)
+        else:
+            with open(path, 'rb') as f:
+                data = f.read(segment['bytes'])
+        return [json.loads(line) for line in data.splitlines() if line.strip()]
+
+    def _append_messages(self, thread_id, messages):
+        index = self.indexes[str(thread_id)]
+        thread_dir = self._thread_dir(thread_id)
+        os.makedirs(thread_dir, exist_ok=True)
+
+        pos = 0
+        while pos < len(messages):
+            segment = index['segments'][-1] if index['segments'] else None
+            if segment is None or segment['sealed']:
+                segment = self._new_segment(thread_id, index)
+            room = self.segment_size - segment['count']
+            chunk = messages[pos:pos + room]
+            pos += len(chunk)
+
+            data = b"".join(
+                json.dumps(msg, ensure_ascii=False).encode('utf-8') + b"\n" for msg in chunk
+            )
+            with open(os.path.join(thread_dir, segment['file']), 'ab') as f:
+                f.write(data)
+            segment['count'] += len(chunk)
+            segment['bytes'] += len(data)
+            if not segment['first_ts']:
+                segment['first_ts'] = chunk[0].get('timestamp', '')
+            segment['last_ts'] = chunk[-1].get('timestamp', '')
+            index['count'] += len(chunk)
+
+            if segment['count'] >= self.segment_size:
+                self._seal_segment(thread_id, segment)
+
+        self._save_index(thread_id)
+
+    # ---- 对外接口 ----
+
+    def count(self, thread_id):
+        """对话中已归档的消息数"""
+        with self.lock:
+            return self._index(thread_id)['count']
+
+    def exists(self, thread_id):
+        return self.count(thread_id) > 0
+
+    def append(self, thread_id, message):
+        """追加一条消息，只写当前分段末尾"""
+        self.extend(thread_id, [message])
+
+    def extend(self, thread_id, messages):
+        """追加多条消息"""
+        if not messages:
+            return
+        with self.lock:
+            self._index(thread_id)
+            self._append_messages(thread_id, messages)
+
+    def write(self, thread_id, messages):
+        """用给定的消息列表覆盖整个对话归档"""
+        thread_id = str(thread_id)
+        with self.lock:
+            thread_dir = self._thread_dir(thread_id)
+            if os.path.isdir(thread_dir):
+                for filename in os.listdir(thread_dir):
+                    os.remove(os.path.join(thread_dir, filename))
+            self.indexes[thread_id] = {'count': 0, 'segments': []}
+            self._append_messages(thread_id, messages)
+
+    def load(self, thread_id):
+        """读取完整对话"""
+        with self.lock:
+            index = self._index(thread_id)
+            messages = []
+            for segment in index['segments']:
+                messages.extend(self._read_segment(thread_id, segment))
+            return messages
+
+    def tail(self, thread_id, n):
+        """读取最近 n 条消息，只解析末尾的分段"""
+        if n <= 0:
+            return []
+        with self.lock:
+            index = self._index(thread_id)
+            chunks = []
+            total = 0
+            for segment in reversed(index['segments']):
+                if total >= n:
+                    break
+                chunks.append(self._read_segment(thread_id, segment))
+                total += segment['count']
+            messages = [msg for chunk in reversed(chunks) for msg in chunk]
+            return messages[-n:]
+
+    def range_by_time(self, thread_id, start=None, end=None):
+        """读取 [start, end] 时间段内的消息，只解析时间范围有交集的分段"""
+        with self.lock:
+            index = self._index(thread_id)
+            messages = []
+            for segment in index['segments']:
+                if start and segment['last_ts'] < start:
+                    continue
+                if end and segment['first_ts'] > end:
+                    continue
+                for msg in self._read_segment(thread_id, segment):
+                    timestamp = msg.get('timestamp', '')
+                    if (not start or timestamp >= start) and (not end or timestamp <= end):
+                        messages.append(msg)
+            return messages
+
+    def list_threads(self):
+        """列出归档中的所有对话（包括尚未导入的旧格式备份）"""
+        if not os.path.isdir(self.base_dir):
+            return []
+        threads = set()
+        for name in os.listdir(self.base_dir):
+            path = os.path.join(self.base_dir, name)
+            if os.path.isdir(path) and os.path.exists(os.path.join(path, INDEX_FILE)):
+                threads.add(name)
+            elif name.startswith("conversation_") and name.endswith(".json"):
+                threads.add(name[len("conversation_"):-len(".json")])
+        return sorted(threads)
@@ -0,0 +1,90 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+import unicodedata
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+MEMORY_CACHE_TTL = float(os.getenv('MEMORY_CACHE_TTL', '3600'))  # 缓存有效期（秒）
+MEMORY_CACHE_MAX_ENTRIES = int(os.getenv('MEMORY_CACHE_MAX_ENTRIES', '500'))
+MEMORY_CACHE_PATH = os.getenv('MEMORY_CACHE_PATH', '')  # 为空时只缓存在内存中
+
+
+def normalize_query(text):
+    """统一大小写、全半角，去掉标点和空白，使重复发送的同一个问题得到相同的键"""
+    text = unicodedata.normalize('NFKC', text).lower()
+    return "".join(ch for ch in text if not ch.isspace() and unicodedata.category(ch)[0] not in ('P', 'S'))
+
+
+class MemoryResultCache:
+    """记忆检索结果缓存，键为 (对话 ID, 历史版本, 规范化后的问题)
+
+    历史版本变化（有了新的对话）后旧结果自然失效；按 TTL 过期，按条目数 LRU 淘汰。
+    设置了 path 时同时保存到磁盘，重启后仍可使用。
+    """
+
+    def __init__(self, ttl=MEMORY_CACHE_TTL, max_entries=MEMORY_CACHE_MAX_ENTRIES, path=MEMORY_CACHE_PATH):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.path = path
+        self.entries = OrderedDict()  # 键 -> (过期时间, 结果)
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        if self.path:
+            self._load()
+
+    @staticmethod
+    def _key(thread_id, version, query):
+        raw = f"{thread_id}\n{version}\n{normalize_query(query)}"
+        return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            now = time.time()
+            for key, (expires_at, result) in data.items():
+                if expires_at > now:
+                    self.entries[key] = (expires_at, result)
+            logger.info(f"加载记忆缓存 - {len(self.entries)} 条")
+        except Exception as e:
+            logger.error(f"读取记忆缓存失败: {str(e)}")
+
+    def _save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.entries, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    def get(self, thread_id, version, query):
+        key = self._key(thread_id, version, query)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] <= time.time():
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, thread_id, version, query, result):
+        key = self._key(thread_id, version, query)
+        with self.lock:
+            self.entries[key] = (time.time() + self.ttl, result)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            if self.path:
+                try:
+                    self._save()
+                except Exception as e:
+                    logger.error(f"保存记忆缓存失败: {str(e)}")
@@ -0,0 +1,206 @@
+import os
+import re
+import json
+import logging
+import threading
+from collections import Counter
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# 索引文件目录，为空时只保存在内存中。GitHub Actions 等临时环境的磁盘在运行结束后会清空，
+# 保存下来也无法复用，每次运行第一次用到某个对话时从完整历史重新建立索引
+MEMORY_INDEX_DIR = os.getenv('MEMORY_INDEX_DIR', '')
+MEMORY_MIN_SCORE = float(os.getenv('MEMORY_MIN_SCORE', '2.0'))  # 低于该 BM25 得分的对话不算相关记忆
+
+# BM25 参数
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+# 英文单词和数字
+WORD_PATTERN = re.compile(r'[a-z0-9]+')
+# 中日韩文字
+CJK_PATTERN = re.compile(r'[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af]+')
+
+
+def tokenize(text):
+    """分词：英文按单词，中日韩文字按单字和相邻两字（不依赖分词词典）"""
+    text = text.lower()
+    tokens = WORD_PATTERN.findall(text)
+    for run in CJK_PATTERN.findall(text):
+        tokens.extend(run)
+        tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+
+class ThreadIndex:
+    """单个对话的 BM25 索引，文档是一问一答的消息对"""
+
+    def __init__(self):
+        self.pairs = []  # [{'u': 用户消息, 'a': 回复, 't': 时间}]
+        self.postings = {}  # 词 -> ([文档序号], [词频])
+        self.lengths = []
+        self.length_array = None  # 文档长度的 NumPy 数组，新增文档后重建
+        self.pending_user = []  # 还没有收到回复的用户消息
+
+    def add_pair(self, pair):
+        doc_id = len(self.pairs)
+        self.pairs.append(pair)
+        counts = Counter(tokenize(f"{pair['u']} {pair['a']}"))
+        for term, tf in counts.items():
+            docs, tfs = self.postings.setdefault(term, ([], []))
+            docs.append(doc_id)
+            tfs.append(tf)
+        self.lengths.append(sum(counts.values()))
+        self.length_array = None
+
+    def add_message(self, role, content, timestamp=''):
+        """按消息顺序更新索引，收到回复时把前面的用户消息和回复组成一个文档
+
+        Returns:
+            新增的消息对，没有新增时返回 None
+        """
+        if role == 'user':
+            self.pending_user.append(content)
+            return None
+        if role != 'assistant' or not self.pending_user:
+            return None
+        pair = {'u': "\n".join(self.pending_user), 'a': content, 't': timestamp}
+        self.pending_user = []
+        self.add_pair(pair)
+        return pair
+
+    def search(self, query, k, min_score=0.0):
+        """返回得分最高、且不低于 min_score 的至多 k 个消息对的序号（按得分从高到低）
+
+        只共有一两个常见字的消息对得分很低，设置 min_score 后可以返回空结果，表示没有相关记忆。
+        """
+        terms = set(tokenize(query))
+        if not self.pairs or not terms:
+            return []
+        if self.length_array is None:
+            self.length_array = np.array(self.lengths, dtype=np.float64)
+        lengths = self.length_array
+        n = len(self.pairs)
+        norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths / max(lengths.mean(), 1.0))
+
+        scores = np.zeros(n)
+        for term in terms:
+            posting = self.postings.get(term)
+            if posting is None:
+                continue
+            docs = np.array(posting[0])
+            tfs = np.array(posting[1], dtype=np.float64)
+            idf = np.log(1 + (n - len(docs) + 0.5) / (len(docs) + 0.5))
+            scores[docs] += idf * tfs * (BM25_K1 + 1) / (tfs + norm[docs])
+
+        scores[scores < min_score] = 0
+        k = min(k, int(np.count_nonzero(scores)))
+        if k <= 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        return top[np.argsort(-scores[top])].tolist()
+
+
+class MemoryIndex:
+    """本地记忆检索：每个对话一个 BM25 索引，代替把完整历史发给记忆 AI
+
+    设置了 base_dir 时，消息对以 JSONL 追加保存在 {base_dir}/{thread_id}.jsonl，重启后直接加载；
+    否则索引只在内存中。没有索引的对话需要先用 build() 从完整历史建立一次。
+    """
+
+    def __init__(self, base_dir=MEMORY_INDEX_DIR, min_score=MEMORY_MIN_SCORE):
+        self.base_dir = base_dir
+        self.min_score = min_score
+        self.threads = {}
+        self.missing = set()  # 没有索引文件、需要从完整历史建立的对话
+        self.lock = threading.Lock()
+
+    def _path(self, thread_id):
+        return os.path.join(self.base_dir, f"{thread_id}.jsonl")
+
+    def _thread(self, thread_id):
+        index = self.threads.get(thread_id)
+        if index is not None:
+            return index
+        index = ThreadIndex()
+        path = self._path(thread_id) if self.base_dir else None
+        if path and os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        index.add_pair(json.loads(line))
+                    except ValueError:
+                        continue  # 最后一行可能没有写完
+            logger.info(f"加载记忆索引 [对话ID: ****{thread_id[-4:]}] - {len(index.pairs)} 组对话")
+        else:
+            self.missing.add(thread_id)
+        self.threads[thread_id] = index
+        return index
+
+    def _append(self, thread_id, pairs):
+        if not self.base_dir:
+            return
+        os.makedirs(self.base_dir, exist_ok=True)
+        with open(self._path(thread_id), 'a', encoding='utf-8') as f:
+            for pair in pairs:
+                f.write(json.dumps(pair, ensure_ascii=False) + "\n")
+
+    def needs_build(self, thread_id):
+        thread_id = str(thread_id)
+        with self.lock:
+            self._thread(thread_id)
+            return thread_id in self.missing
+
+    def build(self, thread_id, messages):
+        """用完整的对话历史（重新）建立索引"""
+        thread_id = str(thread_id)
+        index = ThreadIndex()
+        for msg in messages:
+            index.add_message(msg.get('role'), msg.get('content', ''), msg.get('timestamp', ''))
+        with self.lock:
+            if self.base_dir:
+                os.makedirs(self.base_dir, exist_ok=True)
+                tmp_path = self._path(thread_id) + ".tmp"
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    for pair in index.pairs:
+                        f.write(json.dumps(pair, ensure_ascii=False) + "\n")
+                os.replace(tmp_path, self._path(thread_id))
+            self.threads[thread_id] = index
+            self.missing.discard(thread_id)
+        logger.info(f"建立记忆索引 [对话ID: ****{thread_id[-4:]}] - {len(index.pairs)} 组对话")
+
+    def version(self, thread_id):
+        """索引中的对话组数，有新的一问一答后变化"""
+        thread_id = str(thread_id)
+        with self.lock:
+            return len(self._thread(thread_id).pairs)
+
+    def add_message(self, thread_id, role, content, timestamp=''):
+        """新消息写入对话历史后调用，增量更新索引"""
+        thread_id = str(thread_id)
+        try:
+            with self.lock:
+                index = self._thread(thread_id)
+                pair = index.add_message(role, content, timestamp)
+                if pair is not None and thread_id not in self.missing:
+                    self._append(thread_id, [pair])
+        except Exception as e:
+            logger.error(f"更新记忆索引失败: {str(e)}")
+
+    def search(self, thread_id, query, k=5):
+        """检索与 query 最相关的 k 组对话
+
+        Returns:
+            按时间顺序排列的消息列表 [{'role': 'user', ...}, {'role': 'assistant', ...}, ...]
+        """
+        thread_id = str(thread_id)
+        with self.lock:
+            index = self._thread(thread_id)
+            doc_ids = sorted(index.search(query, k, self.min_score))
+            pairs = [index.pairs[doc_id] for doc_id in doc_ids]
+        messages = []
+        for pair in pairs:
+            messages.append({"role": "user", "content": pair['u']})
+            messages.append({"role": "assistant", "content": pair['a']})
+        return messages
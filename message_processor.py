@@ -5,10 +5,8 @@ import random
 import time
 import os
 from dotenv import load_dotenv
-import firebase_admin
-from firebase_admin import credentials
-from firebase_admin import db
-import base64
+from chat_history import ChatHistoryManager
+from rule_engine import RuleEngine
 
 # 加载环境变量
 load_dotenv()
@@ -17,132 +15,12 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-class ChatHistoryManager:
-    def __init__(self):
-        """初始化 Firebase 连接"""
-        try:
-            firebase_cred_base64 = os.getenv('FIREBASE_CREDENTIALS_BASE64')
-            firebase_url = os.getenv('FIREBASE_DATABASE_URL')
-            
-            if not firebase_cred_base64 or not firebase_url:
-                logger.error("Firebase 配置未找到")
-                return
-                
-            try:
-                cred_json = base64.b64decode(firebase_cred_base64).decode('utf-8')
-                cred_dict = json.loads(cred_json)
-                logger.info("Firebase 凭证解码成功")
-            except Exception as e:
-                logger.error(f"Firebase 凭证解码失败: {str(e)}")
-                return
-                
-            logger.info("初始化 Firebase 连接...")
-            cred = credentials.Certificate(cred_dict)
-            firebase_admin.initialize_app(cred, {
-                'databaseURL': firebase_url
-            })
-            logger.info("Firebase 连接成功")
-            
-            self.conversations = {}
-            self.ref = db.reference('chat_histories')
-            
-        except Exception as e:
-            logger.error(f"初始化 Firebase 失败: {str(e)}")
-
-    def save_conversation(self, thread_id):
-        """保存对话到 Firebase"""
-        thread_id = str(thread_id)
-        if thread_id not in self.conversations:
-            return
-            
-        conversation = self.conversations[thread_id]
-        if not conversation:
-            return
-            
-        try:
-            logger.info(f"保存对话到 Firebase [对话ID: {thread_id}]")
-            self.ref.child(thread_id).set(conversation)
-            logger.info("保存成功")
-            
-            # 保存本地备份
-            local_dir = "chat_histories"
-            os.makedirs(local_dir, exist_ok=True)
-            local_file = os.path.join(local_dir, f"conversation_{thread_id}.json")
-            with open(local_file, 'w', encoding='utf-8') as f:
-                json.dump(conversation, f, ensure_ascii=False, indent=2)
-            logger.info(f"保存本地备份: {local_file}")
-            
-        except Exception as e:
-            logger.error(f"保存对话失败 [对话ID: {thread_id}]: {str(e)}")
-
-    def load_conversation(self, thread_id):
-        """从 Firebase 加载对话"""
-        thread_id = str(thread_id)
-        logger.info(f"尝试从 Firebase 加载对话 [对话ID: {thread_id}]")
-        
-        try:
-            conversation = self.ref.child(thread_id).get()
-            if conversation:
-                logger.info(f"成功从 Firebase 加载对话 - {len(conversation)} 条消息")
-                self.conversations[thread_id] = conversation
-                return conversation
-                
-            logger.info("Firebase 中未找到数据，尝试从本地加载")
-            local_file = f"chat_histories/conversation_{thread_id}.json"
-            if os.path.exists(local_file):
-                with open(local_file, 'r', encoding='utf-8') as f:
-                    conversation = json.load(f)
-                logger.info(f"成功从本地加载对话 - {len(conversation)} 条消息")
-                self.ref.child(thread_id).set(conversation)
-                logger.info("已同步本地数据到 Firebase")
-                self.conversations[thread_id] = conversation
-                return conversation
-                
-            logger.info("未找到对话历史")
-            return []
-            
-        except Exception as e:
-            logger.error(f"加载对话失败: {str(e)}")
-            return []
-
-    def add_message(self, thread_id, role, content, metadata=None):
-        """添加新消息到对话历史"""
-        if not content or content.strip() == "***":
-            return
-            
-        thread_id = str(thread_id)
-        masked_thread_id = f"****{thread_id[-4:]}"
-        
-        if thread_id not in self.conversations:
-            self.conversations[thread_id] = []
-            
-        message = {
-            'timestamp': datetime.now().isoformat(),
-            'role': role,
-            'content': content
-        }
-        if metadata:
-            message['metadata'] = metadata
-            
-        self.conversations[thread_id].append(message)
-            
-        try:
-            ref = db.reference(f'chat_histories/{thread_id}')
-            current_messages = ref.get() or []
-            current_messages.append(message)
-            ref.set(current_messages)
-            logger.info(f"已保存消息到 Firebase [对话ID: {masked_thread_id}]")
-        except Exception as e:
-            logger.error(f"保存到 Firebase 失败: {str(e)}")
-            if thread_id in self.conversations:
-                self.conversations[thread_id].pop()
-            return
-        
-        logger.info(f"添加新消息 [对话ID: {masked_thread_id}] - {role}: ***")
+RECENT_HISTORY_SIZE = 10  # 生成回复时参考的最近消息数
 
 class ChatCore:
     def __init__(self):
-        self.chat_history = ChatHistoryManager()
+        self.chat_history = ChatHistoryManager(backup_dir="chat_histories")
+        self.rules = RuleEngine.load()
         self.system_prompt = """# 角色设定与交互规则
 
 ## 基本角色
@@ -178,9 +56,9 @@ class ChatCore:
         try:
             logger.info(f"开始处理对话 [对话ID: {thread_id}]")
             
-            # 加载历史对话
+            # 加载最近的历史对话（generate_reply 只使用最近 10 条）
             try:
-                conversation = self.chat_history.load_conversation(thread_id)
+                conversation = self.chat_history.load_conversation(thread_id, last_n=RECENT_HISTORY_SIZE)
                 logger.info(f"加载历史对话 - {len(conversation)} 条消息")
             except Exception as e:
                 logger.error(f"加载历史对话时出错: {str(e)}")
@@ -198,27 +76,14 @@ class ChatCore:
     def generate_reply(self, message, history):
         """生成回复"""
         # 1. 分析最近的对话历史
-        recent_history = history[-10:]  # 只看最近的10条消息
+        recent_history = history[-RECENT_HISTORY_SIZE:]  # 只看最近的10条消息
         
-        # 2. 根据消息内容和历史生成合适的回复
-        if any(word in message for word in ["你好", "hi", "hello"]):
-            return "你好啊！今天过得怎么样？"
-            
-        if "天气" in message:
-            return "今天天气确实不错，适合出去走走。你喜欢户外活动吗？"
-            
-        if any(word in message for word in ["谢谢", "thanks"]):
-            return "不客气！很高兴能帮到你。"
-            
-        # 3. 检查历史对话中的上下文
-        if recent_history:
-            last_bot_message = next((msg for msg in reversed(recent_history) 
-                                   if msg["role"] == "assistant"), None)
-            if last_bot_message:
-                if "户外活动" in last_bot_message["content"] and "喜欢" in message:
-                    return "那太好了！我也很喜欢户外活动。你最常去哪里玩呢？"
+        # 2. 快速回复规则（问候、感谢等），结合上一条回复判断上下文，不需要等待
+        reply = self.rules.match(message, recent_history)
+        if reply is not None:
+            return reply
         
-        # 4. 默认回复
+        # 3. 默认回复
         default_replies = [
             "这个话题很有趣，能说得更具体一些吗？",
             "我明白你的意思了，要不要聊聊你的其他想法？",
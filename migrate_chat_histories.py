@@ -0,0 +1,67 @@
+"""把 chat_histories 下的对话迁移为按月分区的格式（chat_histories/{thread_id}/{yyyy-mm}/{push ID}）
+
+用法（迁移前先停止机器人，避免迁移期间写入的消息丢失）：
+    python migrate_chat_histories.py               # 迁移所有对话
+    python migrate_chat_histories.py <对话ID> ...   # 只迁移指定对话
+
+迁移完成后设置 CHAT_FIREBASE_LAYOUT=monthly 启用按月分区读写。
+"""
+import sys
+import logging
+from dotenv import load_dotenv
+from chat_storage import FirebaseStorage, MonthlyFirebaseStorage
+
+# 加载环境变量
+load_dotenv()
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+
+def migrate_thread(flat, monthly, thread_id):
+    """迁移单个对话
+
+    Returns:
+        bool: 是否迁移成功（已经是按月分区的对话也算成功）
+    """
+    months, has_legacy = monthly.partitions(thread_id)
+    if months and not has_legacy:
+        logger.info(f"对话已是按月分区格式，跳过 [对话ID: {thread_id}]")
+        return True
+
+    # FirebaseStorage.load 能读取旧列表、push 追加以及部分迁移的混合格式
+    messages = flat.load(thread_id)
+    if not messages:
+        logger.warning(f"对话为空，跳过 [对话ID: {thread_id}]")
+        return True
+
+    monthly.save(thread_id, messages)
+    migrated = monthly.load(thread_id)
+    if len(migrated) != len(messages):
+        logger.error(f"迁移后消息数不一致 [对话ID: {thread_id}]: {len(messages)} -> {len(migrated)}")
+        return False
+
+    months, _ = monthly.partitions(thread_id)
+    logger.info(f"迁移完成 [对话ID: {thread_id}] - {len(messages)} 条消息，{len(months)} 个月份分区")
+    return True
+
+
+def main(thread_ids):
+    flat = FirebaseStorage()
+    monthly = MonthlyFirebaseStorage()
+    thread_ids = thread_ids or flat.list_threads()
+    logger.info(f"准备迁移 {len(thread_ids)} 个对话")
+
+    failed = [thread_id for thread_id in thread_ids if not migrate_thread(flat, monthly, thread_id)]
+    if failed:
+        logger.error(f"{len(failed)} 个对话迁移失败: {', '.join(failed)}")
+        return 1
+    logger.info("所有对话迁移完成")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,116 @@
+import os
+import json
+import math
+import logging
+
+logger = logging.getLogger(__name__)
+
+# 各模型提示词的 token 预算，可用 PROMPT_BUDGET_<模型> 环境变量覆盖
+DEFAULT_BUDGETS = {
+    'gemini': 8000,
+    'lingyi': 3000,
+    'deepseek': 3000
+}
+
+
+def model_budget(model):
+    return int(os.getenv(f'PROMPT_BUDGET_{model.upper()}', str(DEFAULT_BUDGETS.get(model, 3000))))
+
+
+def _is_cjk(ch):
+    return '\u3040' <= ch <= '\u30ff' or '\u3400' <= ch <= '\u9fff' or '\uac00' <= ch <= '\ud7af'
+
+
+def estimate_tokens(text):
+    """粗略估算 token 数：中日韩文字每字约 1 个 token，其他字符约 4 个一个 token"""
+    cjk = sum(1 for ch in text if _is_cjk(ch))
+    return cjk + math.ceil((len(text) - cjk) / 4)
+
+
+def compact_history(messages):
+    """把消息列表压缩成 "用户: ..." / "我: ..." 的文本行
+
+    去掉时间戳、元数据等字段，连续重复的消息只保留一条。
+    """
+    lines = []
+    last = None
+    for msg in messages:
+        content = (msg.get('content') or '').strip()
+        if not content:
+            continue
+        line = f"{'用户' if msg.get('role') == 'user' else '我'}: {content}"
+        if line != last:
+            lines.append(line)
+        last = line
+    return lines
+
+
+def fit_lines(lines, budget):
+    """保留预算内最近的若干行"""
+    kept = []
+    used = 0
+    for line in reversed(lines):
+        tokens = estimate_tokens(line) + 1
+        if used + tokens > budget:
+            break
+        kept.append(line)
+        used += tokens
+    kept.reverse()
+    return kept
+
+
+def _report(name, baseline, prompt):
+    baseline_bytes = len(baseline.encode('utf-8'))
+    prompt_bytes = len(prompt.encode('utf-8'))
+    baseline_tokens = estimate_tokens(baseline)
+    prompt_tokens = estimate_tokens(prompt)
+    logger.debug(f"{name} 提示词 {prompt_bytes} 字节 / 约 {prompt_tokens} tokens，"
+                 f"节省 {baseline_bytes - prompt_bytes} 字节 / 约 {baseline_tokens - prompt_tokens} tokens")
+
+
+def build_history_prompt(template, history, question, model):
+    """生成包含对话历史的提示词
+
+    template 中的 {history} 替换为压缩后的历史（只出现一次），{question} 替换为当前问题；
+    历史超出模型预算时丢弃最早的部分。
+
+    Returns:
+        str: 提示词
+    """
+    fixed = template.replace('{history}', '').replace('{question}', question)
+    budget = max(model_budget(model) - estimate_tokens(fixed), 0)
+    lines = compact_history(history)
+    kept = fit_lines(lines, budget)
+    if len(kept) < len(lines):
+        logger.info(f"对话历史超出预算，保留最近 {len(kept)}/{len(lines)} 条")
+    prompt = template.replace('{question}', question).replace('{history}', "\n".join(kept))
+
+    # 与原来的整段 JSON（indent=2）格式比较；序列化整个历史开销不小，只在调试日志打开时计算
+    if logger.isEnabledFor(logging.DEBUG):
+        baseline = template.replace('{question}', question).replace(
+            '{history}', json.dumps(history, ensure_ascii=False, indent=2)
+        )
+        _report(model, baseline, prompt)
+    return prompt
+
+
+def fit_messages(messages, model):
+    """把聊天消息裁剪到模型预算内：保留第一条系统提示词和最后一条消息，从最早的历史开始丢弃
+
+    Returns:
+        list: 裁剪后的消息列表（只含 role/content）
+    """
+    cleaned = [{'role': msg['role'], 'content': msg['content']} for msg in messages]
+    budget = model_budget(model)
+    total = sum(estimate_tokens(msg['content']) + 4 for msg in cleaned)
+    if total <= budget or len(cleaned) <= 2:
+        return cleaned
+
+    head, middle, tail = cleaned[:1], cleaned[1:-1], cleaned[-1:]
+    dropped = 0
+    while middle and total > budget:
+        total -= estimate_tokens(middle[0]['content']) + 4
+        middle.pop(0)
+        dropped += 1
+    logger.info(f"消息超出 {model} 预算，丢弃最早的 {dropped} 条历史，约 {total} tokens")
+    return head + middle + tail
@@ -0,0 +1,192 @@
+import os
+import time
+import random
+import logging
+import threading
+from email.utils import parsedate_to_datetime
+import requests
+import http_client
+
+logger = logging.getLogger(__name__)
+
+# 重试配置
+RETRY_MAX_ATTEMPTS = int(os.getenv('RETRY_MAX_ATTEMPTS', '3'))  # 每次调用最多尝试次数（含第一次）
+RETRY_BASE_DELAY = float(os.getenv('RETRY_BASE_DELAY', '0.5'))  # 退避基数（秒），第 n 次重试最多等待 基数 * 2^n
+RETRY_MAX_DELAY = float(os.getenv('RETRY_MAX_DELAY', '8'))  # 单次退避上限（秒）
+LLM_SLO = float(os.getenv('LLM_SLO', '30'))  # 一次调用（含重试）的延迟目标，预计超过时不再重试（秒）
+
+# 熔断配置
+BREAKER_FAILURES = int(os.getenv('BREAKER_FAILURES', '5'))  # 连续失败多少次后熔断
+BREAKER_RESET = float(os.getenv('BREAKER_RESET', '30'))  # 熔断多久后放行一次试探请求（秒）
+
+# 可以重试的状态码：限流和服务端临时错误
+RETRYABLE_STATUS = {408, 425, 429, 500, 502, 503, 504}
+
+
+class ProviderError(Exception):
+    """模型服务商返回了非 200 状态码"""
+
+    def __init__(self, provider, status_code, text='', retry_after=None):
+        super().__init__(f"{provider} API 错误 [状态码: {status_code}]: {text[:200]}")
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class CircuitOpenError(Exception):
+    """服务商处于熔断状态，调用直接失败"""
+
+
+def parse_retry_after(value):
+    """解析 Retry-After 响应头（秒数或 HTTP 日期），返回需要等待的秒数"""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def check_response(provider, response):
+    """状态码不是 200 时抛出 ProviderError"""
+    if response.status_code != 200:
+        raise ProviderError(
+            provider, response.status_code, response.text,
+            parse_retry_after(response.headers.get('Retry-After'))
+        )
+    return response
+
+
+def is_retryable(error):
+    if isinstance(error, ProviderError):
+        return error.status_code in RETRYABLE_STATUS
+    return isinstance(error, (requests.exceptions.Timeout, requests.exceptions.ConnectionError))
+
+
+class CircuitBreaker:
+    """单个服务商的熔断器
+
+    连续 BREAKER_FAILURES 次临时性失败后熔断，熔断期间调用直接失败；
+    BREAKER_RESET 秒后放行一次试探请求，成功则恢复，失败则继续熔断。
+    """
+
+    def __init__(self, name, failures=BREAKER_FAILURES, reset=BREAKER_RESET):
+        self.name = name
+        self.max_failures = failures
+        self.reset = reset
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.lock = threading.Lock()
+
+    def available(self):
+        """是否可以发出请求（不占用试探名额）"""
+        with self.lock:
+            return self.opened_at is None or (not self.probing and time.time() - self.opened_at >= self.reset)
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if self.probing or time.time() - self.opened_at < self.reset:
+                return False
+            self.probing = True
+            logger.info(f"{self.name} 熔断 {self.reset:.0f} 秒后放行试探请求")
+            return True
+
+    def record_success(self):
+        with self.lock:
+            if self.opened_at is not None:
+                logger.info(f"{self.name} 已恢复，结束熔断")
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.probing or (self.opened_at is None and self.failures >= self.max_failures):
+                logger.warning(f"{self.name} 连续失败 {self.failures} 次，熔断 {self.reset:.0f} 秒")
+                self.opened_at = time.time()
+            self.probing = False
+
+    def release(self):
+        """请求以非临时性错误结束时调用，释放试探名额"""
+        with self.lock:
+            self.probing = False
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def breaker(provider):
+    with _breakers_lock:
+        if provider not in _breakers:
+            _breakers[provider] = CircuitBreaker(provider)
+        return _breakers[provider]
+
+
+def backoff_delay(attempt, retry_after=None):
+    """第 attempt 次重试前的等待时间：指数退避加全抖动，服务端给出 Retry-After 时以它为下限"""
+    delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
+
+
+def call_with_retry(provider, func, *args, max_attempts=RETRY_MAX_ATTEMPTS, slo=LLM_SLO, **kwargs):
+    """带重试和熔断地调用 func(*args, **kwargs)
+
+    只重试限流、服务端错误、超时和连接错误；等待后预计会超过延迟目标
+    （slo 与 http_client.deadline() 中较早的一个）时不再重试，直接抛出最后一次的错误，
+    由调用方尽快改用其他服务商或兜底回复。每次请求的读取超时也不超过剩余的时间。
+
+    Raises:
+        CircuitOpenError: 服务商处于熔断状态
+    """
+    circuit = breaker(provider)
+    start_time = time.time()
+    at = start_time + slo
+    outer = http_client.current_deadline()
+    if outer is not None:
+        at = min(at, outer)
+
+    attempt = 0
+    while True:
+        if not circuit.allow():
+            raise CircuitOpenError(f"{provider} 处于熔断状态，跳过调用")
+        try:
+            # 每次请求的超时时间不超过剩余的延迟预算
+            with http_client.deadline(at):
+                result = func(*args, **kwargs)
+        except Exception as e:
+            if not is_retryable(e):
+                circuit.release()
+                raise
+            circuit.record_failure()
+            attempt += 1
+            if not circuit.available():
+                raise
+            if attempt >= max_attempts:
+                logger.error(f"{provider} 重试 {attempt - 1} 次后仍然失败: {str(e)}")
+                raise
+            delay = backoff_delay(attempt, getattr(e, 'retry_after', None))
+            if time.time() + delay >= at:
+                logger.warning(f"{provider} 调用失败，重试将超过延迟目标，放弃重试: {str(e)}")
+                raise
+            logger.warning(f"{provider} 调用失败，{delay:.2f} 秒后第 {attempt} 次重试: {str(e)}")
+            time.sleep(delay)
+            continue
+        circuit.record_success()
+        if attempt:
+            logger.info(f"{provider} 第 {attempt} 次重试成功 - 总耗时 {time.time() - start_time:.3f} 秒")
+        return result
+
+
+def post_with_retry(provider, url, **kwargs):
+    """http_client.post 的重试版本，状态码不是 200 时按 ProviderError 处理"""
+    return call_with_retry(provider, lambda: check_response(provider, http_client.post(url, **kwargs)))
@@ -0,0 +1,117 @@
+import os
+import re
+import json
+import random
+import logging
+
+logger = logging.getLogger(__name__)
+
+REPLY_RULES_PATH = os.getenv('REPLY_RULES_PATH', 'reply_rules.json')  # 快速回复规则文件
+
+
+def keyword_pattern(keyword):
+    """单个关键词的正则：英文关键词按整词匹配（"hi" 不匹配 "this"），中日韩文字按子串匹配
+
+    需要和 re.ASCII 一起使用，\\b 只把英文字母、数字和下划线当作单词字符，"hi你好" 中的 hi 仍能匹配。
+    """
+    pattern = re.escape(keyword)
+    if keyword[0].isascii() and keyword[0].isalnum():
+        pattern = r'\b' + pattern
+    if keyword[-1].isascii() and keyword[-1].isalnum():
+        pattern = pattern + r'\b'
+    return pattern
+
+
+class RuleEngine:
+    """关键词快速回复规则
+
+    规则文件是一个 JSON 列表，按顺序匹配，第一条满足条件的规则生效：
+        {
+            "name": "outdoor",
+            "keywords": ["喜欢"],               # 消息包含任意一个关键词（忽略大小写，英文按整词）
+            "last_assistant": ["户外活动"],      # 可选，上一条回复包含任意一个
+            "replies": ["那太好了！..."]         # 随机选一条
+        }
+
+    所有规则的关键词编译成一个正则表达式，每条消息只扫描一次，
+    命中规则时不需要调用模型。
+    """
+
+    def __init__(self, rules):
+        self.rules = []
+        keyword_rules = {}  # 关键词 -> 规则序号
+        for index, rule in enumerate(rules):
+            keywords = [kw.lower() for kw in rule.get('keywords', []) if kw]
+            replies = rule.get('replies') or []
+            if not keywords or not replies:
+                logger.warning(f"忽略无效的回复规则: {rule.get('name', index)}")
+                continue
+            self.rules.append({
+                'name': rule.get('name', str(index)),
+                'last_assistant': [text.lower() for text in rule.get('last_assistant', [])],
+                'replies': replies
+            })
+            for keyword in keywords:
+                keyword_rules.setdefault(keyword, set()).add(len(self.rules) - 1)
+
+        # 每个位置只报告最长的关键词，这里预先算出它匹配时同样会匹配的其他关键词
+        patterns = {keyword: keyword_pattern(keyword) for keyword in keyword_rules}
+        self.implied = {
+            keyword: {other for other in keyword_rules if re.search(patterns[other], keyword, re.ASCII)}
+            for keyword in keyword_rules
+        }
+        self.keyword_rules = keyword_rules
+        if keyword_rules:
+            alternation = "|".join(patterns[kw] for kw in sorted(keyword_rules, key=len, reverse=True))
+            # 前瞻匹配，每个位置都尝试一次，允许关键词相互重叠
+            self.pattern = re.compile(f"(?=({alternation}))", re.ASCII)
+        else:
+            self.pattern = None
+
+    @classmethod
+    def load(cls, path=REPLY_RULES_PATH):
+        """从规则文件加载，文件不存在或格式错误时返回没有规则的引擎"""
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                rules = json.load(f)
+            engine = cls(rules)
+            logger.info(f"加载快速回复规则 - {len(engine.rules)} 条")
+            return engine
+        except FileNotFoundError:
+            logger.warning(f"未找到快速回复规则文件: {path}")
+        except Exception as e:
+            logger.error(f"读取快速回复规则失败: {str(e)}")
+        return cls([])
+
+    def match(self, message, history=None):
+        """匹配快速回复
+
+        Args:
+            history: 最近的对话历史，用于判断上一条回复
+
+        Returns:
+            str: 回复内容，没有匹配的规则时返回 None
+        """
+        if self.pattern is None:
+            return None
+        matched = set()
+        for found in self.pattern.finditer(message.lower()):
+            matched |= self.implied[found.group(1)]
+        if not matched:
+            return None
+
+        candidates = sorted(set().union(*(self.keyword_rules[kw] for kw in matched)))
+        last_assistant = None
+        for index in candidates:
+            rule = self.rules[index]
+            if rule['last_assistant']:
+                if last_assistant is None:
+                    last_assistant = next(
+                        (msg.get('content', '') for msg in reversed(history or []) if msg.get('role') == 'assistant'),
+                        ''
+                    ).lower()
+                if not any(text in last_assistant for text in rule['last_assistant']):
+                    continue
+            logger.info(f"命中快速回复规则: {rule['name']}")
+            return random.choice(rule['replies'])
+        return None
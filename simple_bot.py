@@ -3,13 +3,16 @@ import json
 import time
 import logging
 import random
+import threading
 from datetime import datetime
 import base64
 from dotenv import load_dotenv
-import requests
-import firebase_admin
-from firebase_admin import credentials
 from firebase_admin import db
+from chat_storage import normalize_conversation
+from chat_history import ChatHistoryManager
+from prompt_builder import build_history_prompt
+from llm_router import lingyi_completion
+from resilience import post_with_retry
 from cryptography.fernet import Fernet
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
@@ -20,6 +23,9 @@ load_dotenv()
 # 配置日志
 LOG_LEVEL = os.getenv('LOG_LEVEL', 'ERROR')
 HIDE_CHAT_CONTENT = os.getenv('HIDE_CHAT_CONTENT', 'false').lower() == 'true'
+# 监听对话的新写入，关闭时每5秒轮询一次
+WATCH_MODE = os.getenv('SIMPLE_BOT_WATCH', 'true').lower() == 'true'
+IDLE_TIMEOUT = 60  # 超过该时间没有新的用户消息就退出（秒）
 
 # 配置日志格式
 class CustomFormatter(logging.Formatter):
@@ -97,171 +103,29 @@ def log_function_call(func):
             raise
     return wrapper
 
-class ChatHistoryManager:
-    def __init__(self):
-        """初始化 Firebase 连接"""
-        try:
-            # 从环境变量获取 Firebase 配置
-            firebase_cred_base64 = os.getenv('FIREBASE_CREDENTIALS_BASE64')
-            firebase_url = os.getenv('FIREBASE_DATABASE_URL')
-            
-            if not firebase_cred_base64 or not firebase_url:
-                logger.error("Firebase 配置未找到")
-                return
-                
-            # 解码 base64 凭证
-            try:
-                cred_json = base64.b64decode(firebase_cred_base64).decode('utf-8')
-                cred_dict = json.loads(cred_json)
-                logger.info("Firebase 凭证解码成功")
-            except Exception as e:
-                logger.error(f"Firebase 凭证解码失败: {str(e)}")
-                return
-                
-            # 初始化 Firebase
-            logger.info("初始化 Firebase 连接...")
-            cred = credentials.Certificate(cred_dict)
-            firebase_admin.initialize_app(cred, {
-                'databaseURL': firebase_url
-            })
-            logger.info("Firebase 连接成功")
-            
-            self.conversations = {}
-            self.ref = db.reference('chat_histories')
-            
-        except Exception as e:
-            logger.error(f"初始化 Firebase 失败: {str(e)}")
-
-    def save_conversation(self, thread_id):
-        """保存对话到 Firebase"""
-        thread_id = str(thread_id)
-        if thread_id not in self.conversations:
-            return
-            
-        conversation = self.conversations[thread_id]
-        if not conversation:
-            return
-            
-        try:
-            logger.info(f"保存对话到 Firebase [对话ID: {thread_id}]")
-            self.ref.child(thread_id).set(conversation)
-            logger.info("保存成功")
-            
-        except Exception as e:
-            logger.error(f"保存对话失败 [对话ID: {thread_id}]: {str(e)}")
-
-    def load_conversation(self, thread_id):
-        """从 Firebase 加载对话"""
-        thread_id = str(thread_id)
-        logger.info(f"尝试从 Firebase 加载对话 [对话ID: {thread_id}]")
-        
-        try:
-            conversation = self.ref.child(thread_id).get()
-            if conversation:
-                logger.info(f"成功从 Firebase 加载对话 - {len(conversation)} 条消息")
-                self.conversations[thread_id] = conversation
-                return conversation
-                
-            logger.info("未找到对话历史")
-            return []
-            
-        except Exception as e:
-            logger.error(f"加载对话失败: {str(e)}")
-            return []
-
-    def add_message(self, thread_id, role, content, metadata=None):
-        """添加新消息到对话历史"""
-        if not content or content.strip() == "***":
-            return
-            
-        thread_id = str(thread_id)
-        masked_thread_id = f"****{thread_id[-4:]}"
-        
-        if thread_id not in self.conversations:
-            self.conversations[thread_id] = []
-            
-        message = {
-            'timestamp': datetime.now().isoformat(),
-            'role': role,
-            'content': content
-        }
-        if metadata:
-            message['metadata'] = metadata
-            
-        self.conversations[thread_id].append(message)
-            
-        try:
-            ref = db.reference(f'chat_histories/{thread_id}')
-            current_messages = ref.get() or []
-            current_messages.append(message)
-            ref.set(current_messages)
-            logger.info(f"已保存消息到 Firebase [对话ID: {masked_thread_id}]")
-        except Exception as e:
-            logger.error(f"保存到 Firebase 失败: {str(e)}")
-            if thread_id in self.conversations:
-                self.conversations[thread_id].pop()
-            return
-        
-        logger.info(f"添加新消息 [对话ID: {masked_thread_id}] - {role}: ***")
-
 @log_function_call
-def create_chat_completion(messages, max_retries=3, retry_delay=2):
-    """创建聊天回复，使用灵医万物 API"""
-    retries = 0
-    while retries < max_retries:
-        try:
-            logger.info(f"尝试调用灵医万物 API [尝试次数: {retries + 1}/{max_retries}]")
-            logger.debug(f"请求参数: {json.dumps(messages, ensure_ascii=False)}")
-            
-            response = requests.post(
-                os.getenv('LINGYI_API_BASE', 'https://api.lingyiwanwu.com/v1/chat/completions'),
-                headers={
-                    "Authorization": f"Bearer {os.getenv('LINGYI_API_KEY')}",
-                    "Content-Type": "application/json"
-                },
-                json={
-                    "model": "yi-34b-chat-0205",
-                    "messages": messages,
-                    "temperature": 0.7,
-                    "max_tokens": 1000
-                }
-            )
-            
-            logger.debug(f"API响应状态码: {response.status_code}")
-            logger.debug(f"API响应内容: {response.text}")
-            
-            if response.status_code == 200:
-                result = response.json()["choices"][0]["message"]["content"]
-                logger.info("API调用成功")
-                logger.debug(f"生成的回复: {result}")
-                return result
-                
-            logger.error(f"API 错误 [状态码: {response.status_code}]")
-            logger.error(f"错误响应: {response.text}")
-            
-            if response.status_code == 500:
-                if retries < max_retries - 1:
-                    logger.warning(f"服务器错误，等待 {retry_delay} 秒后重试")
-                    time.sleep(retry_delay)
-                    retries += 1
-                    continue
-            
-            return "抱歉，我现在有点忙，稍后再试好吗？😭"
-                
-        except Exception as e:
-            logger.error(f"API 调用异常: {str(e)}", exc_info=True)
-            if retries < max_retries - 1:
-                logger.info(f"等待 {retry_delay} 秒后重试")
-                time.sleep(retry_delay)
-                retries += 1
-                continue
-            break
-            
-    return "抱歉，我现在有点忙，稍后再试好吗？😭"
+def create_chat_completion(messages):
+    """创建聊天回复，使用灵医万物 API（重试、退避和熔断由 resilience.call_with_retry 处理）"""
+    try:
+        logger.info("调用灵医万物 API")
+        logger.debug(f"请求参数: {json.dumps(messages, ensure_ascii=False)}")
+        result = lingyi_completion(messages)
+        logger.info("API调用成功")
+        logger.debug(f"生成的回复: {result}")
+        return result
+    except Exception as e:
+        logger.error(f"API 调用失败: {str(e)}")
+        return "抱歉，我现在有点忙，稍后再试好吗？😭"
 
 @log_function_call
-def call_memory_ai(messages):
-    """调用 Gemini 1.5 Flash 作为记忆 AI"""
+def call_memory_ai(messages, chat_history=None):
+    """调用 Gemini 1.5 Flash 作为记忆 AI
+
+    Args:
+        messages: [系统提示词, 带 thread_id 元数据的用户消息]
+        chat_history: 读取对话历史的 ChatHistoryManager（包含尚未写入存储的消息），
+            默认直接读取 Firebase
+    """
     try:
         logger.info("使用 Gemini Flash API 调用记忆管理")
         
@@ -290,8 +154,10 @@ def call_memory_ai(messages):
             logger.debug(f"完整消息结构: {json.dumps(messages, ensure_ascii=False, indent=2)}")
             return "none"
             
-        ref = db.reference(f'chat_histories/{thread_id}')
-        conversation = ref.get()
+        if chat_history is not None:
+            conversation = chat_history.load_conversation(thread_id)
+        else:
+            conversation = normalize_conversation(db.reference(f'chat_histories/{thread_id}').get())
         
         if not conversation:
             logger.warning(f"未找到对话历史 [对话ID: {thread_id}]")
@@ -339,16 +205,19 @@ def call_memory_ai(messages):
    - 即使用词相似，也要确保上下文主题相同
 
 对话历史：
-{0}
+{history}
 
-当前问题：{1}
+当前问题：{question}
 
-请分析对话历史并按要求返回相关对话片段。""".format(json.dumps(conversation, ensure_ascii=False, indent=2), user_prompt)
+请分析对话历史并按要求返回相关对话片段。"""
+        # 用 replace 而不是 format，示例中的 JSON 花括号不需要转义
+        prompt = build_history_prompt(prompt, conversation, user_prompt, 'gemini')
         
         logger.info("发送请求到 Gemini API...")
         
         # 调用 Gemini API
-        response = requests.post(
+        response = post_with_retry(
+            'gemini',
             'https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-flash:generateContent',
             headers={
                 'x-goog-api-key': api_key,
@@ -387,42 +256,37 @@ def call_memory_ai(messages):
             }
         )
         
-        if response.status_code == 200:
-            result = response.json()
-            response_text = result['candidates'][0]['content']['parts'][0]['text']
-            logger.info("Gemini API 响应成功")
-            logger.info(f"响应内容: {response_text[:200]}...")
-            
-            # 验证和格式化返回结果
-            try:
-                # 清理响应文本，只保留 JSON 部分
-                json_text = response_text.strip()
-                if json_text.startswith('```json'):
-                    json_text = json_text[7:]
-                if json_text.endswith('```'):
-                    json_text = json_text[:-3]
-                json_text = json_text.strip()
-                
-                # 如果返回的是 "none"，直接返回
-                if json_text.strip('"') == "none":
-                    return "none"
-                    
-                # 尝试解析 JSON
-                if json_text.startswith('['):
-                    memory_list = json.loads(json_text)
-                    # 验证格式是否正确
-                    if all(isinstance(msg, dict) and 'role' in msg and 'content' in msg for msg in memory_list):
-                        return json.dumps(memory_list, ensure_ascii=False)
-                
-                logger.warning("记忆AI返回格式无效，返回 none")
-                return "none"
-                
-            except json.JSONDecodeError as e:
-                logger.error(f"JSON 解析失败: {str(e)}")
+        result = response.json()
+        response_text = result['candidates'][0]['content']['parts'][0]['text']
+        logger.info("Gemini API 响应成功")
+        logger.info(f"响应内容: {response_text[:200]}...")
+        
+        # 验证和格式化返回结果
+        try:
+            # 清理响应文本，只保留 JSON 部分
+            json_text = response_text.strip()
+            if json_text.startswith('```json'):
+                json_text = json_text[7:]
+            if json_text.endswith('```'):
+                json_text = json_text[:-3]
+            json_text = json_text.strip()
+        
+            # 如果返回的是 "none"，直接返回
+            if json_text.strip('"') == "none":
                 return "none"
-        else:
-            logger.error(f"Gemini API 错误: {response.status_code}")
-            logger.error(f"错误信息: {response.text}")
+        
+            # 尝试解析 JSON
+            if json_text.startswith('['):
+                memory_list = json.loads(json_text)
+                # 验证格式是否正确
+                if all(isinstance(msg, dict) and 'role' in msg and 'content' in msg for msg in memory_list):
+                    return json.dumps(memory_list, ensure_ascii=False)
+        
+            logger.warning("记忆AI返回格式无效，返回 none")
+            return "none"
+        
+        except json.JSONDecodeError as e:
+            logger.error(f"JSON 解析失败: {str(e)}")
             return "none"
             
     except Exception as e:
@@ -432,7 +296,8 @@ def call_memory_ai(messages):
 class SimpleBot:
     def __init__(self):
         logger.info("初始化 SimpleBot")
-        self.chat_history = ChatHistoryManager()
+        # 目标对话由其他进程写入新消息，每次读取都需要做版本校验
+        self.chat_history = ChatHistoryManager(cache_ttl=0)
         self.target_thread = "340282366841710301244276017723107508377"
         logger.info(f"目标对话ID: {self.target_thread}")
         
@@ -443,10 +308,6 @@ class SimpleBot:
             logger.info(f"开始处理对话 [对话ID: {thread_id}]")
             logger.debug(f"用户消息: {message}")
             
-            # 加载历史对话
-            conversation = self.chat_history.load_conversation(thread_id)
-            logger.info(f"加载历史对话 - {len(conversation)} 条消息")
-            
             # 构建消息
             messages = []
             
@@ -495,7 +356,7 @@ class SimpleBot:
                     }
                 }
             ]
-            memory_response = call_memory_ai(memory_messages)
+            memory_response = call_memory_ai(memory_messages, self.chat_history)
             
             # 处理记忆结果
             if memory_response != "none":
@@ -554,17 +415,67 @@ class SimpleBot:
             logger.error(f"处理消息失败: {str(e)}", exc_info=True)
             return "抱歉，处理消息时出错了"
 
+    def run_watch(self):
+        """事件驱动模式：对话有新写入时才检查最新消息
+
+        Returns:
+            bool: 监听无法启动时返回 False，由调用方改用轮询
+        """
+        thread_id = self.target_thread
+        changed = threading.Event()
+        try:
+            watcher = self.chat_history.watch(thread_id, changed.set)
+        except Exception as e:
+            logger.error(f"启动对话监听失败，改用轮询: {str(e)}")
+            return False
+
+        logger.info("已启动对话监听，等待新消息...")
+        try:
+            idle_start = time.time()
+            while True:
+                remaining = IDLE_TIMEOUT - (time.time() - idle_start)
+                if remaining <= 0:
+                    logger.info("超过1分钟没有新消息，退出程序")
+                    return True
+                if not changed.wait(remaining):
+                    continue
+                changed.clear()
+
+                # 通知只表示有写入（也包括自己的回复），只读取最后一条消息确认
+                conversation = self.chat_history.load_conversation(thread_id, last_n=1)
+                if not conversation:
+                    logger.info("未找到对话历史，退出")
+                    return True
+
+                latest_message = conversation[-1]
+                logger.info(f"最新消息 - 角色: {latest_message.get('role')}")
+                if latest_message.get('role') != 'user':
+                    continue
+
+                message = latest_message.get('content', '')
+                logger.info("检测到新的用户消息，开始处理")
+                logger.debug(f"消息内容: {message}")
+                response = self.handle_message(message)
+                logger.info(f"机器人回复: {response}")
+                logger.info("消息处理完成")
+                idle_start = time.time()
+        finally:
+            watcher.close()
+
     def run(self):
         """运行机器人"""
         logger.info("机器人启动...")
         
         try:
+            if WATCH_MODE and self.run_watch():
+                return
+
             no_message_start_time = None  # 记录开始无消息的时间
             
             while True:
-                # 加载对话历史
+                # 只加载最新一条消息
                 thread_id = self.target_thread
-                conversation = self.chat_history.load_conversation(thread_id)
+                conversation = self.chat_history.load_conversation(thread_id, last_n=1)
                 
                 if not conversation:
                     logger.info("未找到对话历史，退出")
@@ -0,0 +1,203 @@
+import os
+import copy
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_EVERY = int(os.getenv('SUMMARY_EVERY', '20'))  # 每积累多少条新消息更新一次摘要
+RECENT_DAYS = 3  # 提示词中包含的最近几天的日摘要
+RECENT_MONTHS = 3  # 提示词中包含的最近几个月的月摘要
+
+# 各层摘要的字数上限
+RUNNING_CHARS = 200
+DAY_CHARS = 100
+MONTH_CHARS = 150
+
+
+def _format_messages(messages):
+    return "\n".join(f"{'用户' if msg['r'] == 'user' else '我'}: {msg['c']}" for msg in messages)
+
+
+class SummaryStore:
+    """分层滚动摘要：每个对话一份持续更新的总摘要，外加日摘要和月摘要
+
+    新消息先记入待摘要列表，每满 SUMMARY_EVERY 条在后台线程中调用一次摘要模型，
+    把新消息合并进总摘要和对应日期的日摘要；某个月份结束后，该月的日摘要合并为月摘要。
+    每次更新只处理新增的消息，生成回复时只带上有限长度的摘要。
+
+    摘要通过聊天记录的存储后端保存在 summaries/{thread_id}，只在生成新摘要时写入，
+    同时记录已摘要到的最后一条消息的时间 through。待摘要消息只保存在内存中，
+    重启后按 through 从存储后端的聊天记录重新取出，每次运行时间很短、本地磁盘不保留时，
+    待摘要消息也会跨运行累积到 SUMMARY_EVERY 条。
+    """
+
+    def __init__(self, summarize, storage=None, every=SUMMARY_EVERY):
+        """
+        Args:
+            summarize: summarize(text, max_chars) -> str，失败时返回空字符串
+            storage: 聊天记录存储后端（chat_storage.ChatStorage），为空时摘要只保存在内存中
+        """
+        self.summarize = summarize
+        self.storage = storage
+        self.every = every
+        self.states = {}
+        self.updating = set()
+        self.unsaved = set()  # 已修改、还没有写入存储的对话
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="summary")
+        self.saver = ThreadPoolExecutor(max_workers=1, thread_name_prefix="summary-save")
+
+    def _state(self, thread_id):
+        state = self.states.get(thread_id)
+        if state is None:
+            if self.storage is not None:
+                try:
+                    state = self.storage.load_state(f"summaries/{thread_id}")
+                except Exception as e:
+                    logger.error(f"读取对话摘要失败 [对话ID: ****{thread_id[-4:]}]: {str(e)}")
+            state = state or {}
+            # Firebase 不保存空的 dict/list
+            state.setdefault('running', '')
+            state.setdefault('days', {})
+            state.setdefault('months', {})
+            # 旧版本保存了待摘要消息本身
+            legacy = state.pop('pending', None)
+            if legacy and not state.get('through') and not state.get('since'):
+                state['since'] = legacy[0]['t']
+            state['pending'] = self._load_pending(thread_id, state)
+            self.states[thread_id] = state
+        return state
+
+    def _load_pending(self, thread_id, state):
+        """从聊天记录中取出还没有摘要的消息
+
+        through 之后（不含）的消息，从来没有生成过摘要的对话取 since 及之后的消息
+        """
+        start = state.get('through') or state.get('since')
+        if self.storage is None or not start:
+            return []
+        try:
+            messages = self.storage.range_by_time(thread_id, start=start)
+        except Exception as e:
+            logger.error(f"读取待摘要消息失败 [对话ID: ****{thread_id[-4:]}]: {str(e)}")
+            return []
+        if state.get('through'):
+            messages = [msg for msg in messages if msg.get('timestamp', '') > start]
+        return [
+            {'r': msg.get('role'), 'c': msg.get('content', ''), 't': msg.get('timestamp', '')}
+            for msg in messages if msg.get('role') in ('user', 'assistant')
+        ]
+
+    def _save(self, thread_id):
+        """在后台线程中写入存储（调用方需持有 lock），连续多次修改只写入最新的一份"""
+        if self.storage is None or thread_id in self.unsaved:
+            return
+        self.unsaved.add(thread_id)
+        self.saver.submit(self._write, thread_id)
+
+    def _write(self, thread_id):
+        with self.lock:
+            self.unsaved.discard(thread_id)
+            state = copy.deepcopy(self.states[thread_id])
+        # 待摘要消息可以从聊天记录中重新取出，不保存
+        state.pop('pending', None)
+        try:
+            self.storage.save_state(f"summaries/{thread_id}", state)
+        except Exception as e:
+            logger.error(f"保存对话摘要失败 [对话ID: ****{thread_id[-4:]}]: {str(e)}")
+
+    def add_message(self, thread_id, role, content, timestamp=''):
+        """新消息写入对话历史后调用"""
+        thread_id = str(thread_id)
+        try:
+            with self.lock:
+                state = self._state(thread_id)
+                message = {'r': role, 'c': content, 't': timestamp}
+                # 重新取出待摘要消息时可能已经包含了这条消息
+                if message not in state['pending']:
+                    state['pending'].append(message)
+                if not state.get('through') and not state.get('since'):
+                    # 第一次记录该对话，保存起点，重启后从这里取出待摘要消息
+                    state['since'] = timestamp
+                    self._save(thread_id)
+                if len(state['pending']) >= self.every and thread_id not in self.updating:
+                    self.updating.add(thread_id)
+                    self.executor.submit(self._update, thread_id)
+        except Exception as e:
+            logger.error(f"记录待摘要消息失败: {str(e)}")
+
+    def _update(self, thread_id):
+        masked_thread_id = f"****{thread_id[-4:]}"
+        try:
+            with self.lock:
+                state = self._state(thread_id)
+                batch = list(state['pending'])
+                running = state['running']
+                days = dict(state['days'])
+                months = dict(state['months'])
+
+            logger.info(f"更新对话摘要 [对话ID: {masked_thread_id}] - {len(batch)} 条新消息")
+            new_running = self.summarize(
+                f"已有摘要：{running or '无'}\n\n新的对话：\n{_format_messages(batch)}", RUNNING_CHARS
+            )
+            if not new_running:
+                raise Exception("摘要模型没有返回内容")
+
+            by_day = {}
+            for msg in batch:
+                by_day.setdefault(msg['t'][:10], []).append(msg)
+            for day, messages in by_day.items():
+                summary = self.summarize(
+                    f"当天已有摘要：{days.get(day) or '无'}\n\n新的对话：\n{_format_messages(messages)}", DAY_CHARS
+                )
+                if summary:
+                    days[day] = summary
+
+            # 早于最新消息所在月份的日摘要合并为月摘要
+            current_month = max(by_day)[:7]
+            for month in sorted({day[:7] for day in days if day[:7] < current_month}):
+                month_days = sorted(day for day in days if day[:7] == month)
+                text = "\n".join(f"{day}: {days[day]}" for day in month_days)
+                if months.get(month):
+                    text = f"{months[month]}\n{text}"
+                summary = self.summarize(text, MONTH_CHARS)
+                if summary:
+                    months[month] = summary
+                    for day in month_days:
+                        del days[day]
+
+            with self.lock:
+                state['running'] = new_running
+                state['days'] = days
+                state['months'] = months
+                state['pending'] = state['pending'][len(batch):]
+                state['through'] = batch[-1]['t']
+                state.pop('since', None)
+                self._save(thread_id)
+                # 更新期间又积累了足够的新消息
+                if len(state['pending']) >= self.every:
+                    self.executor.submit(self._update, thread_id)
+                else:
+                    self.updating.discard(thread_id)
+            logger.info(f"对话摘要已更新 [对话ID: {masked_thread_id}]")
+        except Exception as e:
+            # 待摘要消息保留，下次收到新消息时重试
+            logger.error(f"更新对话摘要失败 [对话ID: {masked_thread_id}]: {str(e)}")
+            with self.lock:
+                self.updating.discard(thread_id)
+
+    def context(self, thread_id):
+        """生成回复时使用的长期记忆，长度有上限，与历史长度无关"""
+        thread_id = str(thread_id)
+        with self.lock:
+            state = self._state(thread_id)
+            parts = []
+            for month in sorted(state['months'])[-RECENT_MONTHS:]:
+                parts.append(f"{month}: {state['months'][month]}")
+            for day in sorted(state['days'])[-RECENT_DAYS:]:
+                parts.append(f"{day}: {state['days'][day]}")
+            if state['running']:
+                parts.append(f"总体: {state['running']}")
+        return "\n".join(parts)
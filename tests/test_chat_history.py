@@ -0,0 +1,68 @@
+import pytest
+
+pytest.importorskip("firebase_admin")
+
+from chat_history import ChatHistoryManager
+from chat_storage import SQLiteStorage
+
+
+def make_manager(tmp_path, storage, **kwargs):
+    return ChatHistoryManager(
+        storage=storage,
+        journal_path=str(tmp_path / "journal.jsonl"),
+        flush_interval=3600,
+        max_pending=1000,
+        **kwargs
+    )
+
+
+def contents(messages):
+    return [m['content'] for m in messages]
+
+
+def test_write_behind_flush(tmp_path):
+    storage = SQLiteStorage(str(tmp_path / "chat.db"))
+    manager = make_manager(tmp_path, storage)
+    manager.add_message('t1', 'user', 'hello')
+    manager.add_message('t1', 'assistant', 'hi')
+    assert storage.load('t1') == []
+    # 尚未写入存储的消息也能读到
+    assert contents(manager.load_conversation('t1', last_n=10)) == ['hello', 'hi']
+
+    assert manager.flush()
+    assert contents(storage.load('t1')) == ['hello', 'hi']
+    assert not (tmp_path / "journal.jsonl").exists()
+    manager.close()
+
+
+def test_journal_replay_after_crash(tmp_path):
+    storage = SQLiteStorage(str(tmp_path / "chat.db"))
+    crashed = make_manager(tmp_path, storage)
+    crashed.add_message('t1', 'user', 'one')
+    crashed.add_message('t1', 'assistant', 'two')
+    # 模拟崩溃：后台线程停止、没有刷新，最后一行只写了一半
+    crashed.closed = True
+    with open(tmp_path / "journal.jsonl", 'a', encoding='utf-8') as f:
+        f.write('{"thread_id": "t1", "key": ')
+    assert storage.load('t1') == []
+
+    restarted = make_manager(tmp_path, storage)
+    assert contents(storage.load('t1')) == ['one', 'two']
+    assert not (tmp_path / "journal.jsonl").exists()
+    restarted.close()
+
+    # 同一份日志再次重放不会产生重复消息
+    assert contents(storage.load('t1')) == ['one', 'two']
+
+
+def test_sync_mode_and_cache(tmp_path):
+    storage = SQLiteStorage(str(tmp_path / "chat.db"))
+    manager = make_manager(tmp_path, storage, write_behind=False, cache_ttl=0)
+    manager.add_message('t1', 'user', 'a')
+    assert contents(manager.load_conversation('t1')) == ['a']
+    manager.add_message('t1', 'assistant', 'b')
+    assert contents(manager.load_conversation('t1')) == ['a', 'b']
+    # 其他写入者追加的消息在缓存校验时被发现
+    storage.append('t1', {'timestamp': '2999-01-01T00:00:00', 'role': 'user', 'content': 'c'})
+    assert contents(manager.load_conversation('t1')) == ['a', 'b', 'c']
+    assert manager.history_version('t1') == 2
@@ -0,0 +1,155 @@
+import pytest
+
+pytest.importorskip("firebase_admin")
+
+from chat_storage import FirebaseStorage, SQLiteStorage, generate_push_id, normalize_conversation
+
+
+def msg(timestamp, content, role='user'):
+    return {'timestamp': timestamp, 'role': role, 'content': content}
+
+
+def contents(messages):
+    return [m['content'] for m in messages]
+
+
+def test_normalize_legacy_list_skips_holes():
+    data = [msg('2024-01-01T00:00:00', 'a'), None, msg('2024-01-01T00:00:02', 'b')]
+    assert contents(normalize_conversation(data)) == ['a', 'b']
+
+
+def test_normalize_legacy_digit_keys_before_push_ids():
+    first, second = generate_push_id(), generate_push_id()
+    data = {
+        second: msg('2024-01-02T00:00:00', 'd'),
+        '10': msg('2024-01-01T00:00:10', 'b'),
+        first: msg('2024-01-02T00:00:00', 'c'),
+        '2': msg('2024-01-01T00:00:02', 'a'),
+    }
+    assert contents(normalize_conversation(data)) == ['a', 'b', 'c', 'd']
+
+
+def test_normalize_monthly_partitions():
+    data = {
+        '2024-02': {generate_push_id(): msg('2024-02-01T00:00:00', 'feb')},
+        '2024-01': {generate_push_id(): msg('2024-01-01T00:00:00', 'jan')},
+    }
+    assert contents(normalize_conversation(data)) == ['jan', 'feb']
+
+
+def test_normalize_grouped_nodes_and_junk():
+    data = {
+        'node_b': {'m1': msg('2024-01-01T00:00:03', 'c')},
+        'node_a': {'m1': msg('2024-01-01T00:00:01', 'a'), 'm2': msg('2024-01-01T00:00:02', 'b')},
+        'meta': 'not a message',
+        'empty': {},
+    }
+    assert contents(normalize_conversation(data)) == ['a', 'b', 'c']
+
+
+def test_normalize_empty():
+    assert normalize_conversation(None) == []
+    assert normalize_conversation({}) == []
+
+
+@pytest.fixture
+def sqlite(tmp_path):
+    return SQLiteStorage(str(tmp_path / "chat.db"))
+
+
+def test_sqlite_append_tail_range(sqlite):
+    for i in range(5):
+        sqlite.append('t1', msg(f'2024-01-01T00:00:0{i}', str(i)))
+    sqlite.append('t2', msg('2024-01-01T00:00:09', 'other'))
+
+    assert contents(sqlite.load('t1')) == ['0', '1', '2', '3', '4']
+    assert contents(sqlite.tail('t1', 2)) == ['3', '4']
+    assert contents(sqlite.range_by_time('t1', start='2024-01-01T00:00:01', end='2024-01-01T00:00:03')) == ['1', '2', '3']
+    assert sorted(sqlite.list_threads()) == ['t1', 't2']
+
+
+def test_sqlite_append_batch_ignores_duplicate_keys(sqlite):
+    key = generate_push_id()
+    sqlite.append_batch([('t1', key, msg('2024-01-01T00:00:00', 'a'))])
+    sqlite.append_batch([('t1', key, msg('2024-01-01T00:00:00', 'a'))])
+    assert contents(sqlite.load('t1')) == ['a']
+
+
+def test_sqlite_load_if_changed(sqlite):
+    sqlite.append('t1', msg('2024-01-01T00:00:00', 'a'))
+    changed, messages, version = sqlite.load_if_changed('t1')
+    assert changed and contents(messages) == ['a']
+    assert sqlite.load_if_changed('t1', version) == (False, None, version)
+    sqlite.append('t1', msg('2024-01-01T00:00:01', 'b'))
+    assert sqlite.load_if_changed('t1', version)[0]
+
+
+def test_sqlite_state(sqlite):
+    assert sqlite.load_state('inbox_sync') is None
+    sqlite.save_state('inbox_sync/123', {'item_id': '1'})
+    sqlite.save_state('inbox_sync/456', {'item_id': '2'})
+    assert sqlite.load_state('inbox_sync') == {'123': {'item_id': '1'}, '456': {'item_id': '2'}}
+    sqlite.save_state('inbox_sync', {})
+    assert sqlite.load_state('inbox_sync') == {}
+
+
+class FakeRef:
+    """模拟 Firebase 按 timestamp 查询：没有 timestamp 的子节点排在最前，start_at 会把它们排除"""
+
+    def __init__(self, data, start=None, limit=None):
+        self.data = data
+        self.start = start
+        self.limit = limit
+
+    def order_by_child(self, child):
+        return self
+
+    def start_at(self, start):
+        return FakeRef(self.data, start, self.limit)
+
+    def limit_to_first(self, limit):
+        return FakeRef(self.data, self.start, limit)
+
+    def get(self):
+        items = sorted(self.data.items(), key=lambda item: item[1].get('timestamp') or '')
+        if self.start is not None:
+            items = [item for item in items if (item[1].get('timestamp') or '') >= self.start]
+        if self.limit is not None:
+            items = items[:self.limit]
+        return dict(items)
+
+
+def test_firebase_range_reads_grouped_thread_in_full():
+    storage = FirebaseStorage.__new__(FirebaseStorage)
+    grouped = FakeRef({
+        'node_a': {'m1': msg('2024-01-01T08:00:00', 'old'), 'm2': msg('2024-01-02T08:00:00', 'today')},
+        generate_push_id(): msg('2024-01-02T09:00:00', 'flat'),
+    })
+    assert contents(storage._query_by_time(grouped, start='2024-01-02T00:00:00')) == ['today', 'flat']
+
+    flat = FakeRef({generate_push_id(): msg('2024-01-01T08:00:00', 'old'),
+                    generate_push_id(): msg('2024-01-02T08:00:00', 'today')})
+    assert contents(storage._query_by_time(flat, start='2024-01-02T00:00:00')) == ['today']
+
+
+class RecordingRef:
+    def __init__(self):
+        self.updates = []
+
+    def update(self, updates):
+        self.updates.append(updates)
+
+
+def test_firebase_append_batch_updates_watch_marker():
+    storage = FirebaseStorage.__new__(FirebaseStorage)
+    storage.root = 'chat_histories'
+    storage.updates_root = 'chat_updates'
+    storage.db_root = RecordingRef()
+    first, second = generate_push_id(), generate_push_id()
+    storage.append_batch([('t1', first, msg('2024-01-01T00:00:00', 'a')),
+                          ('t1', second, msg('2024-01-01T00:00:01', 'b'))])
+
+    (updates,) = storage.db_root.updates
+    assert updates[f'chat_histories/t1/{first}']['content'] == 'a'
+    assert updates[f'chat_histories/t1/{second}']['content'] == 'b'
+    assert updates['chat_updates/t1'] == second
@@ -0,0 +1,130 @@
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+from inbox_sync import InboxSync
+
+OWN_ID = '1'
+BASE = datetime(2024, 1, 1, 12, 0, 0)
+
+
+def message(item_id, seconds, user_id='2', text=''):
+    return SimpleNamespace(id=str(item_id), user_id=user_id, timestamp=BASE + timedelta(seconds=seconds), text=text)
+
+
+def thread(thread_id, messages, last_activity_at=None):
+    if last_activity_at is None and messages:
+        last_activity_at = max(msg.timestamp for msg in messages)
+    return SimpleNamespace(id=thread_id, messages=messages, last_activity_at=last_activity_at)
+
+
+class FakeClient:
+    user_id = OWN_ID
+
+    def __init__(self, unread=(), pending=(), history=None):
+        self.unread = list(unread)
+        self.pending = list(pending)
+        self.history = history or {}
+        self.history_calls = []
+
+    def direct_threads(self, amount, selected_filter, thread_message_limit):
+        return self.unread
+
+    def direct_pending_inbox(self, amount):
+        return self.pending
+
+    def direct_messages(self, thread_id, amount):
+        self.history_calls.append(thread_id)
+        return self.history.get(thread_id, [])
+
+
+class FakeStorage:
+    def __init__(self, state=None):
+        self.state = state or {}
+        self.saved = []
+
+    def load_state(self, name):
+        return self.state
+
+    def save_state(self, name, data):
+        self.saved.append((name, data))
+
+
+def test_new_thread_returns_messages_after_own_reply():
+    messages = [message(1, 0), message(2, 1, user_id=OWN_ID), message(3, 2), message(4, 3)]
+    sync = InboxSync(FakeClient(), message_limit=5)
+
+    assert [msg.id for msg in sync.unseen(thread('t1', messages))] == ['3', '4']
+
+
+def test_unseen_returns_messages_after_mark_and_skips_own():
+    sync = InboxSync(FakeClient(), message_limit=5)
+    sync.mark('t1', message(2, 1))
+    messages = [message(1, 0), message(2, 1), message(3, 2, user_id=OWN_ID), message(4, 3)]
+
+    assert [msg.id for msg in sync.unseen(thread('t1', messages))] == ['4']
+
+
+def test_unseen_backfills_when_inbox_preview_does_not_reach_mark():
+    history = {'t1': [message(i, i) for i in range(1, 8)]}
+    client = FakeClient(history=history)
+    sync = InboxSync(client, message_limit=3)
+    sync.mark('t1', message(2, 2))
+
+    preview = history['t1'][-3:]
+    assert [msg.id for msg in sync.unseen(thread('t1', preview))] == ['3', '4', '5', '6', '7']
+    assert client.history_calls == ['t1']
+
+
+def test_poll_merges_lists_and_skips_threads_without_new_activity():
+    old = thread('t1', [message(1, 0)])
+    fresh = thread('t2', [message(2, 5), message(3, 6)])
+    client = FakeClient(unread=[old, fresh], pending=[fresh])
+    sync = InboxSync(client, message_limit=5)
+    sync.mark('t1', message(1, 0))
+    sync.mark('t2', message(2, 5))
+
+    updates = sync.poll()
+
+    assert [(t.id, [msg.id for msg in msgs]) for t, msgs in updates] == [('t2', ['3'])]
+
+
+def test_mark_only_moves_forward_and_saves_one_thread():
+    storage = FakeStorage()
+    sync = InboxSync(FakeClient(), storage=storage)
+
+    sync.mark('t1', message(5, 5))
+    sync.mark('t1', message(4, 4))
+
+    assert sync.threads['t1']['item_id'] == '5'
+    assert storage.saved == [('inbox_sync/t1', {'item_id': '5', 'timestamp': (BASE + timedelta(seconds=5)).isoformat()})]
+
+
+def test_marks_are_loaded_from_storage():
+    mark = {'item_id': '1', 'timestamp': BASE.isoformat()}
+    sync = InboxSync(FakeClient(unread=[thread('t1', [message(1, 0)])]), storage=FakeStorage({'t1': mark}))
+
+    assert sync.poll() == []
+
+
+def test_message_with_same_timestamp_as_mark_is_not_dropped():
+    first, second = message(100, 5), message(101, 5)
+    sync = InboxSync(FakeClient(unread=[thread('t1', [second, first])]), message_limit=5)
+    sync.mark('t1', first)
+
+    assert [(t.id, [msg.id for msg in msgs]) for t, msgs in sync.poll()] == [('t1', ['101'])]
+
+    sync.mark('t1', second)
+    assert sync.threads['t1']['item_id'] == '101'
+    assert sync.poll() == []
+    # 时间相同、顺序更早的消息不会让高水位后退
+    sync.mark('t1', first)
+    assert sync.threads['t1']['item_id'] == '101'
+
+
+def test_poll_does_not_request_threads_older_than_mark():
+    client = FakeClient(unread=[thread('t1', [], last_activity_at=BASE)])
+    sync = InboxSync(client, message_limit=5)
+    sync.mark('t1', message(1, 10))
+
+    assert sync.poll() == []
+    assert client.history_calls == []
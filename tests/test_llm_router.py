@@ -0,0 +1,92 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+pytest.importorskip("requests")
+
+from llm_router import ChatRouter
+from resilience import CircuitOpenError
+
+
+class FakeGateway:
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=8)
+
+    def submit(self, provider, func, *args, **kwargs):
+        return self.executor.submit(func, *args, **kwargs)
+
+
+def provider(calls, name, delay=0.0, error=None):
+    def call(messages):
+        calls.append(name)
+        time.sleep(delay)
+        if error is not None:
+            raise error
+        return name
+    return name, call
+
+
+def test_failure_with_hedge_in_flight_does_not_start_more_backups():
+    calls = []
+    router = ChatRouter(FakeGateway(), providers=[
+        provider(calls, 'router-test-a', delay=0.2, error=ValueError("boom")),
+        provider(calls, 'router-test-b', delay=0.4),
+        provider(calls, 'router-test-c'),
+    ], hedge_delay=0.05)
+
+    assert router.complete([]) == ('router-test-b', 'router-test-b')
+    assert calls == ['router-test-a', 'router-test-b']
+
+
+def test_falls_back_when_nothing_is_in_flight():
+    calls = []
+    router = ChatRouter(FakeGateway(), providers=[
+        provider(calls, 'router-test-d', error=ValueError("boom")),
+        provider(calls, 'router-test-e'),
+    ], hedge_delay=1)
+
+    assert router.complete([]) == ('router-test-e', 'router-test-e')
+    assert calls == ['router-test-d', 'router-test-e']
+
+
+def test_open_circuit_is_not_recorded_as_provider_error():
+    calls = []
+    router = ChatRouter(FakeGateway(), providers=[
+        provider(calls, 'router-test-f', error=CircuitOpenError("open")),
+        provider(calls, 'router-test-g'),
+    ], hedge_delay=1)
+
+    assert router.complete([])[1] == 'router-test-g'
+    assert router.stats['router-test-f'].error_rate() == 0.0
+
+
+def test_stream_holds_a_gateway_slot_with_deadline(monkeypatch):
+    import concurrent.futures
+
+    import http_client
+    import llm_router
+    from llm_gateway import LLMGateway
+
+    seen = []
+
+    def stream(messages):
+        seen.append(http_client.current_deadline())
+        yield 'a'
+        yield 'b'
+
+    monkeypatch.setenv('LLM_CONCURRENCY_ROUTER-TEST-H', '1')
+    monkeypatch.setitem(llm_router.STREAM_FUNCTIONS, 'router-test-h', stream)
+    gateway = LLMGateway(deadline=5)
+    router = ChatRouter(gateway, providers=[provider([], 'router-test-h')])
+
+    chunks = router.stream([])
+    assert next(chunks) == 'a'
+    assert seen[0] is not None
+    # 流未结束时占用唯一的名额
+    with pytest.raises(concurrent.futures.TimeoutError):
+        with gateway.slot('router-test-h', deadline=0.1):
+            pass
+    assert list(chunks) == ['b']
+    with gateway.slot('router-test-h', deadline=1):
+        pass
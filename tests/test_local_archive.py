@@ -0,0 +1,67 @@
+import json
+import os
+
+import local_archive
+from local_archive import ConversationArchive
+
+
+def msg(i):
+    return {'timestamp': f'2024-01-01T00:00:{i:02d}', 'role': 'user', 'content': str(i)}
+
+
+def contents(messages):
+    return [m['content'] for m in messages]
+
+
+def test_round_trip_with_segment_rotation(tmp_path):
+    archive = ConversationArchive(str(tmp_path), segment_size=3)
+    archive.extend('t1', [msg(i) for i in range(5)])
+    archive.append('t1', msg(5))
+    archive.extend('t1', [msg(6), msg(7)])
+
+    files = sorted(os.listdir(tmp_path / 't1'))
+    assert files == ['index.json', 'seg_000001.jsonl.gz', 'seg_000002.jsonl.gz', 'seg_000003.jsonl']
+    assert archive.count('t1') == 8
+    assert contents(archive.load('t1')) == [str(i) for i in range(8)]
+    assert contents(archive.tail('t1', 4)) == ['4', '5', '6', '7']
+    assert contents(archive.range_by_time('t1', '2024-01-01T00:00:02', '2024-01-01T00:00:04')) == ['2', '3', '4']
+
+    # 重新打开后从索引读取
+    reopened = ConversationArchive(str(tmp_path), segment_size=3)
+    assert contents(reopened.load('t1')) == [str(i) for i in range(8)]
+
+
+def test_zstd_falls_back_to_gzip_without_zstandard(tmp_path, monkeypatch):
+    monkeypatch.setattr(local_archive, 'zstandard', None)
+    archive = ConversationArchive(str(tmp_path), segment_size=2, compression='zstd')
+    assert archive.compression == 'gzip'
+    archive.extend('t1', [msg(0), msg(1)])
+    assert 'seg_000001.jsonl.gz' in os.listdir(tmp_path / 't1')
+    assert contents(archive.load('t1')) == ['0', '1']
+
+
+def test_recovers_truncated_last_line(tmp_path):
+    archive = ConversationArchive(str(tmp_path), segment_size=100)
+    archive.extend('t1', [msg(0), msg(1)])
+    segment = tmp_path / 't1' / 'seg_000001.jsonl'
+    # 模拟崩溃：写入了一条完整消息和半条消息，索引还没来得及更新
+    with open(segment, 'ab') as f:
+        f.write(json.dumps(msg(2)).encode('utf-8') + b"\n")
+        f.write(b'{"timestamp": "2024-01-01T00:00:03", "ro')
+
+    reopened = ConversationArchive(str(tmp_path), segment_size=100)
+    assert reopened.count('t1') == 3
+    assert contents(reopened.load('t1')) == ['0', '1', '2']
+    reopened.append('t1', msg(4))
+    assert contents(ConversationArchive(str(tmp_path)).load('t1')) == ['0', '1', '2', '4']
+
+
+def test_imports_legacy_backup(tmp_path):
+    with open(tmp_path / 'conversation_t1.json', 'w', encoding='utf-8') as f:
+        json.dump([msg(0), msg(1), msg(2)], f)
+
+    archive = ConversationArchive(str(tmp_path), segment_size=2)
+    assert archive.list_threads() == ['t1']
+    assert archive.exists('t1')
+    assert contents(archive.load('t1')) == ['0', '1', '2']
+    assert (tmp_path / 't1' / 'index.json').exists()
@@ -0,0 +1,98 @@
+import pytest
+
+pytest.importorskip("numpy")
+
+from memory_index import MemoryIndex, ThreadIndex, tokenize
+
+
+def make_index(pairs):
+    index = ThreadIndex()
+    for user, assistant in pairs:
+        index.add_message('user', user)
+        index.add_message('assistant', assistant)
+    return index
+
+
+def test_tokenize_mixed_cjk_and_ascii():
+    assert tokenize("Hi 你好吗") == ['hi', '你', '好', '吗', '你好', '好吗']
+    assert tokenize("iPhone15 和 MacBook") == ['iphone15', 'macbook', '和']
+    assert tokenize("!!!") == []
+
+
+def test_search_ranks_most_relevant_pair_first():
+    index = make_index([
+        ("今天天气怎么样", "晴天"),
+        ("我的猫叫什么名字", "你的猫叫小白"),
+        ("猫喜欢吃鱼吗", "大部分猫喜欢"),
+        ("my dog likes walks", "great"),
+    ])
+
+    assert index.search("我的猫叫什么", 2) == [1, 2]
+    assert index.search("dog", 5) == [3]
+    assert index.search("", 5) == []
+
+
+def test_add_message_pairs_user_messages_with_next_reply():
+    index = ThreadIndex()
+    assert index.add_message('assistant', "没有问题的回复") is None
+    assert index.add_message('user', "第一句") is None
+    assert index.add_message('user', "第二句") is None
+    pair = index.add_message('assistant', "回复", '2024-01-01T00:00:00')
+
+    assert pair == {'u': "第一句\n第二句", 'a': "回复", 't': '2024-01-01T00:00:00'}
+    assert index.pending_user == []
+    assert index.search("第二句", 5) == [0]
+
+    index.add_message('user', "新的问题")
+    assert len(index.pairs) == 1
+    index.add_message('assistant', "新的回复")
+    assert index.search("新的问题", 5) == [1]
+
+
+def test_min_score_drops_weak_matches():
+    index = make_index([
+        ("我的猫叫小白", "记住了"),
+        ("明天去北京出差", "一路顺风"),
+        ("北京的烤鸭很好吃", "是的"),
+    ])
+
+    assert index.search("的", 5) != []
+    assert index.search("的", 5, min_score=2.0) == []
+    assert index.search("北京出差", 5, min_score=2.0)[0] == 1
+
+
+def test_memory_index_search_returns_messages_in_time_order():
+    memory = MemoryIndex(base_dir='', min_score=0.0)
+    assert memory.needs_build('t1')
+    memory.build('t1', [
+        {'role': 'user', 'content': "我住在上海"},
+        {'role': 'assistant', 'content': "上海很好"},
+        {'role': 'user', 'content': "我喜欢打篮球"},
+        {'role': 'assistant', 'content': "篮球很有趣"},
+    ])
+    memory.add_message('t1', 'user', "上海明天下雨吗")
+    memory.add_message('t1', 'assistant', "可能会下雨")
+
+    assert not memory.needs_build('t1')
+    assert memory.version('t1') == 3
+    assert memory.search('t1', "上海", k=2) == [
+        {'role': 'user', 'content': "我住在上海"},
+        {'role': 'assistant', 'content': "上海很好"},
+        {'role': 'user', 'content': "上海明天下雨吗"},
+        {'role': 'assistant', 'content': "可能会下雨"},
+    ]
+
+
+def test_memory_index_reloads_pairs_from_disk(tmp_path):
+    memory = MemoryIndex(base_dir=str(tmp_path), min_score=0.0)
+    memory.build('t1', [
+        {'role': 'user', 'content': "我的生日是五月"},
+        {'role': 'assistant', 'content': "记住了"},
+    ])
+    memory.add_message('t1', 'user', "我喜欢咖啡")
+    memory.add_message('t1', 'assistant', "好的")
+
+    reloaded = MemoryIndex(base_dir=str(tmp_path), min_score=0.0)
+    assert not reloaded.needs_build('t1')
+    assert reloaded.version('t1') == 2
+    assert reloaded.search('t1', "咖啡", k=1)[0]['content'] == "我喜欢咖啡"
@@ -0,0 +1,32 @@
+import time
+
+import pytest
+
+pytest.importorskip("requests")
+
+import http_client
+from resilience import call_with_retry
+
+
+def test_each_attempt_timeout_is_capped_by_slo():
+    timeouts = []
+
+    def call():
+        timeouts.append(http_client._apply_deadline((5, 60)))
+        return 'ok'
+
+    assert call_with_retry('resilience-test-a', call, slo=2) == 'ok'
+    assert timeouts[0][0] <= 2
+    assert timeouts[0][1] <= 2
+
+
+def test_outer_deadline_still_applies():
+    timeouts = []
+
+    def call():
+        timeouts.append(http_client._apply_deadline(60))
+        return 'ok'
+
+    with http_client.deadline(time.time() + 1):
+        call_with_retry('resilience-test-b', call, slo=30)
+    assert timeouts[0] <= 1
@@ -0,0 +1,34 @@
+from rule_engine import RuleEngine
+
+RULES = [
+    {"name": "greeting", "keywords": ["你好", "hi", "hello"], "replies": ["greeting"]},
+    {"name": "thanks", "keywords": ["谢谢", "thanks"], "replies": ["thanks"]},
+    {"name": "outdoor", "keywords": ["喜欢"], "last_assistant": ["户外活动"], "replies": ["outdoor"]},
+]
+
+
+def test_ascii_keyword_matches_whole_word_only():
+    engine = RuleEngine(RULES)
+    assert engine.match("this is it") is None
+    assert engine.match("shelloff") is None
+    assert engine.match("Hi there") == "greeting"
+    assert engine.match("hi!") == "greeting"
+
+
+def test_ascii_keyword_next_to_cjk():
+    engine = RuleEngine(RULES)
+    assert engine.match("hi你好") == "greeting"
+    assert engine.match("thanks啦") == "thanks"
+
+
+def test_cjk_keyword_matches_substring():
+    engine = RuleEngine(RULES)
+    assert engine.match("你好呀") == "greeting"
+    assert engine.match("真的谢谢你") == "thanks"
+
+
+def test_last_assistant_condition():
+    engine = RuleEngine(RULES)
+    history = [{"role": "assistant", "content": "你喜欢户外活动吗？"}]
+    assert engine.match("我喜欢", history) == "outdoor"
+    assert engine.match("我喜欢") is None
@@ -0,0 +1,89 @@
+import copy
+
+from summary_memory import SummaryStore
+
+
+class FakeStorage:
+    def __init__(self):
+        self.messages = []
+        self.states = {}
+        self.saves = []
+
+    def append(self, role, content, timestamp):
+        self.messages.append({'timestamp': timestamp, 'role': role, 'content': content})
+
+    def range_by_time(self, thread_id, start=None, end=None):
+        return [m for m in self.messages if not start or m['timestamp'] >= start]
+
+    def load_state(self, name):
+        return copy.deepcopy(self.states.get(name))
+
+    def save_state(self, name, data):
+        self.saves.append(copy.deepcopy(data))
+        self.states[name] = copy.deepcopy(data)
+
+
+def summarize(text, max_chars):
+    return f"摘要{len(text)}"
+
+
+def add(store, storage, role, content, timestamp):
+    storage.append(role, content, timestamp)
+    store.add_message('t1', role, content, timestamp)
+
+
+def wait(store):
+    store.executor.submit(lambda: None).result()
+    store.saver.submit(lambda: None).result()
+
+
+def test_saves_only_start_and_summaries_without_pending():
+    storage = FakeStorage()
+    store = SummaryStore(summarize, storage=storage, every=3)
+
+    for i in range(5):
+        add(store, storage, 'user', f"消息{i}", f"2024-01-01T00:00:0{i}")
+        wait(store)
+
+    assert len(storage.saves) == 2
+    assert storage.saves[0] == {'running': '', 'days': {}, 'months': {}, 'since': '2024-01-01T00:00:00'}
+    assert storage.saves[1]['through'] == '2024-01-01T00:00:02'
+    assert 'since' not in storage.saves[1]
+    assert all('pending' not in state for state in storage.saves)
+    assert store.states['t1']['pending'] == [
+        {'r': 'user', 'c': "消息3", 't': '2024-01-01T00:00:03'},
+        {'r': 'user', 'c': "消息4", 't': '2024-01-01T00:00:04'},
+    ]
+
+
+def test_pending_is_rebuilt_from_storage_after_restart():
+    storage = FakeStorage()
+    store = SummaryStore(summarize, storage=storage, every=3)
+    for i in range(5):
+        add(store, storage, 'user', f"消息{i}", f"2024-01-01T00:00:0{i}")
+        wait(store)
+
+    restarted = SummaryStore(summarize, storage=storage, every=3)
+    # 新消息已经写入聊天记录，重新取出时包含它，不会重复记录
+    add(restarted, storage, 'assistant', "回复", '2024-01-01T00:00:05')
+    wait(restarted)
+
+    assert storage.saves[-1]['through'] == '2024-01-01T00:00:05'
+    assert restarted.states['t1']['pending'] == []
+    assert restarted.context('t1').startswith("2024-01-01:")
+
+
+def test_legacy_pending_becomes_start_marker():
+    storage = FakeStorage()
+    storage.append('user', "旧消息", '2024-01-01T00:00:00')
+    storage.states['summaries/t1'] = {
+        'running': "旧摘要",
+        'pending': [{'r': 'user', 'c': "旧消息", 't': '2024-01-01T00:00:00'}],
+    }
+    store = SummaryStore(summarize, storage=storage, every=3)
+
+    add(store, storage, 'user', "新消息", '2024-01-01T00:00:01')
+    wait(store)
+
+    assert [m['c'] for m in store.states['t1']['pending']] == ["旧消息", "新消息"]
+    assert storage.saves == []
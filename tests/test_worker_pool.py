@@ -0,0 +1,94 @@
+import threading
+import time
+
+from worker_pool import OrderedWorkerPool, SendPacer
+
+
+def test_same_key_runs_in_submit_order():
+    pool = OrderedWorkerPool(workers=4)
+    done = []
+
+    def task(i):
+        time.sleep(0.01 if i % 2 else 0)
+        done.append(i)
+
+    for i in range(10):
+        pool.submit('t1', task, i)
+    pool.join()
+    pool.shutdown()
+
+    assert done == list(range(10))
+
+
+def test_different_keys_run_in_parallel():
+    pool = OrderedWorkerPool(workers=2)
+    barrier = threading.Barrier(2, timeout=2)
+    results = []
+
+    def task(key):
+        # 两个对话必须同时在执行才能通过
+        barrier.wait()
+        results.append(key)
+
+    pool.submit('t1', task, 't1')
+    pool.submit('t2', task, 't2')
+    pool.join()
+    pool.shutdown()
+
+    assert sorted(results) == ['t1', 't2']
+
+
+def test_join_waits_for_queued_and_failed_tasks():
+    pool = OrderedWorkerPool(workers=2)
+    done = []
+
+    def slow(i):
+        time.sleep(0.05)
+        done.append(i)
+
+    def fail():
+        raise ValueError("boom")
+
+    pool.submit('t1', slow, 1)
+    pool.submit('t1', fail)
+    pool.submit('t1', slow, 2)
+    pool.submit('t2', slow, 3)
+    pool.join()
+
+    assert sorted(done) == [1, 2, 3]
+    assert pool.pending == 0
+    assert pool.queues == {}
+    pool.shutdown()
+
+
+def test_send_pacer_spaces_sends_and_runs_one_at_a_time():
+    pacer = SendPacer(interval=0.05)
+    sends = []
+    active = []
+    overlaps = []
+
+    def send():
+        with pacer:
+            active.append(1)
+            overlaps.append(len(active))
+            sends.append(time.time())
+            time.sleep(0.01)
+            active.pop()
+
+    threads = [threading.Thread(target=send) for _ in range(3)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    sends.sort()
+    assert overlaps == [1, 1, 1]
+    # 上一次发送结束后至少间隔 interval
+    assert all(b - a >= 0.06 - 0.005 for a, b in zip(sends, sends[1:]))
+
+
+def test_send_pacer_is_reentrant():
+    pacer = SendPacer(interval=0)
+    with pacer:
+        with pacer:
+            pass
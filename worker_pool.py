@@ -0,0 +1,93 @@
+import os
+import time
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+THREAD_WORKERS = int(os.getenv('THREAD_WORKERS', '3'))  # 同时处理的对话数上限
+IG_SEND_INTERVAL = float(os.getenv('IG_SEND_INTERVAL', '1.5'))  # 所有对话共用的两次发送消息最小间隔（秒）
+
+
+class SendPacer:
+    """全局发送节奏：无论多少个对话同时在处理，发送消息之间至少间隔 interval 秒
+
+    作为上下文管理器使用，发送期间一直持有锁，instagrapi 的 Client 不是线程安全的，
+    同一时间只允许一个线程用它发送：
+
+        with pacer:
+            client.direct_answer(thread_id, text)
+    """
+
+    def __init__(self, interval=IG_SEND_INTERVAL):
+        self.interval = interval
+        self.next_at = 0.0
+        self.lock = threading.RLock()
+
+    def __enter__(self):
+        # 持有锁等待，后面的发送依次排队
+        self.lock.acquire()
+        delay = self.next_at - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.next_at = time.time() + self.interval
+        self.lock.release()
+        return False
+
+
+class OrderedWorkerPool:
+    """对话工作池：不同对话并行处理，同一个对话的任务按提交顺序依次执行
+
+    每个对话一个任务队列，同一时间最多一个线程在处理它；
+    等待中的对话不占用线程，并发数不超过 workers。
+    """
+
+    def __init__(self, workers=THREAD_WORKERS):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="thread-worker")
+        self.queues = {}  # 对话 ID -> 待执行的任务
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+
+    def submit(self, key, func, *args, **kwargs):
+        with self.lock:
+            self.pending += 1
+            queue = self.queues.get(key)
+            if queue is not None:
+                # 该对话正在处理，排在后面
+                queue.append((func, args, kwargs))
+                return
+            self.queues[key] = deque([(func, args, kwargs)])
+        self.executor.submit(self._drain, key)
+
+    def _drain(self, key):
+        while True:
+            with self.lock:
+                queue = self.queues[key]
+                if not queue:
+                    del self.queues[key]
+                    return
+                func, args, kwargs = queue.popleft()
+            try:
+                func(*args, **kwargs)
+            except Exception as e:
+                logger.error(f"对话任务执行失败 [对话ID: ****{str(key)[-4:]}]: {str(e)}")
+            finally:
+                with self.lock:
+                    self.pending -= 1
+                    if self.pending == 0:
+                        self.idle.notify_all()
+
+    def join(self):
+        """等待已提交的任务全部完成"""
+        with self.lock:
+            while self.pending:
+                self.idle.wait()
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)